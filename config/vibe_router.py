@@ -12,9 +12,24 @@ Fallback 链 (auto-chat 为例):
     openai/gpt-5 (主模型) → gpt-5 (限流回落)
 """
 
+import asyncio
+import bisect
+import fnmatch
+import hashlib
+import json
+import math
+import os
+import random
+import re
 import sys
+import threading
 import time
-from typing import Optional, Dict, Any, List, Literal, Union
+import traceback
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Any, List, Literal, Union, Tuple, Callable
 
 # Initialize logging immediately
 def _log(message: str, level: str = "INFO"):
@@ -37,6 +52,2967 @@ except ImportError as e:
     raise
 
 
+# ============================================================
+# 配置读取 (环境变量, 统一 VIBE_ 前缀)
+# ============================================================
+def _env_str(name: str, default: str = "") -> str:
+    value = os.environ.get(name)
+    return value.strip() if value is not None and value.strip() else default
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(_env_str(name, str(default)))
+    except ValueError:
+        _log(f"Invalid integer for {name}, using default {default}", "WARN")
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(_env_str(name, str(default)))
+    except ValueError:
+        _log(f"Invalid number for {name}, using default {default}", "WARN")
+        return default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = _env_str(name, "")
+    if not value:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def _get_metadata(kwargs: Optional[Dict]) -> Dict:
+    """
+    从 LiteLLM 回调 kwargs 中取出请求 metadata
+    (proxy 请求体里是 metadata / litellm_metadata, 日志回调里在 litellm_params 下)
+    """
+    if not kwargs:
+        return {}
+    for source in (kwargs, kwargs.get("litellm_params") or {}):
+        for key in ("metadata", "litellm_metadata"):
+            value = source.get(key)
+            if isinstance(value, dict) and value:
+                return value
+    return {}
+
+
+# ============================================================
+# 消息内容遍历 (支持 OpenAI / Anthropic 列表形式的多模态内容)
+# ============================================================
+# 只读取文本的内容块类型
+_TEXT_PART_TYPES = {"text", "input_text", "output_text"}
+# 只计数、不读取负载的内容块类型 (图片/文件/音频可能是 MB 级 base64)
+_MEDIA_PART_TYPES = {"image_url", "image", "input_image", "file", "input_file",
+                     "document", "input_audio", "audio"}
+
+
+class ContentFeatures:
+    """
+    单条消息内容的结构特征
+
+    text 为截断到 scan_cap 的小写文本 (仅来自文本块);
+    text_chars 为所有文本块的真实长度总和 (len() 不复制字符串)。
+    """
+
+    __slots__ = ("text", "text_chars", "media_parts", "tool_uses", "tool_results", "truncated")
+
+    def __init__(self):
+        self.text = ""
+        self.text_chars = 0
+        self.media_parts = 0
+        self.tool_uses = 0
+        self.tool_results = 0
+        self.truncated = False
+
+
+def _walk_content(content: Any, scan_cap: int) -> ContentFeatures:
+    """
+    按类型遍历消息内容块，只读取文本块的前 scan_cap 个字符。
+
+    图片 / 文件等媒体块只计数，不访问其 payload，
+    避免对 base64 做 str() + lower() 产生大块内存分配。
+    """
+    features = ContentFeatures()
+    chunks: List[str] = []
+    budget = scan_cap
+
+    def add_text(text: str):
+        nonlocal budget
+        features.text_chars += len(text)
+        if budget <= 0:
+            features.truncated = features.truncated or bool(text)
+            return
+        if len(text) > budget:
+            features.truncated = True
+        piece = text[:budget]
+        chunks.append(piece)
+        budget -= len(piece)
+
+    def walk(node: Any, depth: int):
+        if isinstance(node, str):
+            add_text(node)
+            return
+        if not isinstance(node, list) or depth > 3:
+            return
+        for part in node:
+            if isinstance(part, str):
+                add_text(part)
+                continue
+            if not isinstance(part, dict):
+                continue
+            part_type = part.get("type")
+            if part_type in _TEXT_PART_TYPES:
+                text = part.get("text")
+                if isinstance(text, str):
+                    add_text(text)
+            elif part_type in _MEDIA_PART_TYPES:
+                features.media_parts += 1
+            elif part_type == "tool_use":
+                features.tool_uses += 1
+            elif part_type == "tool_result":
+                features.tool_results += 1
+                walk(part.get("content"), depth + 1)
+
+    walk(content, 0)
+    features.text = " ".join(chunks).lower() if len(chunks) > 1 else (chunks[0].lower() if chunks else "")
+    return features
+
+
+# ============================================================
+# Token 估算 (不跑 BPE, 按字符类别近似)
+# ============================================================
+# 经验值: 英文/代码约 4 字符 1 token, CJK 约 1 字符 1 token (偏保守)
+_ASCII_CHARS_PER_TOKEN = 4.0
+_CJK_TOKENS_PER_CHAR = 1.0
+# 超过该长度的非 ASCII 文本只抽样估算 CJK 比例
+_TOKEN_SAMPLE_CHARS = 4096
+# 媒体块按固定 token 数计算 (不读取 payload)
+_MEDIA_PART_TOKENS = 1000
+# 每条消息的格式开销 (role / 分隔符)
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def _non_ascii_ratio(sample: str) -> float:
+    """
+    通过 UTF-8 编码长度差估算多字节字符占比
+    (CJK 字符编码为 3 字节, 每个字符比 ASCII 多 2 字节)
+    """
+    if not sample:
+        return 0.0
+    extra_bytes = len(sample.encode("utf-8", "ignore")) - len(sample)
+    return min(1.0, max(0.0, extra_bytes / 2 / len(sample)))
+
+
+def _estimate_text_tokens(text: str) -> int:
+    """估算单段文本的 token 数; ASCII 文本走 C 实现的快速路径, 不做额外分配"""
+    length = len(text)
+    if length == 0:
+        return 0
+    if text.isascii():
+        # 代码中换行/缩进通常单独成 token
+        return int(length / _ASCII_CHARS_PER_TOKEN) + text.count("\n") // 2 + 1
+
+    if length <= _TOKEN_SAMPLE_CHARS * 3:
+        ratio = _non_ascii_ratio(text)
+    else:
+        # 头/中/尾三段抽样
+        middle = length // 2
+        half = _TOKEN_SAMPLE_CHARS // 2
+        ratio = (_non_ascii_ratio(text[:_TOKEN_SAMPLE_CHARS])
+                 + _non_ascii_ratio(text[middle - half:middle + half])
+                 + _non_ascii_ratio(text[-_TOKEN_SAMPLE_CHARS:])) / 3
+    cjk_chars = length * ratio
+    return int(cjk_chars * _CJK_TOKENS_PER_CHAR + (length - cjk_chars) / _ASCII_CHARS_PER_TOKEN) + 1
+
+
+def _estimate_content_tokens(content: Any, depth: int = 0) -> int:
+    if isinstance(content, str):
+        return _estimate_text_tokens(content)
+    if not isinstance(content, list) or depth > 3:
+        return 0
+    tokens = 0
+    for part in content:
+        if isinstance(part, str):
+            tokens += _estimate_text_tokens(part)
+            continue
+        if not isinstance(part, dict):
+            continue
+        part_type = part.get("type")
+        if part_type in _TEXT_PART_TYPES:
+            text = part.get("text")
+            if isinstance(text, str):
+                tokens += _estimate_text_tokens(text)
+        elif part_type in _MEDIA_PART_TYPES:
+            tokens += _MEDIA_PART_TOKENS
+        elif part_type == "tool_use":
+            tokens += _estimate_text_tokens(str(part.get("input", "")))
+        elif part_type == "tool_result":
+            tokens += _estimate_content_tokens(part.get("content"), depth + 1)
+    return tokens
+
+
+def _estimate_message_tokens(message: Dict) -> int:
+    tokens = _MESSAGE_OVERHEAD_TOKENS + _estimate_content_tokens(message.get("content"))
+    for tool_call in message.get("tool_calls") or []:
+        if isinstance(tool_call, dict):
+            function = tool_call.get("function") or {}
+            tokens += _estimate_text_tokens(str(function.get("arguments", "")))
+    return tokens
+
+
+def _estimate_request_tokens(data: Dict) -> int:
+    """估算整个请求的输入 token 数 (system + messages + tools)"""
+    tokens = 0
+    system = data.get("system")
+    if system:
+        tokens += _estimate_content_tokens(system)
+    for message in data.get("messages") or []:
+        if isinstance(message, dict):
+            tokens += _estimate_message_tokens(message)
+    tools = data.get("tools")
+    if tools:
+        tokens += _estimate_text_tokens(str(tools))
+    return tokens
+
+
+# ============================================================
+# Deployment 信息 (来自 model_list 条目)
+# ============================================================
+def _deployment_info(deployment: Dict) -> Dict:
+    return deployment.get("model_info") or {}
+
+
+def _deployment_label(deployment: Dict) -> str:
+    """可读的 deployment 标识: <model_name>/L<层级>:<上游模型>"""
+    params = deployment.get("litellm_params") or {}
+    order = _deployment_info(deployment).get("fallback_order", 1)
+    return f"{deployment.get('model_name')}/L{order}:{params.get('model')}"
+
+
+def _deployment_id(deployment: Dict) -> str:
+    """deployment 唯一标识 (LiteLLM router 生成的 model_info.id)"""
+    return str(_deployment_info(deployment).get("id") or _deployment_label(deployment))
+
+
+def _deployment_context_limit(deployment: Dict) -> Optional[int]:
+    """deployment 的输入上下文上限 (model_info.max_input_tokens), 未配置返回 None"""
+    limit = _deployment_info(deployment).get("max_input_tokens")
+    if limit is None:
+        limit = (deployment.get("litellm_params") or {}).get("max_input_tokens")
+    try:
+        return int(limit) if limit is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _deployment_capacity(deployment: Dict) -> Optional[int]:
+    """deployment 的并发上限: litellm_params.max_parallel_requests 或 model_info.max_concurrency"""
+    params = deployment.get("litellm_params") or {}
+    value = params.get("max_parallel_requests") or _deployment_info(deployment).get("max_concurrency")
+    try:
+        return int(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+# ============================================================
+# 对话轮次分类 (Agent 工具循环识别)
+# ============================================================
+# 对话类请求的 call_type: /v1/chat/completions (completion / acompletion) 和 /v1/messages (anthropic_messages)
+_CHAT_CALL_TYPES = ("completion", "acompletion", "anthropic_messages")
+# 其中 OpenAI 格式的部分 (proxy 对 /v1/chat/completions 使用 acompletion)
+_OPENAI_CHAT_CALL_TYPES = ("completion", "acompletion")
+
+TURN_FRESH_INSTRUCTION = "fresh_instruction"
+TURN_TOOL_CONTINUATION = "tool_continuation"
+TURN_FINAL_SUMMARY = "final_summary"
+
+# 识别总结类请求的标记词 (只在文本前 _SUMMARY_SCAN_CHARS 个字符里查找)
+_SUMMARY_MARKERS = ("summarize", "summary", "summarise", "recap", "总结", "汇总", "概括")
+_SUMMARY_SCAN_CHARS = 512
+# 向前回看多少条消息判断是否处于工具循环中
+_TOOL_HISTORY_LOOKBACK = 20
+
+
+def _message_has_tool_activity(message: Dict) -> bool:
+    """只看 role 和内容块 type, 不读取内容 payload"""
+    role = message.get("role")
+    if role in ("tool", "function") or message.get("tool_calls"):
+        return True
+    content = message.get("content")
+    if isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict) and part.get("type") in ("tool_use", "tool_result"):
+                return True
+    return False
+
+
+def _classify_turn(data: Dict) -> str:
+    """
+    根据消息角色和内容块类型判断本轮请求类型:
+    - tool_continuation: 最后一条是工具结果 (OpenAI role=tool / Anthropic tool_result)
+    - final_summary: 工具循环后的纯文本请求, 且不再提供工具或明确要求总结
+    - fresh_instruction: 其他情况 (用户的新指令)
+    """
+    messages = data.get("messages") or []
+    if not messages or not isinstance(messages[-1], dict):
+        return TURN_FRESH_INSTRUCTION
+
+    last = messages[-1]
+    if last.get("role") in ("tool", "function"):
+        return TURN_TOOL_CONTINUATION
+
+    content = last.get("content")
+    if isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "tool_result":
+                return TURN_TOOL_CONTINUATION
+
+    if last.get("role") != "user":
+        return TURN_FRESH_INSTRUCTION
+
+    history = messages[-_TOOL_HISTORY_LOOKBACK - 1:-1]
+    if not any(isinstance(m, dict) and _message_has_tool_activity(m) for m in history):
+        return TURN_FRESH_INSTRUCTION
+
+    if not data.get("tools") or data.get("tool_choice") == "none":
+        return TURN_FINAL_SUMMARY
+    head = _walk_content(content, _SUMMARY_SCAN_CHARS).text
+    if any(marker in head for marker in _SUMMARY_MARKERS):
+        return TURN_FINAL_SUMMARY
+    return TURN_FRESH_INSTRUCTION
+
+
+def _session_key(data: Dict) -> str:
+    """
+    会话标识: x-session-id 请求头 > litellm_session_id > user 字段 >
+    首条消息文本前缀的哈希 (同一 Agent 会话的首条消息不变)
+    """
+    headers = (data.get("proxy_server_request") or {}).get("headers") or {}
+    for header in ("x-session-id", "x-vibe-session-id"):
+        if headers.get(header):
+            return str(headers[header])
+    metadata = data.get("metadata") or {}
+    for key in ("litellm_session_id", "session_id"):
+        if data.get(key) or metadata.get(key):
+            return str(data.get(key) or metadata.get(key))
+    if data.get("user"):
+        return f"user:{data['user']}"
+
+    messages = data.get("messages") or []
+    first = next((m for m in messages if isinstance(m, dict) and m.get("role") == "user"), None)
+    if first is None:
+        return "anonymous"
+    head = _walk_content(first.get("content"), 256).text
+    return "fp:" + uuid.uuid5(uuid.NAMESPACE_OID, head).hex[:16]
+
+
+# ============================================================
+# 历史压缩 (长对话发往 mini / 小上下文层之前)
+# ============================================================
+# 短于该长度的工具结果不去重 (替换标记本身就有几十个字符)
+_COMPACTION_DEDUPE_MIN_CHARS = 200
+# 超出预算需要丢弃旧轮次时, 一次压到预算的该比例, 后续几轮可以沿用同一个切点
+_COMPACTION_HEADROOM = 0.8
+# 省略说明中最多列出的工具名数量
+_COMPACTION_TOOL_NAMES = 8
+
+
+def _tool_result_text(content: Any) -> Optional[str]:
+    """工具结果的纯文本; 含图片等非文本块时返回 None (不处理)"""
+    if isinstance(content, str):
+        return content
+    if not isinstance(content, list):
+        return None
+    texts = []
+    for part in content:
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, dict) and part.get("type") in _TEXT_PART_TYPES and isinstance(part.get("text"), str):
+            texts.append(part["text"])
+        else:
+            return None
+    return "\n".join(texts)
+
+
+def _is_tool_result_message(message: Dict) -> bool:
+    if message.get("role") in ("tool", "function"):
+        return True
+    content = message.get("content")
+    return isinstance(content, list) and any(
+        isinstance(part, dict) and part.get("type") == "tool_result" for part in content)
+
+
+def _compact_tool_results(messages: List, max_chars: int) -> Tuple[List, int, int]:
+    """
+    工具结果去重 + 截断 (OpenAI role=tool 消息和 Anthropic tool_result 块):
+    - 与之前某个结果完全相同的, 替换为指向首次出现的标记 (保留首次出现, 前缀不变, 不破坏上游 prompt cache)
+    - 超过 max_chars 的保留头尾, 中间替换为截断标记
+    返回 (新消息列表, 去重数, 截断数); 修改过的消息是浅拷贝, 不改动原请求中的对象
+    """
+    seen: Dict[bytes, str] = {}
+    counts = [0, 0]
+
+    def compact(text: str, call_id: Optional[str]) -> Optional[str]:
+        if len(text) >= _COMPACTION_DEDUPE_MIN_CHARS:
+            digest = hashlib.sha1(text.encode("utf-8", "ignore")).digest()
+            if digest in seen:
+                counts[0] += 1
+                first = seen[digest]
+                return (f"[vibe-router: identical to the earlier tool result{f' of {first}' if first else ''}, "
+                        f"omitted]")
+            seen[digest] = call_id or ""
+        if max_chars and len(text) > max_chars:
+            counts[1] += 1
+            head = max_chars * 2 // 3
+            tail = max_chars - head
+            return (f"{text[:head]}\n[vibe-router: {len(text) - max_chars} characters truncated]\n"
+                    f"{text[len(text) - tail:]}")
+        return None
+
+    result = []
+    for message in messages:
+        if not isinstance(message, dict):
+            result.append(message)
+            continue
+        if message.get("role") in ("tool", "function"):
+            text = _tool_result_text(message.get("content"))
+            replacement = compact(text, message.get("tool_call_id")) if text is not None else None
+            result.append(message if replacement is None else {**message, "content": replacement})
+            continue
+        content = message.get("content")
+        if not isinstance(content, list):
+            result.append(message)
+            continue
+        parts, changed = [], False
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "tool_result":
+                text = _tool_result_text(part.get("content"))
+                replacement = compact(text, part.get("tool_use_id")) if text is not None else None
+                if replacement is not None:
+                    part, changed = {**part, "content": replacement}, True
+            parts.append(part)
+        result.append({**message, "content": parts} if changed else message)
+    return result, counts[0], counts[1]
+
+
+def _omitted_notice(dropped: List, tokens: int) -> str:
+    """被丢弃的旧轮次的说明: 条数、估算 token 数和其中调用过的工具"""
+    tools: Dict[str, int] = {}
+    for message in dropped:
+        if not isinstance(message, dict):
+            continue
+        for tool_call in message.get("tool_calls") or []:
+            if isinstance(tool_call, dict):
+                name = str((tool_call.get("function") or {}).get("name") or "")
+                tools[name] = tools.get(name, 0) + 1
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "tool_use":
+                    name = str(part.get("name") or "")
+                    tools[name] = tools.get(name, 0) + 1
+    tools.pop("", None)
+    notice = (f"[vibe-router: {len(dropped)} earlier messages (~{tokens} tokens) were omitted "
+              f"to fit the context window.")
+    if tools:
+        ranked = sorted(tools.items(), key=lambda item: -item[1])[:_COMPACTION_TOOL_NAMES]
+        notice += " Tools used in the omitted part: " + ", ".join(f"{name}×{count}" for name, count in ranked) + "."
+    return notice + "]"
+
+
+def _drop_oldest_turns(messages: List, available: int, keep_recent: int,
+                       previous_cut: Optional[int] = None) -> Tuple[List, int, int]:
+    """
+    保留开头的 system 消息和最近 keep_recent 条消息, 丢弃最旧的轮次直到估算 token 不超过 available。
+    只在 assistant 消息或用户新指令处切分, 不拆开工具调用和它的结果;
+    切点之后以一条说明开头 (并入首条 user 消息, 或在 assistant 消息前插入一条 user 消息)。
+    previous_cut 仍能满足预算时沿用 (同一会话的前缀保持不变)。
+    返回 (新消息列表, 切点 = 丢弃条数 (不含 system), 丢弃的估算 token 数)
+    """
+    pinned = 0
+    while pinned < len(messages) and isinstance(messages[pinned], dict) \
+            and messages[pinned].get("role") in ("system", "developer"):
+        pinned += 1
+    history = messages[pinned:]
+    sizes = [_estimate_message_tokens(m) if isinstance(m, dict) else 0 for m in history]
+    suffix = [0] * (len(history) + 1)
+    for i in range(len(history) - 1, -1, -1):
+        suffix[i] = suffix[i + 1] + sizes[i]
+    if suffix[0] <= available:
+        return messages, 0, 0
+
+    candidates = [i for i in range(1, len(history) - keep_recent + 1)
+                  if isinstance(history[i], dict) and history[i].get("role") in ("user", "assistant")
+                  and not _is_tool_result_message(history[i])]
+    if not candidates:
+        return messages, 0, 0
+    if previous_cut in candidates and suffix[previous_cut] <= available:
+        cut = previous_cut
+    else:
+        target = available * _COMPACTION_HEADROOM
+        cut = next((i for i in candidates if suffix[i] <= target), candidates[-1])
+
+    dropped_tokens = suffix[0] - suffix[cut]
+    notice = _omitted_notice(history[:cut], dropped_tokens)
+    first = history[cut]
+    if first.get("role") == "user":
+        content = first.get("content")
+        if isinstance(content, list):
+            content = [{"type": "text", "text": notice}] + content
+        else:
+            content = f"{notice}\n\n{content or ''}"
+        retained = [{**first, "content": content}] + history[cut + 1:]
+    else:
+        retained = [{"role": "user", "content": notice}] + history[cut:]
+    return messages[:pinned] + retained, cut, dropped_tokens
+
+
+# ============================================================
+# 会话亲和 (让同一对话命中同一后端, 复用上游 prompt cache)
+# ============================================================
+# 指纹中每段内容最多取的字符数
+_FINGERPRINT_SCAN_CHARS = 2048
+
+
+def _conversation_fingerprint(data: Dict, prefix_messages: int) -> Optional[str]:
+    """
+    对话稳定前缀的指纹: system prompt + 前 prefix_messages 条非 system 消息。
+    同一对话后续轮次只在末尾追加消息, 前缀不变, 指纹也不变。
+    """
+    messages = data.get("messages") or []
+    if not messages:
+        return None
+    digest = hashlib.blake2b(digest_size=8)
+    system = data.get("system")
+    if system:
+        digest.update(_walk_content(system, _FINGERPRINT_SCAN_CHARS).text.encode("utf-8", "ignore"))
+    taken = 0
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        role = message.get("role", "")
+        if role != "system":
+            if taken >= prefix_messages:
+                break
+            taken += 1
+        digest.update(role.encode())
+        digest.update(_walk_content(message.get("content"), _FINGERPRINT_SCAN_CHARS).text.encode("utf-8", "ignore"))
+    return digest.hexdigest()
+
+
+class AffinityMap:
+    """对话指纹 -> deployment id 的有界 LRU 映射, 条目带 TTL"""
+
+    # 跨进程合并时 monotonic <-> wall clock 换算的容差 (秒); 重新绑定会把过期时间推后整个 TTL
+    MERGE_TOLERANCE = 1.0
+
+    def __init__(self, ttl_seconds: float = 300.0, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._pins: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        # 被解除的绑定: key -> 被解除条目的过期时间 (monotonic), 防止跨 worker 合并时复活
+        self._unpinned: "OrderedDict[str, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._pins)
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._pins.get(key)
+        if entry is None:
+            return None
+        deployment_id, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._pins[key]
+            return None
+        self._pins.move_to_end(key)
+        return deployment_id
+
+    def peek(self, key: str) -> Optional[str]:
+        """只读查询 (不刷新 LRU 顺序, 不删除过期条目)"""
+        entry = self._pins.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def pin(self, key: str, deployment_id: str):
+        self._pins[key] = (deployment_id, time.monotonic() + self.ttl_seconds)
+        self._pins.move_to_end(key)
+        while len(self._pins) > self.max_entries:
+            self._pins.popitem(last=False)
+
+    def unpin(self, key: str, deployment_id: Optional[str] = None) -> bool:
+        """解除绑定; 指定 deployment_id 时仅在当前绑定的正是它时解除"""
+        entry = self._pins.get(key)
+        if entry is None or (deployment_id is not None and entry[0] != deployment_id):
+            return False
+        del self._pins[key]
+        self._unpinned[key] = entry[1]
+        self._unpinned.move_to_end(key)
+        while len(self._unpinned) > self.max_entries:
+            self._unpinned.popitem(last=False)
+        return True
+
+    def export_state(self, limit: int) -> Dict[str, Dict]:
+        """
+        导出最近使用的 limit 个未过期绑定和解除记录 (时间均为 wall clock):
+            {"pins": {key: [deployment id, 过期时间]}, "unpinned": {key: 被解除条目的过期时间}}
+        """
+        mono, wall = time.monotonic(), time.time()
+        pins: Dict[str, List] = {}
+        for key in reversed(self._pins):
+            if len(pins) >= limit:
+                break
+            deployment_id, expires_at = self._pins[key]
+            if expires_at > mono:
+                pins[key] = [deployment_id, wall + (expires_at - mono)]
+        unpinned: Dict[str, float] = {}
+        for key in reversed(self._unpinned):
+            if len(unpinned) >= limit:
+                break
+            expires_at = self._unpinned[key]
+            if expires_at > mono:
+                unpinned[key] = wall + (expires_at - mono)
+        return {"pins": pins, "unpinned": unpinned}
+
+    def merge_state(self, state: Dict[str, Dict]):
+        """合并其他 worker 的绑定; 同一 key 取过期时间较晚 (即较新) 的一方, 已解除的绑定不会复活"""
+        mono, wall = time.monotonic(), time.time()
+        for key, expires_wall in (state.get("unpinned") or {}).items():
+            expires_at = mono + (expires_wall - wall)
+            entry = self._pins.get(key)
+            if entry is not None and entry[1] <= expires_at + self.MERGE_TOLERANCE:
+                del self._pins[key]
+            if expires_at > self._unpinned.get(key, 0.0):
+                self._unpinned[key] = expires_at
+        for key, (deployment_id, expires_wall) in (state.get("pins") or {}).items():
+            expires_at = mono + (expires_wall - wall)
+            entry = self._pins.get(key)
+            if expires_at <= mono or expires_at <= self._unpinned.get(key, 0.0) + self.MERGE_TOLERANCE:
+                continue
+            if entry is None or expires_at > entry[1]:
+                self._pins[key] = (deployment_id, expires_at)
+        while len(self._pins) > self.max_entries:
+            self._pins.popitem(last=False)
+        while len(self._unpinned) > self.max_entries:
+            self._unpinned.popitem(last=False)
+
+
+# ============================================================
+# 路由统计 (EWMA 延迟, 按模型组和 deployment)
+# ============================================================
+class RoutingStats:
+    """
+    按模型组和 deployment 维护路由统计:
+    - 延迟 / TTFT / 花费的指数加权移动平均
+    - 健康分 (0.0 ~ 1.0): 成功拉向 1, 失败/卡顿拉向 0, 无新样本时按半衰期恢复到 1
+    """
+
+    def __init__(self, alpha: float = 0.2, health_half_life: float = 60.0):
+        self.alpha = alpha
+        self.health_half_life = health_half_life
+        self.group_latency: Dict[str, float] = {}
+        self.group_cost: Dict[str, float] = {}
+        self.deployment_latency: Dict[str, float] = {}
+        self.deployment_ttft: Dict[str, float] = {}
+        # deployment id -> 输出吞吐 (tokens/s, 不含首 token 等待)
+        self.deployment_throughput: Dict[str, float] = {}
+        self.samples: Dict[str, int] = {}
+        # deployment id -> (健康分, 更新时间 monotonic); 本 worker 与其他 worker 观测合并后的结果
+        self.health: Dict[str, Tuple[float, float]] = {}
+        # 本 worker 自己观测到的健康分 (只发布这部分, 避免其他 worker 的失败被重复累加)
+        self.own_health: Dict[str, Tuple[float, float]] = {}
+        # worker id -> {deployment id -> (健康分, 更新时间 monotonic)}
+        self.peer_health: Dict[str, Dict[str, Tuple[float, float]]] = {}
+        # deployment id -> 限流解除时间 (monotonic)
+        self.rate_limited: Dict[str, float] = {}
+        # (表名, key) -> 最近一次更新的 wall clock 时间, 用于跨 worker 合并时取最新值
+        self.updated: Dict[Tuple[str, str], float] = {}
+        # (表名, key) -> 从快照恢复的旧值的剩余权重 (0~1); 第一个新样本按 1 - 权重 覆盖旧值
+        self.prior_weight: Dict[Tuple[str, str], float] = {}
+        # deployment 级统计变化时的回调 (参数为 deployment id), 用于增量维护排名
+        self.listeners: List[Callable[[str], None]] = []
+
+    def _changed(self, deployment_id: str):
+        for listener in self.listeners:
+            listener(deployment_id)
+
+    # 参与跨 worker 共享的 EWMA 表
+    SHARED_TABLES = ("group_latency", "group_cost", "deployment_latency", "deployment_ttft", "deployment_throughput")
+
+    def _ewma(self, table: Dict[str, float], key: str, value: float):
+        previous = table.get(key)
+        for name in self.SHARED_TABLES:
+            if getattr(self, name) is table:
+                break
+        alpha = self.alpha
+        prior = self.prior_weight.pop((name, key), None)
+        if prior is not None:
+            alpha = max(alpha, 1.0 - prior)
+        table[key] = value if previous is None else previous + alpha * (value - previous)
+        self.updated[(name, key)] = time.time()
+
+    def observe_latency(self, group: Optional[str], deployment_id: Optional[str], seconds: float):
+        if group:
+            self._ewma(self.group_latency, group, seconds)
+        if deployment_id:
+            self._ewma(self.deployment_latency, deployment_id, seconds)
+            self.samples[deployment_id] = self.samples.get(deployment_id, 0) + 1
+            self._changed(deployment_id)
+
+    def observe_cost(self, group: Optional[str], cost: float):
+        if group:
+            self._ewma(self.group_cost, group, cost)
+
+    def observe_ttft(self, deployment_id: Optional[str], seconds: float):
+        if deployment_id:
+            self._ewma(self.deployment_ttft, deployment_id, seconds)
+            self._changed(deployment_id)
+
+    def observe_throughput(self, deployment_id: Optional[str], output_tokens: int, generation_seconds: float):
+        if deployment_id and output_tokens > 0 and generation_seconds > 0:
+            self._ewma(self.deployment_throughput, deployment_id, output_tokens / generation_seconds)
+            self._changed(deployment_id)
+
+    def predict_seconds(self, deployment_id: str, output_tokens: int) -> Optional[float]:
+        """预计完成时间 = TTFT + 输出 token / 吞吐; 没有吞吐样本时退回平均总延迟, 都没有时返回 None"""
+        throughput = self.deployment_throughput.get(deployment_id)
+        if throughput:
+            return self.deployment_ttft.get(deployment_id, 0.0) + output_tokens / throughput
+        return self.deployment_latency.get(deployment_id)
+
+    def health_score(self, deployment_id: str, now: Optional[float] = None) -> float:
+        entry = self.health.get(deployment_id)
+        if entry is None:
+            return 1.0
+        score, updated = entry
+        now = time.monotonic() if now is None else now
+        decay = 0.5 ** (max(0.0, now - updated) / self.health_half_life)
+        return 1.0 - (1.0 - score) * decay
+
+    def _decayed_deficit(self, entry: Optional[Tuple[float, float]], now: float) -> float:
+        """健康分的缺口 1 - score 按半衰期衰减到 now 时刻的值"""
+        if entry is None:
+            return 0.0
+        score, updated = entry
+        return (1.0 - score) * 0.5 ** (max(0.0, now - updated) / self.health_half_life)
+
+    def _combine_health(self, deployment_id: str, now: Optional[float] = None):
+        """
+        合并本 worker 与各 peer 的健康分: 缺口相加 (相当于失败次数求和), 上限为 1。
+        各缺口按同一半衰期衰减, 折算到 now 后的和仍按该半衰期衰减, 所以合并结果仍是一个 (分数, 时间) 条目
+        """
+        now = time.monotonic() if now is None else now
+        deficit = self._decayed_deficit(self.own_health.get(deployment_id), now)
+        for peer in self.peer_health.values():
+            deficit += self._decayed_deficit(peer.get(deployment_id), now)
+        if deficit <= 0.0 and deployment_id not in self.own_health:
+            self.health.pop(deployment_id, None)
+        else:
+            self.health[deployment_id] = (1.0 - min(1.0, deficit), now)
+
+    def record_outcome(self, deployment_id: Optional[str], ok: bool, weight: int = 1):
+        """记录一次结果; weight > 1 表示更严重的失败 (例如流卡顿)"""
+        if not deployment_id:
+            return
+        now = time.monotonic()
+        entry = self.own_health.get(deployment_id)
+        score = 1.0 - self._decayed_deficit(entry, now)
+        target = 1.0 if ok else 0.0
+        for _ in range(weight):
+            score += self.alpha * (target - score)
+        self.own_health[deployment_id] = (score, now)
+        self._combine_health(deployment_id, now)
+        self._changed(deployment_id)
+
+    def mark_rate_limited(self, deployment_id: Optional[str], seconds: float):
+        """记录上游 429: seconds 秒内该 deployment 不参与选择"""
+        if deployment_id and seconds > 0:
+            until = time.monotonic() + seconds
+            self.rate_limited[deployment_id] = max(until, self.rate_limited.get(deployment_id, 0.0))
+
+    def is_rate_limited(self, deployment_id: str, now: Optional[float] = None) -> bool:
+        until = self.rate_limited.get(deployment_id)
+        if until is None:
+            return False
+        if until <= (time.monotonic() if now is None else now):
+            del self.rate_limited[deployment_id]
+            return False
+        return True
+
+    def export_state(self) -> Dict[str, Any]:
+        """
+        导出可跨进程共享的状态; monotonic 时间转换为 wall clock:
+            {"tables": {表名: {key: [值, 更新时间]}}, "health": {id: [分数, 更新时间]}, "rate_limited": {id: 解除时间}}
+        """
+        mono, wall = time.monotonic(), time.time()
+        tables = {}
+        for name in self.SHARED_TABLES:
+            tables[name] = {key: [value, self.updated.get((name, key), 0.0)]
+                            for key, value in getattr(self, name).items()}
+        return {
+            "tables": tables,
+            "health": {key: [score, wall - (mono - updated)] for key, (score, updated) in self.own_health.items()},
+            "rate_limited": {key: wall + (until - mono) for key, until in self.rate_limited.items() if until > mono},
+        }
+
+    def restore_state(self, state: Dict[str, Any], age_seconds: float, half_life: float) -> int:
+        """
+        从重启前的快照恢复; 旧 EWMA 值按快照年龄衰减权重 0.5 ** (age / half_life),
+        越旧的值越快被新样本覆盖。健康分与限流表按原时间戳恢复, 自然衰减 / 过期。
+        返回恢复的条目数。
+        """
+        self.merge_state(state)
+        weight = 0.5 ** (max(0.0, age_seconds) / half_life) if half_life > 0 else 0.0
+        restored = 0
+        for name, entries in (state.get("tables") or {}).items():
+            if name in self.SHARED_TABLES:
+                for key in entries:
+                    self.prior_weight[(name, key)] = weight
+                    restored += 1
+        return restored + len(state.get("health") or {}) + len(state.get("rate_limited") or {})
+
+    def merge_state(self, state: Dict[str, Any], source: Optional[str] = None):
+        """
+        合并导出的状态: EWMA 表每个 key 取更新时间较新的一方, 限流取较晚的解除时间。
+        健康分: source 为其他 worker 的 id 时整体替换该 worker 的观测, 再与本地观测累加;
+        source 为 None (从本进程重启前的快照恢复) 时按更新时间合并进本地观测
+        """
+        mono, wall = time.monotonic(), time.time()
+        changed = set()
+        for name, entries in (state.get("tables") or {}).items():
+            if name not in self.SHARED_TABLES:
+                continue
+            table = getattr(self, name)
+            for key, (value, updated) in entries.items():
+                if updated > self.updated.get((name, key), 0.0):
+                    table[key] = value
+                    self.updated[(name, key)] = updated
+                    if name.startswith("deployment_"):
+                        changed.add(key)
+        health = {key: (score, mono - (wall - updated)) for key, (score, updated) in (state.get("health") or {}).items()}
+        if source is not None:
+            previous = self.peer_health.get(source) or {}
+            self.peer_health[source] = health
+            changed.update(previous, health)
+        else:
+            for key, entry in health.items():
+                if key not in self.own_health or entry[1] > self.own_health[key][1]:
+                    self.own_health[key] = entry
+                    changed.add(key)
+        for key in changed:
+            self._combine_health(key, mono)
+        for key, until in (state.get("rate_limited") or {}).items():
+            local_until = mono + (until - wall)
+            if local_until > self.rate_limited.get(key, 0.0):
+                self.rate_limited[key] = local_until
+        for key in changed:
+            self._changed(key)
+
+    def retain_peers(self, workers: set):
+        """丢弃已不再发布状态的 worker 的健康观测"""
+        for worker in [w for w in self.peer_health if w not in workers]:
+            for key in self.peer_health.pop(worker):
+                self._combine_health(key)
+                self._changed(key)
+
+
+def _kwargs_deployment_id(kwargs: Dict) -> Optional[str]:
+    """从日志回调 kwargs 中取出实际服务的 deployment id"""
+    litellm_params = kwargs.get("litellm_params") or {}
+    model_info = litellm_params.get("model_info") or kwargs.get("model_info") or {}
+    model_id = model_info.get("id") or _get_metadata(kwargs).get("model_info", {}).get("id")
+    return str(model_id) if model_id else None
+
+
+def _deployment_prices(model_info: Optional[Dict], litellm_params: Optional[Dict] = None) -> Optional[Tuple[float, float]]:
+    """(输入单价, 输出单价) USD/token; 未配置价格返回 None"""
+    for source in (model_info or {}, litellm_params or {}):
+        if "input_cost_per_token" in source or "output_cost_per_token" in source:
+            try:
+                return (float(source.get("input_cost_per_token") or 0.0),
+                        float(source.get("output_cost_per_token") or 0.0))
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def _estimate_deployment_cost(deployment: Dict, input_tokens: int, output_tokens: int) -> Optional[float]:
+    prices = _deployment_prices(_deployment_info(deployment), deployment.get("litellm_params"))
+    if prices is None:
+        return None
+    return input_tokens * prices[0] + output_tokens * prices[1]
+
+
+def _retry_after(exception: Any, default: float) -> float:
+    """从上游 429 的 Retry-After 头读取等待秒数, 没有时返回 default"""
+    response = getattr(exception, "response", None)
+    headers = getattr(exception, "headers", None) or getattr(response, "headers", None) or {}
+    try:
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        return float(value) if value else default
+    except (AttributeError, TypeError, ValueError):
+        return default
+
+
+# ============================================================
+# 延迟分级 (interactive / standard / batch)
+# ============================================================
+LATENCY_INTERACTIVE = "interactive"
+LATENCY_STANDARD = "standard"
+LATENCY_BATCH = "batch"
+LATENCY_CLASSES = (LATENCY_INTERACTIVE, LATENCY_STANDARD, LATENCY_BATCH)
+
+
+def _latency_request(data: Dict, user_api_key_dict: Any, interactive_ms: float) -> Tuple[str, Optional[float]]:
+    """
+    读取请求声明的延迟等级和预算 (毫秒), 优先级: 请求头 > 请求 metadata > key metadata。
+    只给预算时, 预算不超过 interactive_ms 视为 interactive; 只给等级 interactive 时预算取 interactive_ms。
+    """
+    headers = (data.get("proxy_server_request") or {}).get("headers") or {}
+    sources = [
+        (headers.get("x-vibe-latency-class"), headers.get("x-vibe-latency-ms")),
+        ((data.get("metadata") or {}).get("vibe_latency_class"), (data.get("metadata") or {}).get("vibe_latency_ms")),
+        ((getattr(user_api_key_dict, "metadata", None) or {}).get("vibe_latency_class"),
+         (getattr(user_api_key_dict, "metadata", None) or {}).get("vibe_latency_ms")),
+    ]
+    for latency_class, budget in sources:
+        if latency_class is None and budget is None:
+            continue
+        try:
+            budget_ms = float(budget) if budget is not None else None
+        except (TypeError, ValueError):
+            budget_ms = None
+        latency_class = str(latency_class).lower() if latency_class else None
+        if latency_class not in LATENCY_CLASSES:
+            latency_class = LATENCY_INTERACTIVE if budget_ms is not None and budget_ms <= interactive_ms else LATENCY_STANDARD
+        if budget_ms is None and latency_class == LATENCY_INTERACTIVE:
+            budget_ms = interactive_ms
+        return latency_class, budget_ms
+    return LATENCY_STANDARD, None
+
+
+def _http_error(status_code: int, message: str) -> Exception:
+    """构造 pre-call hook 中用于拒绝请求的 HTTP 异常 (proxy 会原样返回给客户端)"""
+    try:
+        from fastapi import HTTPException
+        return HTTPException(status_code=status_code, detail=message)
+    except ImportError:
+        error = Exception(message)
+        error.status_code = status_code
+        return error
+
+
+def _get_llm_router() -> Optional[Any]:
+    """proxy 启动后创建的 LiteLLM Router 实例 (加载插件时尚未创建, 需要运行时读取)"""
+    try:
+        from litellm.proxy import proxy_server
+        return getattr(proxy_server, "llm_router", None)
+    except ImportError:
+        return None
+
+
+# ============================================================
+# 编译后的路由表 (model_list → 每个模型组的有序候选链 + 通配符前缀树)
+# ============================================================
+class RouteEntry:
+    """候选链中的一个 deployment 及其预先计算好的属性"""
+
+    __slots__ = ("deployment", "id", "layer", "context_limit", "prices", "capacity")
+
+    def __init__(self, deployment: Dict):
+        self.deployment = deployment
+        self.id = _deployment_id(deployment)
+        self.layer = _deployment_info(deployment).get("fallback_order", 1)
+        self.context_limit = _deployment_context_limit(deployment)
+        self.prices = _deployment_prices(_deployment_info(deployment), deployment.get("litellm_params"))
+        self.capacity = _deployment_capacity(deployment)
+
+
+class RoutingTable:
+    """
+    启动时 (及 model_list 变化时) 从 LiteLLM router 的 model_list 编译出的只读路由表:
+    - groups: 模型组 → 按 fallback_order 排序的 deployment 元组, 请求路径 O(1) 查找
+    - 通配符模型组 (claude-* / anthropic/* / *) 按 * 之前的字面前缀建前缀树,
+      查找只沿模型名走一遍, 最长 (最具体) 的模式优先
+    - errors: 不一致的候选链 (同一层重复的上游、引用了未设置的环境变量)
+    - strict 时在构建时拒绝出问题的 deployment: 不进入路由表, 记录在 rejected_ids 中, 选择时排除;
+      其余层照常使用。整个模型组都被拒绝时记录在 rejected 中, 请求直接返回 503
+    重建时构造新对象后整体替换引用, 读者不会看到构建到一半的表。
+    """
+
+    def __init__(self, model_list: List[Dict], strict: bool = False):
+        groups: Dict[str, List[RouteEntry]] = {}
+        for deployment in model_list:
+            name = deployment.get("model_name")
+            if name:
+                groups.setdefault(str(name), []).append(RouteEntry(deployment))
+        self.entries: Dict[str, Tuple[RouteEntry, ...]] = {
+            name: tuple(sorted(items, key=lambda e: e.layer)) for name, items in groups.items()
+        }
+        problems = self._validate()
+        self.errors: Dict[str, List[str]] = {}
+        for name, _, problem in problems:
+            self.errors.setdefault(name, []).append(problem)
+        # deployment id -> 拒绝原因; 模型组 -> 问题列表 (组内没有剩下任何 deployment)
+        self.rejected_ids: Dict[str, str] = {}
+        self.rejected: Dict[str, List[str]] = {}
+        if strict:
+            for _, deployment_id, problem in problems:
+                self.rejected_ids.setdefault(deployment_id, problem)
+            for name in list(self.entries):
+                kept = tuple(e for e in self.entries[name] if e.id not in self.rejected_ids)
+                if not kept:
+                    self.rejected[name] = self.errors[name]
+                    del self.entries[name]
+                else:
+                    self.entries[name] = kept
+        self.groups: Dict[str, Tuple[Dict, ...]] = {
+            name: tuple(e.deployment for e in items) for name, items in self.entries.items()
+        }
+        self.by_id: Dict[str, Dict] = {e.id: e.deployment for items in self.entries.values() for e in items}
+        self._trie: Dict[str, Any] = {}
+        for pattern in self.groups:
+            if "*" in pattern:
+                node = self._trie
+                for char in pattern[:pattern.index("*")]:
+                    node = node.setdefault(char, {})
+                node.setdefault("", []).append(pattern)
+
+    def _validate(self) -> List[Tuple[str, str, str]]:
+        """返回 (模型组, deployment id, 问题) 列表"""
+        problems: List[Tuple[str, str, str]] = []
+        for name, items in self.entries.items():
+            # 同一层有多个不同上游是负载均衡池; 同一层重复出现同一个上游 (model + api_base) 才是配置错误,
+            # 第一次出现的保留, 之后重复的算作问题
+            seen = set()
+            for e in items:
+                params = e.deployment.get("litellm_params") or {}
+                key = (e.layer, params.get("model"), params.get("api_base"))
+                if key in seen:
+                    problems.append((name, e.id, f"duplicate deployment {params.get('model')} "
+                                                 f"at fallback_order {e.layer}"))
+                seen.add(key)
+            for e in items:
+                params = e.deployment.get("litellm_params") or {}
+                for key, value in params.items():
+                    if isinstance(value, str) and value.startswith("os.environ/") \
+                            and not os.environ.get(value[len("os.environ/"):]):
+                        problems.append((name, e.id, f"L{e.layer} {key}: {value} is not set"))
+        return problems
+
+    def group(self, model_group: str) -> Tuple[Dict, ...]:
+        return self.groups.get(model_group, ())
+
+    def match_wildcard(self, model: str) -> Optional[str]:
+        """找到透传请求命中的通配符模型组 (claude-* / anthropic/* / *)"""
+        candidates = list(self._trie.get("", ()))
+        node = self._trie
+        for char in model:
+            node = node.get(char)
+            if node is None:
+                break
+            candidates.extend(node.get("", ()))
+        for pattern in sorted(candidates, key=len, reverse=True):
+            if fnmatch.fnmatchcase(model, pattern):
+                return pattern
+        return None
+
+
+# 当前路由表及其来源 model_list 的内容摘要; 内容变化时重建
+_ROUTING_TABLE: Optional[RoutingTable] = None
+_ROUTING_TABLE_DIGEST: Optional[str] = None
+# 上次检查的 model_list (对象 id, 长度) 与检查时间: 两者变化时立即重新计算摘要,
+# 其他变化 (upsert 保持长度不变的原地更新) 最多延迟 _ROUTING_TABLE_CHECK_INTERVAL 秒发现
+_ROUTING_TABLE_CHECKED: Tuple[Optional[Tuple[int, int]], float] = (None, 0.0)
+_ROUTING_TABLE_CHECK_INTERVAL = 1.0
+
+
+def _model_list_digest(model_list: List[Dict]) -> str:
+    payload = json.dumps(model_list, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def _routing_table() -> Optional[RoutingTable]:
+    """返回与运行中 LiteLLM router 的 model_list 内容一致的路由表 (替换 / 增删 / upsert 后自动重建)"""
+    global _ROUTING_TABLE, _ROUTING_TABLE_DIGEST, _ROUTING_TABLE_CHECKED
+    router = _get_llm_router()
+    model_list = getattr(router, "model_list", None) if router is not None else None
+    if model_list is None:
+        return _ROUTING_TABLE
+    source, now = (id(model_list), len(model_list)), time.monotonic()
+    checked_source, checked_at = _ROUTING_TABLE_CHECKED
+    if source == checked_source and now - checked_at < _ROUTING_TABLE_CHECK_INTERVAL:
+        return _ROUTING_TABLE
+    _ROUTING_TABLE_CHECKED = (source, now)
+    try:
+        digest = _model_list_digest(list(model_list))
+        if digest == _ROUTING_TABLE_DIGEST:
+            return _ROUTING_TABLE
+        table = RoutingTable(list(model_list), strict=_env_bool("VIBE_ROUTING_TABLE_STRICT", True))
+    except Exception as e:
+        _log(f"Failed to compile routing table: {e}", "ERROR")
+        return _ROUTING_TABLE
+    for group, problems in table.errors.items():
+        action = "rejected" if group in table.rejected else "dropped" if table.rejected_ids else "kept"
+        for problem in problems:
+            _log(f"Routing table: {group} ({action}): {problem}", "ERROR")
+    _ROUTING_TABLE, _ROUTING_TABLE_DIGEST = table, digest
+    _log(f"Routing table compiled: {len(table.groups)} model groups, {len(table.by_id)} deployments, "
+         f"{len(table.rejected_ids)} deployments / {len(table.rejected)} groups rejected")
+    return _ROUTING_TABLE
+
+
+def _group_deployments(model_group: str) -> Tuple[Dict, ...]:
+    """模型组的 deployment 列表 (按 fallback_order 排序)"""
+    table = _routing_table()
+    return table.group(model_group) if table is not None else ()
+
+
+class CandidateRanking:
+    """
+    每个模型组的候选 deployment 排名, 只在某个 deployment 的统计 / 健康分变化时增量更新:
+    - 排名键 = (fallback_order, 默认输出长度下的预计完成秒数); 没有统计的 deployment 为 0, 同层内优先探索
+    - 每个组是按键有序的 [(键, id)] 列表, 变化时用 bisect 删除旧键、插入新键, 不整体重排
+    - 健康分低于阈值的 deployment 记录其按半衰期恢复到阈值的时间, 过滤时比较一次时间即可
+    请求路径只按组的有序列表挑出候选, 不排序; 事件循环单线程读写, 不需要锁。
+    """
+
+    def __init__(self, stats: RoutingStats, min_health: float, output_tokens: int, top_k: int = 0):
+        self.stats = stats
+        self.min_health = min_health
+        self.output_tokens = output_tokens
+        self.top_k = top_k
+        self.table: Optional[RoutingTable] = None
+        self._key: Dict[str, Tuple[int, float]] = {}
+        self._recover_at: Dict[str, float] = {}
+        self._ranked: Dict[str, List[Tuple[Tuple[int, float], str]]] = {}
+        self._groups_of: Dict[str, List[str]] = {}
+        stats.listeners.append(self.update)
+
+    def _score(self, deployment_id: str, layer: int) -> Tuple[int, float]:
+        predicted = self.stats.predict_seconds(deployment_id, self.output_tokens)
+        self._recover_at.pop(deployment_id, None)
+        entry = self.stats.health.get(deployment_id)
+        if entry is not None and 0 < self.min_health < 1.0 and entry[0] < self.min_health:
+            score, updated = entry
+            # 1 - (1 - score) * 0.5 ** (t / half_life) >= min_health 的最早时刻
+            self._recover_at[deployment_id] = updated + self.stats.health_half_life * math.log2(
+                (1.0 - score) / (1.0 - self.min_health))
+        return layer, predicted or 0.0
+
+    def rebuild(self, table: RoutingTable):
+        """路由表变化时重建全部排名"""
+        self._key, self._ranked, self._groups_of = {}, {}, {}
+        for group, entries in table.entries.items():
+            for e in entries:
+                if e.id not in self._key:
+                    self._key[e.id] = self._score(e.id, e.layer)
+                self._groups_of.setdefault(e.id, []).append(group)
+            self._ranked[group] = sorted((self._key[e.id], e.id) for e in entries)
+        self.table = table
+
+    def update(self, deployment_id: str):
+        """某个 deployment 的统计变化: 重算它的键, 在它所在的组中移动这一项 (O(log n) 查找)"""
+        groups = self._groups_of.get(deployment_id)
+        if not groups:
+            return
+        old = self._key[deployment_id]
+        new = self._score(deployment_id, old[0])
+        if new == old:
+            return
+        self._key[deployment_id] = new
+        for group in groups:
+            ranked = self._ranked[group]
+            index = bisect.bisect_left(ranked, (old, deployment_id))
+            if index < len(ranked) and ranked[index][1] == deployment_id:
+                del ranked[index]
+            bisect.insort(ranked, (new, deployment_id))
+
+    def is_healthy(self, deployment_id: str, now: float) -> bool:
+        if deployment_id in self._groups_of:
+            return self._recover_at.get(deployment_id, 0.0) <= now
+        # 不在路由表中的 deployment (model_list 刚变化) 直接计算健康分
+        return self.stats.health_score(deployment_id, now) >= self.min_health
+
+    def order(self, deployments: List) -> List:
+        """
+        按当前排名 (最优在前) 排列候选, 不在排名中的保持在末尾; top_k > 0 时只保留前 top_k 个。
+        router 的 simple-shuffle 在返回的候选中随机选择、不看顺序, 所以排名只有截断到 top_k 时才影响路由。
+        """
+        if len(deployments) <= 1:
+            return deployments
+        ranked = self._ranked.get(str(deployments[0].get("model_name")))
+        if not ranked:
+            return deployments
+        by_id = {_deployment_id(d): d for d in deployments}
+        ordered = [by_id.pop(deployment_id) for _, deployment_id in ranked if deployment_id in by_id]
+        ordered.extend(by_id.values())
+        return ordered[:self.top_k] if self.top_k > 0 else ordered
+
+
+def _response_deployment_id(response: Any) -> Optional[str]:
+    """从 LiteLLM 响应 (含流式 CustomStreamWrapper) 的 _hidden_params 中取出 deployment id"""
+    hidden = getattr(response, "_hidden_params", None) or {}
+    model_id = hidden.get("model_id") or (hidden.get("model_info") or {}).get("id")
+    return str(model_id) if model_id else None
+
+
+def _find_deployment(model_id: Optional[str], model_group: Optional[str] = None) -> Optional[Dict]:
+    if not model_id:
+        return None
+    table = _routing_table()
+    deployment = table.by_id.get(str(model_id)) if table is not None else None
+    if deployment is None or (model_group and deployment.get("model_name") != model_group):
+        return None
+    return deployment
+
+
+async def _get_cooldown_ids(router: Any) -> Optional[set]:
+    """读取 router 当前处于 cooldown 的 deployment id (兼容不同 LiteLLM 版本, 失败返回 None)"""
+    if router is None:
+        return None
+    try:
+        from litellm.router_utils.cooldown_handlers import _async_get_cooldown_deployments
+        return set(await _async_get_cooldown_deployments(litellm_router_instance=router, parent_otel_span=None))
+    except Exception:
+        pass
+    getter = getattr(router, "_async_get_cooldown_deployments", None)
+    if getter is not None:
+        try:
+            return set(await getter())
+        except Exception:
+            return None
+    return None
+
+
+# ============================================================
+# Cascade 模式 (先试 mini 模型, 低置信度时升级到完整链路)
+# ============================================================
+# 拒答 / 不确定标记 (只在回答前 _CASCADE_SCAN_CHARS 个字符中查找)
+_UNCERTAINTY_MARKERS = (
+    "i'm not sure", "i am not sure", "i don't know", "i do not know", "i cannot", "i can't",
+    "i'm unable", "i am unable", "as an ai", "not certain", "unclear",
+    "我不确定", "不确定", "我不知道", "无法回答", "无法确定", "抱歉",
+)
+_CASCADE_SCAN_CHARS = 400
+# 发给 mini 模型时需要保留的请求参数
+_CASCADE_PASSTHROUGH_PARAMS = ("temperature", "top_p", "stop", "tools", "tool_choice",
+                               "response_format", "seed", "user")
+# 流卡顿后重新发起请求时保留的参数
+_REISSUE_PARAMS = _CASCADE_PASSTHROUGH_PARAMS + ("max_tokens", "max_completion_tokens", "stream_options")
+
+
+def _cascade_verdict(response: Any, min_chars: int, min_avg_logprob: Optional[float]) -> Tuple[bool, str, str]:
+    """
+    廉价的接受检查: finish_reason / 长度 / 工具调用 / 拒答标记 / 可选平均 logprob
+    返回 (是否接受, 原因, 回答文本)
+    """
+    choices = getattr(response, "choices", None) or []
+    if not choices:
+        return False, "no_choices", ""
+    choice = choices[0]
+    message = getattr(choice, "message", None)
+    content = getattr(message, "content", None) or ""
+    if getattr(message, "tool_calls", None):
+        return False, "tool_calls", content
+    if getattr(choice, "finish_reason", None) != "stop":
+        return False, f"finish_{getattr(choice, 'finish_reason', None)}", content
+    if len(content.strip()) < min_chars:
+        return False, "too_short", content
+    head = content[:_CASCADE_SCAN_CHARS].lower()
+    if any(marker in head for marker in _UNCERTAINTY_MARKERS):
+        return False, "uncertain", content
+    if min_avg_logprob is not None:
+        token_logprobs = getattr(getattr(choice, "logprobs", None), "content", None) or []
+        values = [getattr(t, "logprob", None) for t in token_logprobs]
+        values = [v for v in values if v is not None]
+        if values and sum(values) / len(values) < min_avg_logprob:
+            return False, "low_logprob", content
+    return True, "accepted", content
+
+
+# ============================================================
+# 预算跟踪 (按 API key / team, 存储在 DualCache)
+# ============================================================
+class BudgetTracker:
+    """
+    按周期 (daily / monthly) 累计 key 和 team 的花费。
+
+    花费写入 proxy 的 DualCache (内存 + 可选 Redis), 多个 worker 共享;
+    预算上限优先取 key/team metadata 中的 vibe_budget_usd, 其次取环境变量默认值 (0 = 不限)。
+    """
+
+    def __init__(self, period: str = "daily", default_key_budget: float = 0.0,
+                 default_team_budget: float = 0.0):
+        self.period = period if period in ("daily", "monthly") else "daily"
+        self.default_key_budget = default_key_budget
+        self.default_team_budget = default_team_budget
+        self.cache = None  # 第一次进入 pre-call hook 时绑定 proxy 的 DualCache
+
+    def _period_tag(self) -> str:
+        return time.strftime("%Y%m%d" if self.period == "daily" else "%Y%m")
+
+    def _ttl(self) -> int:
+        return 2 * 86400 if self.period == "daily" else 62 * 86400
+
+    def spend_key(self, scope: str, identifier: str) -> str:
+        return f"vibe:spend:{scope}:{identifier}:{self._period_tag()}"
+
+    @staticmethod
+    def _limit_from(metadata: Optional[Dict], default: float) -> float:
+        try:
+            return float((metadata or {}).get("vibe_budget_usd", default) or 0.0)
+        except (TypeError, ValueError):
+            return default
+
+    def limits(self, user_api_key_dict: Any) -> Dict[str, Tuple[str, float]]:
+        """scope -> (标识, 上限 USD); 上限为 0 的 scope 不参与预算"""
+        result = {}
+        key_id = getattr(user_api_key_dict, "api_key", None) or getattr(user_api_key_dict, "token", None)
+        if key_id:
+            limit = self._limit_from(getattr(user_api_key_dict, "metadata", None), self.default_key_budget)
+            if limit > 0:
+                result["key"] = (str(key_id), limit)
+        team_id = getattr(user_api_key_dict, "team_id", None)
+        if team_id:
+            limit = self._limit_from(getattr(user_api_key_dict, "team_metadata", None), self.default_team_budget)
+            if limit > 0:
+                result["team"] = (str(team_id), limit)
+        return result
+
+    async def spend(self, scope: str, identifier: str) -> float:
+        if self.cache is None:
+            return 0.0
+        value = await self.cache.async_get_cache(key=self.spend_key(scope, identifier))
+        try:
+            return float(value or 0.0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    async def remaining(self, user_api_key_dict: Any) -> Dict[str, Dict[str, float]]:
+        report = {}
+        for scope, (identifier, limit) in self.limits(user_api_key_dict).items():
+            spent = await self.spend(scope, identifier)
+            report[scope] = {"limit_usd": limit, "spent_usd": spent, "remaining_usd": limit - spent}
+        return report
+
+    async def record(self, scope: str, identifier: str, cost: float):
+        if self.cache is None or cost <= 0:
+            return
+        await self.cache.async_increment_cache(key=self.spend_key(scope, identifier), value=cost, ttl=self._ttl())
+
+
+# ============================================================
+# 指标 (Prometheus 文本格式, 通过 /vibe/metrics 暴露)
+# ============================================================
+class VibeMetrics:
+    """
+    轻量级进程内指标注册表:
+    - counter: 单调递增计数
+    - gauge: 当前值 (可由 collector 在渲染时计算)
+    - summary: 有界样本池, 输出 count/sum 和分位数
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, reservoir_size: int = 512):
+        self.reservoir_size = reservoir_size
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._gauges: Dict[Tuple[str, Tuple], float] = {}
+        self._summaries: Dict[Tuple[str, Tuple], Dict[str, Any]] = {}
+        self._collectors: List[Callable[["VibeMetrics"], None]] = []
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = self._key(name, labels)
+        self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self._gauges[self._key(name, labels)] = float(value)
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        summary = self._summaries.get(key)
+        if summary is None:
+            summary = {"count": 0, "sum": 0.0, "samples": deque(maxlen=self.reservoir_size)}
+            self._summaries[key] = summary
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["samples"].append(value)
+
+    def counter(self, name: str, **labels) -> float:
+        return self._counters.get(self._key(name, labels), 0.0)
+
+    def register_collector(self, collector: Callable[["VibeMetrics"], None]):
+        """注册渲染前回调, 用于按需计算 gauge (避免在热路径上更新)"""
+        self._collectors.append(collector)
+
+    def quantile(self, name: str, q: float, **labels) -> Optional[float]:
+        summary = self._summaries.get(self._key(name, labels))
+        if not summary or not summary["samples"]:
+            return None
+        ordered = sorted(summary["samples"])
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @staticmethod
+    def _format_labels(labels: Tuple, extra: Tuple = ()) -> str:
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        body = ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs
+        )
+        return "{" + body + "}"
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                _log(f"Metrics collector failed: {e}", "ERROR")
+
+        lines = []
+        for (name, labels), value in sorted(self._counters.items()):
+            lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+        for (name, labels), value in sorted(self._gauges.items()):
+            lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+        for (name, labels), summary in sorted(self._summaries.items(), key=lambda item: item[0]):
+            ordered = sorted(summary["samples"])
+            for q in self.QUANTILES:
+                if ordered:
+                    value = ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+                    lines.append(f"{name}{self._format_labels(labels, (('quantile', q),))} {value:g}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {summary['count']}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {summary['sum']:g}")
+        return "\n".join(lines) + "\n"
+
+
+# ============================================================
+# 重试预算 (防止上游过载时的重试风暴)
+# ============================================================
+class RetryBudget:
+    """
+    基于滑动窗口的重试令牌桶:
+        可用令牌 = ratio × 首次请求数 + min_retries − 已用重试数
+
+    同时按虚拟模型和全局 (GLOBAL_SCOPE) 统计, 两者都有令牌时才允许重试。
+    窗口切分为若干个桶, 过期的桶在访问时惰性清零, 热路径只做 O(桶数) 的整数运算。
+    """
+
+    GLOBAL_SCOPE = "__global__"
+
+    def __init__(self, ratio: float = 0.2, window_seconds: float = 60.0,
+                 min_retries: int = 10, buckets: int = 12):
+        self.ratio = ratio
+        self.window_seconds = window_seconds
+        self.min_retries = min_retries
+        self.buckets = buckets
+        self.bucket_width = window_seconds / buckets
+        # scope -> [bucket_epochs, first_attempts, retries]
+        self._scopes: Dict[str, List[List[int]]] = {}
+
+    def _rings(self, scope: str) -> List[List[int]]:
+        rings = self._scopes.get(scope)
+        if rings is None:
+            rings = [[-1] * self.buckets, [0] * self.buckets, [0] * self.buckets]
+            self._scopes[scope] = rings
+        return rings
+
+    def _slot(self, scope: str, now: float) -> Tuple[List[List[int]], int]:
+        epoch = int(now / self.bucket_width)
+        rings = self._rings(scope)
+        index = epoch % self.buckets
+        if rings[0][index] != epoch:
+            rings[0][index] = epoch
+            rings[1][index] = 0
+            rings[2][index] = 0
+        return rings, index
+
+    def _totals(self, scope: str, now: float) -> Tuple[int, int]:
+        rings = self._scopes.get(scope)
+        if rings is None:
+            return 0, 0
+        oldest = int(now / self.bucket_width) - self.buckets + 1
+        firsts = retries = 0
+        for i in range(self.buckets):
+            if rings[0][i] >= oldest:
+                firsts += rings[1][i]
+                retries += rings[2][i]
+        return firsts, retries
+
+    def tokens(self, scope: str, now: Optional[float] = None) -> float:
+        """scope 当前可用的重试令牌数"""
+        now = time.monotonic() if now is None else now
+        firsts, retries = self._totals(scope, now)
+        return self.ratio * firsts + self.min_retries - retries
+
+    def utilization(self, scope: str, now: Optional[float] = None) -> float:
+        """已消耗的预算比例 (0.0 ~ 1.0+)"""
+        now = time.monotonic() if now is None else now
+        firsts, retries = self._totals(scope, now)
+        capacity = self.ratio * firsts + self.min_retries
+        return retries / capacity if capacity > 0 else 0.0
+
+    def scopes(self) -> List[str]:
+        return list(self._scopes.keys())
+
+    def record_request(self, scope: str):
+        now = time.monotonic()
+        for key in (scope, self.GLOBAL_SCOPE):
+            rings, index = self._slot(key, now)
+            rings[1][index] += 1
+
+    def has_budget(self, scope: str) -> bool:
+        now = time.monotonic()
+        return self.tokens(scope, now) >= 1 and self.tokens(self.GLOBAL_SCOPE, now) >= 1
+
+    def try_acquire_retry(self, scope: str) -> bool:
+        """尝试消耗一个重试令牌; 预算耗尽时返回 False"""
+        now = time.monotonic()
+        if self.tokens(scope, now) < 1 or self.tokens(self.GLOBAL_SCOPE, now) < 1:
+            return False
+        for key in (scope, self.GLOBAL_SCOPE):
+            rings, index = self._slot(key, now)
+            rings[2][index] += 1
+        return True
+
+
+
+# ============================================================
+# 优先级准入队列 (稀缺层并发槽位的加权公平排队)
+# ============================================================
+PRIORITY_LEVELS = ("high", "normal", "low")
+
+
+def _parse_weights(spec: str) -> Dict[str, float]:
+    """"high=4,normal=2,low=1" -> {"high": 4.0, ...}"""
+    weights = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        try:
+            weights[name.strip()] = max(float(value), 0.01)
+        except ValueError:
+            continue
+    return weights
+
+
+def _parse_limits(spec: str) -> Dict[str, float]:
+    """"gpt-5*=0,auto-codex=90" -> {"gpt-5*": 0.0, ...}; 保留书写顺序, 允许 0"""
+    limits = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        try:
+            limits[name.strip()] = max(float(value), 0.0)
+        except ValueError:
+            continue
+    return limits
+
+
+def _request_priority(data: Dict, user_api_key_dict: Any, latency_class: str) -> str:
+    """
+    优先级: x-vibe-priority 请求头 > 请求 metadata > key metadata > team metadata;
+    都没有时按延迟等级推断 (interactive -> high, batch -> low)。
+    """
+    headers = (data.get("proxy_server_request") or {}).get("headers") or {}
+    for source in (headers.get("x-vibe-priority"),
+                   (data.get("metadata") or {}).get("vibe_priority"),
+                   (getattr(user_api_key_dict, "metadata", None) or {}).get("vibe_priority"),
+                   (getattr(user_api_key_dict, "team_metadata", None) or {}).get("vibe_priority")):
+        if source and str(source).lower() in PRIORITY_LEVELS:
+            return str(source).lower()
+    return {LATENCY_INTERACTIVE: "high", LATENCY_BATCH: "low"}.get(latency_class, "normal")
+
+
+class Bulkhead:
+    """
+    Bulkhead 隔离的槽位计数: 每个 bulkhead (上游或层) 同时在途的请求数不超过上限。
+    - 槽位在 router 选择 deployment 时预留 (同一请求的下一次尝试先归还上一次的槽位),
+      成功 / 失败 / 流结束或被取消时释放
+    - 超过 ttl 未释放的槽位 (客户端断开后没有任何回调) 自动回收, 上游不会一直显示满载
+    """
+
+    def __init__(self, ttl: float = 600.0):
+        self.ttl = ttl
+        self.active: Dict[str, int] = {}
+        # vibe_request_id -> (bulkhead, 过期时间 monotonic); 按预留顺序排列
+        self.reservations: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    def _expire(self, now: float):
+        while self.reservations:
+            request_id, (_, expires_at) = next(iter(self.reservations.items()))
+            if expires_at >= now:
+                break
+            self.release(request_id)
+
+    def has_room(self, key: str, limit: int) -> bool:
+        self._expire(time.monotonic())
+        return not limit or self.active.get(key, 0) < limit
+
+    def try_reserve(self, request_id: str, key: str, limit: int) -> bool:
+        """为请求在 key 上预留一个槽位; 请求之前持有的槽位先归还"""
+        self.release(request_id)
+        if not self.has_room(key, limit):
+            return False
+        self.active[key] = self.active.get(key, 0) + 1
+        self.reservations[request_id] = (key, time.monotonic() + self.ttl)
+        return True
+
+    def release(self, request_id: Optional[str]) -> bool:
+        reservation = self.reservations.pop(request_id, None) if request_id else None
+        if reservation is None:
+            return False
+        key = reservation[0]
+        self.active[key] = max(0, self.active.get(key, 0) - 1)
+        return True
+
+
+class _AdmissionWaiter:
+    __slots__ = ("finish", "seq", "request_id", "deployment_ids", "future", "priority")
+
+    def __init__(self, finish: float, seq: int, request_id: str, deployment_ids: List[str],
+                 future: "asyncio.Future", priority: str):
+        self.finish = finish
+        self.seq = seq
+        self.request_id = request_id
+        self.deployment_ids = deployment_ids
+        self.future = future
+        self.priority = priority
+
+
+class AdmissionQueue:
+    """
+    有并发上限的 deployment 的准入控制:
+    - 有空闲槽位且没有人排队时立即准入, 否则按加权公平排队 (WFQ) 等待
+    - 流 (flow) = (优先级, API key); 每个请求的虚拟完成时间 = max(虚拟时钟, 该流上次完成时间) + 1 / 权重,
+      槽位释放时优先放行虚拟完成时间最小的请求, 同优先级的不同 key 轮流获得槽位
+    - 槽位以请求为单位持有 (ticket), 成功 / 失败回调释放; 超过 ticket_ttl 未释放的自动回收
+    - 释放、过期回收、并发上限变化后都会重新放行排队的请求
+    """
+
+    def __init__(self, weights: Dict[str, float], ticket_ttl: float = 600.0):
+        self.weights = weights
+        self.ticket_ttl = ticket_ttl
+        self.capacity: Dict[str, int] = {}
+        self.occupancy: Dict[str, int] = {}
+        # vibe_request_id -> (deployment id, 过期时间 monotonic)
+        self.tickets: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.waiters: List[_AdmissionWaiter] = []
+        self.virtual_time = 0.0
+        self._flow_finish: Dict[str, float] = {}
+        self._seq = 0
+
+    def depth(self, priority: Optional[str] = None) -> int:
+        return sum(1 for w in self.waiters if priority is None or w.priority == priority)
+
+    def _free(self, deployment_id: str) -> bool:
+        return self.occupancy.get(deployment_id, 0) < self.capacity.get(deployment_id, 0)
+
+    def _grant(self, request_id: str, deployment_id: str):
+        self.occupancy[deployment_id] = self.occupancy.get(deployment_id, 0) + 1
+        self.tickets[request_id] = (deployment_id, time.monotonic() + self.ticket_ttl)
+
+    def _expire(self):
+        # ticket 按发放顺序排列且 TTL 相同, 最旧的在最前
+        now = time.monotonic()
+        while self.tickets:
+            request_id, (_, expires_at) = next(iter(self.tickets.items()))
+            if expires_at >= now:
+                break
+            self.release(request_id)
+
+    def _next_expiry(self) -> Optional[float]:
+        for _, expires_at in self.tickets.values():
+            return expires_at
+        return None
+
+    def held(self, request_id: Optional[str]) -> Optional[str]:
+        """请求当前持有槽位的 deployment id"""
+        ticket = self.tickets.get(request_id) if request_id else None
+        return ticket[0] if ticket is not None else None
+
+    def reconfigure(self, capacities: Dict[str, int]):
+        """更新并发上限; 上限变大时立即放行排队的请求"""
+        changed = False
+        for deployment_id, capacity in capacities.items():
+            if self.capacity.get(deployment_id) != capacity:
+                self.capacity[deployment_id] = capacity
+                changed = True
+        if changed:
+            self._dispatch()
+
+    def release(self, request_id: Optional[str]) -> bool:
+        ticket = self.tickets.pop(request_id, None) if request_id else None
+        if ticket is None:
+            return False
+        self.occupancy[ticket[0]] = max(0, self.occupancy.get(ticket[0], 0) - 1)
+        self._dispatch()
+        return True
+
+    def _dispatch(self):
+        while self.waiters:
+            ready = [w for w in self.waiters if not w.future.done() and any(self._free(d) for d in w.deployment_ids)]
+            if not ready:
+                break
+            waiter = min(ready, key=lambda w: (w.finish, w.seq))
+            self.waiters.remove(waiter)
+            deployment_id = next(d for d in waiter.deployment_ids if self._free(d))
+            self._grant(waiter.request_id, deployment_id)
+            self.virtual_time = max(self.virtual_time, waiter.finish)
+            waiter.future.set_result(deployment_id)
+
+    def _finish_tag(self, priority: str, flow: str) -> float:
+        key = f"{priority}:{flow}"
+        finish = max(self.virtual_time, self._flow_finish.get(key, 0.0)) + 1.0 / self.weights.get(priority, 1.0)
+        self._flow_finish[key] = finish
+        if len(self._flow_finish) > 10000:
+            self._flow_finish = {k: v for k, v in self._flow_finish.items() if v > self.virtual_time}
+        return finish
+
+    async def acquire(self, request_id: str, deployments: List[Tuple[str, int]], priority: str,
+                      flow: str, timeout: float) -> Optional[str]:
+        """为请求在 deployments [(id, 并发上限)] 之一上取得槽位; 超时返回 None"""
+        self.reconfigure(dict(deployments))
+        self._expire()
+        self.release(request_id)  # 同一请求的上一次尝试仍持有的槽位
+        ids = [deployment_id for deployment_id, _ in deployments]
+        contended = any(set(w.deployment_ids) & set(ids) for w in self.waiters)
+        if not contended:
+            for deployment_id in ids:
+                if self._free(deployment_id):
+                    self._grant(request_id, deployment_id)
+                    return deployment_id
+        if timeout <= 0:
+            return None
+
+        self._seq += 1
+        future = asyncio.get_running_loop().create_future()
+        waiter = _AdmissionWaiter(self._finish_tag(priority, flow), self._seq, request_id, ids, future, priority)
+        self.waiters.append(waiter)
+        deadline = time.monotonic() + timeout
+        try:
+            while not future.done():
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                # 等到超时或最早的 ticket 过期 (过期回收的槽位要放行给排队的请求)
+                wake_at = min(deadline, self._next_expiry() or deadline)
+                await asyncio.wait({future}, timeout=max(0.0, wake_at - now))
+                self._expire()
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        if future.done() and not future.cancelled():
+            return future.result()
+        self._abandon(waiter)
+        return None
+
+    def _abandon(self, waiter: _AdmissionWaiter):
+        """放弃等待; 若恰好已被放行则归还槽位"""
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+        if waiter.future.done() and not waiter.future.cancelled():
+            self.release(waiter.request_id)
+        else:
+            waiter.future.cancel()
+
+
+# ============================================================
+# 跨 worker 共享路由状态 (多 uvicorn worker / 多副本)
+# ============================================================
+class SharedStateBackend(ABC):
+    """
+    共享状态后端: 每个 worker 定期发布自己的状态快照, 并读取其他 worker 的快照。
+    只在后台同步任务中调用, 请求热路径只读本地内存。
+    """
+
+    name = "none"
+
+    @abstractmethod
+    async def publish(self, worker_id: str, state: Dict[str, Any]):
+        """发布本 worker 的状态快照"""
+
+    @abstractmethod
+    async def collect(self, worker_id: str) -> List[Dict[str, Any]]:
+        """读取其他 worker 的状态快照 (不含 worker_id 自己的)"""
+
+
+class SharedMemoryBackend(SharedStateBackend):
+    """
+    单机多进程: 一块 multiprocessing.shared_memory, 每个 worker 独占一个槽位。
+    槽位头: pid (u64) | 发布时间 (f64) | 数据长度 (u32), 之后是 JSON 快照。
+    槽位的领取 / 读写用同名文件锁 (fcntl.flock) 互斥, 临界区只有一次内存拷贝。
+    事件循环中以非阻塞方式加锁, 锁被占用时让出事件循环后重试。
+    """
+
+    name = "shm"
+    HEADER = "<QdI"
+    LOCK_RETRY_SECONDS = 0.005
+    LOCK_TIMEOUT_SECONDS = 1.0
+
+    def __init__(self, segment: str = "vibe_router_state", slots: int = 16, slot_bytes: int = 512 * 1024,
+                 stale_seconds: float = 30.0):
+        import fcntl
+        import struct
+        from multiprocessing import shared_memory
+        self._fcntl = fcntl
+        self._struct = struct
+        self.header_size = struct.calcsize(self.HEADER)
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.stale_seconds = stale_seconds
+        self._lock_file = open(os.path.join("/tmp", f"{segment}.lock"), "a+")
+        with self._locked(fcntl.LOCK_EX):
+            try:
+                self._shm = self._open(shared_memory, segment, create=True)
+            except FileExistsError:
+                self._shm = self._open(shared_memory, segment, create=False)
+        self._slot: Optional[int] = None
+
+    def _open(self, shared_memory: Any, segment: str, create: bool):
+        size = self.slots * self.slot_bytes if create else 0
+        try:
+            # Python 3.13+: 不让 resource_tracker 在本进程退出时删除其他 worker 仍在使用的内存段
+            return shared_memory.SharedMemory(name=segment, create=create, size=size, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=segment, create=create, size=size)
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, "shared_memory")
+            except Exception:
+                pass
+            return shm
+
+    class _Lock:
+        def __init__(self, backend: "SharedMemoryBackend", mode: int):
+            self.backend, self.mode = backend, mode
+
+        def __enter__(self):
+            self.backend._fcntl.flock(self.backend._lock_file.fileno(), self.mode)
+
+        def __exit__(self, *exc):
+            self.backend._fcntl.flock(self.backend._lock_file.fileno(), self.backend._fcntl.LOCK_UN)
+
+    def _locked(self, mode: int) -> "_Lock":
+        return self._Lock(self, mode)
+
+    class _AsyncLock:
+        def __init__(self, backend: "SharedMemoryBackend", mode: int):
+            self.backend, self.mode = backend, mode
+
+        async def __aenter__(self):
+            fcntl, fd = self.backend._fcntl, self.backend._lock_file.fileno()
+            deadline = time.monotonic() + self.backend.LOCK_TIMEOUT_SECONDS
+            while True:
+                try:
+                    fcntl.flock(fd, self.mode | fcntl.LOCK_NB)
+                    return
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError("shared-state lock busy")
+                    await asyncio.sleep(self.backend.LOCK_RETRY_SECONDS)
+
+        async def __aexit__(self, *exc):
+            self.backend._fcntl.flock(self.backend._lock_file.fileno(), self.backend._fcntl.LOCK_UN)
+
+    def _alocked(self, mode: int) -> "_AsyncLock":
+        return self._AsyncLock(self, mode)
+
+    def _header(self, slot: int) -> Tuple[int, float, int]:
+        return self._struct.unpack_from(self.HEADER, self._shm.buf, slot * self.slot_bytes)
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _claim(self) -> Optional[int]:
+        """领取本进程的槽位: 已有 -> 空闲 -> 所属进程已退出"""
+        pid = os.getpid()
+        owners = [self._header(slot)[0] for slot in range(self.slots)]
+        if pid in owners:
+            return owners.index(pid)
+        for slot, owner in enumerate(owners):
+            if owner == 0 or not self._alive(owner):
+                return slot
+        return None
+
+    async def publish(self, worker_id: str, state: Dict[str, Any]):
+        payload = json.dumps(state, separators=(",", ":")).encode()
+        if len(payload) > self.slot_bytes - self.header_size:
+            raise ValueError(f"state snapshot {len(payload)}B exceeds slot size {self.slot_bytes}B")
+        async with self._alocked(self._fcntl.LOCK_EX):
+            if self._slot is None or self._header(self._slot)[0] != os.getpid():
+                self._slot = self._claim()
+                if self._slot is None:
+                    raise RuntimeError(f"no free shared-state slot (slots={self.slots})")
+            offset = self._slot * self.slot_bytes
+            self._shm.buf[offset + self.header_size:offset + self.header_size + len(payload)] = payload
+            self._struct.pack_into(self.HEADER, self._shm.buf, offset, os.getpid(), time.time(), len(payload))
+
+    async def collect(self, worker_id: str) -> List[Dict[str, Any]]:
+        pid, now = os.getpid(), time.time()
+        payloads = []
+        async with self._alocked(self._fcntl.LOCK_SH):
+            for slot in range(self.slots):
+                owner, published, length = self._header(slot)
+                if owner in (0, pid) or now - published > self.stale_seconds or not length:
+                    continue
+                offset = slot * self.slot_bytes + self.header_size
+                payloads.append(bytes(self._shm.buf[offset:offset + length]))
+        return [json.loads(payload) for payload in payloads]
+
+
+class RedisStateBackend(SharedStateBackend):
+    """
+    多机: 通过 proxy 的 DualCache 背后的 Redis 共享。
+    每个 worker 写 "<prefix>:<worker_id>" (带 TTL), 并在 "<prefix>:workers" 中登记自己的心跳;
+    登记是读-改-写, 并发时可能丢失一次, 下一个同步周期会自动补回。
+    """
+
+    name = "redis"
+
+    def __init__(self, prefix: str = "vibe:state", stale_seconds: float = 30.0):
+        self.prefix = prefix
+        self.stale_seconds = stale_seconds
+        self.redis: Any = None
+
+    def bind(self, cache: Any):
+        """绑定 DualCache 的 redis 层 (proxy 未配置 Redis 时回退到 proxy_server.redis_usage_cache)"""
+        redis = getattr(cache, "redis_cache", None)
+        if redis is None:
+            try:
+                from litellm.proxy import proxy_server
+                redis = getattr(proxy_server, "redis_usage_cache", None)
+            except Exception:
+                redis = None
+        self.redis = redis
+
+    async def _workers(self) -> Dict[str, float]:
+        workers = await self.redis.async_get_cache(key=f"{self.prefix}:workers")
+        if isinstance(workers, str):
+            workers = json.loads(workers)
+        return workers if isinstance(workers, dict) else {}
+
+    async def publish(self, worker_id: str, state: Dict[str, Any]):
+        if self.redis is None:
+            self.bind(None)
+        if self.redis is None:
+            raise RuntimeError("no Redis cache configured on the proxy")
+        ttl = int(self.stale_seconds) + 1
+        await self.redis.async_set_cache(key=f"{self.prefix}:{worker_id}", value=state, ttl=ttl)
+        now = time.time()
+        workers = {w: seen for w, seen in (await self._workers()).items() if now - seen <= self.stale_seconds}
+        workers[worker_id] = now
+        await self.redis.async_set_cache(key=f"{self.prefix}:workers", value=workers, ttl=ttl * 10)
+
+    async def collect(self, worker_id: str) -> List[Dict[str, Any]]:
+        if self.redis is None:
+            return []
+        now = time.time()
+        peers = [w for w, seen in (await self._workers()).items()
+                 if w != worker_id and now - seen <= self.stale_seconds]
+        if not peers:
+            return []
+        values = await self.redis.async_batch_get_cache(key_list=[f"{self.prefix}:{w}" for w in peers])
+        values = values.values() if isinstance(values, dict) else (values or [])
+        states = []
+        for value in values:
+            if isinstance(value, str):
+                value = json.loads(value)
+            if isinstance(value, dict):
+                states.append(value)
+        return states
+
+
+class SharedRoutingState:
+    """
+    后台同步任务: 每 interval 秒把本地 RoutingStats / AffinityMap 的快照批量发布到后端,
+    并把其他 worker 的快照合并进本地内存。热路径只读本地表, 不等待任何网络往返;
+    其他 worker 的观测最多延迟一个 interval 可见。
+    """
+
+    def __init__(self, backend: SharedStateBackend, stats: RoutingStats, affinity: AffinityMap,
+                 metrics: VibeMetrics, interval: float = 1.0, affinity_limit: int = 1000):
+        import socket
+        self.backend = backend
+        self.stats = stats
+        self.affinity = affinity
+        self.metrics = metrics
+        self.interval = interval
+        self.affinity_limit = affinity_limit
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.peers = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def ensure_started(self):
+        """在事件循环中懒启动同步任务 (fork 出的 worker 各自启动一次)"""
+        if self._task is not None and not self._task.done():
+            return
+        if not self.worker_id.endswith(f":{os.getpid()}"):
+            self.worker_id = self.worker_id.rsplit(":", 1)[0] + f":{os.getpid()}"
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"worker": self.worker_id, "stats": self.stats.export_state(),
+                "affinity": self.affinity.export_state(self.affinity_limit)}
+
+    def merge(self, state: Dict[str, Any]):
+        self.stats.merge_state(state.get("stats") or {}, source=state.get("worker") or "?")
+        self.affinity.merge_state(state.get("affinity") or {})
+
+    async def sync_once(self):
+        started = time.perf_counter()
+        await self.backend.publish(self.worker_id, self.snapshot())
+        states = await self.backend.collect(self.worker_id)
+        for state in states:
+            self.merge(state)
+        self.stats.retain_peers({state.get("worker") or "?" for state in states})
+        self.peers = len(states)
+        self.metrics.observe("vibe_shared_state_sync_seconds", time.perf_counter() - started,
+                             backend=self.backend.name)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.metrics.inc("vibe_shared_state_errors_total", backend=self.backend.name)
+                _log(f"Shared state sync failed ({self.backend.name}): {e}", "WARN")
+            await asyncio.sleep(self.interval)
+
+
+
+# ============================================================
+# 上游连接预热 / keep-alive
+# ============================================================
+def _resolve_env(value: Any) -> Any:
+    """解析配置中的 os.environ/NAME 引用"""
+    if isinstance(value, str) and value.startswith("os.environ/"):
+        return os.environ.get(value[len("os.environ/"):])
+    return value
+
+
+def _upstream_label(api_base: str) -> str:
+    from urllib.parse import urlparse
+    return urlparse(api_base).netloc or api_base
+
+
+class ConnectionWarmer:
+    """
+    启动时和每 interval 秒, 通过 LiteLLM 共享的 httpx client 向每个不同的 api_base 发一个 HEAD,
+    让连接池里保持可复用的连接 (任何 HTTP 状态码都说明连接已建立)。
+    - 建连耗时 (TCP + TLS) 单独记录: httpcore 传输用 trace 扩展精确测量,
+      其他传输 (aiohttp) 用 "首次请求 - 紧接着的复用请求" 估算
+    - 对已发现的 client 注册 request hook, 真实流量新建连接的耗时同样计入
+    - 不修改连接池配置: 连接只在 client 的 keep-alive 过期时间内保持, interval 需要相应设置
+    默认关闭: 会持续向付费上游发送请求, 需要显式启用。
+    """
+
+    CONNECT_PHASES = ("connection.connect_tcp", "connection.start_tls")
+
+    def __init__(self, metrics: VibeMetrics, interval: float = 30.0, timeout: float = 5.0):
+        self.metrics = metrics
+        self.interval = interval
+        self.timeout = timeout
+        # upstream -> [(api_base, httpx client)]
+        self.targets: Dict[str, List[Tuple[str, Any]]] = {}
+        # deployment id -> upstream
+        self.deployment_upstream: Dict[str, str] = {}
+        self._instrumented: set = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _clients_for(deployment: Dict) -> List[Any]:
+        """该 deployment 的 provider 在 LiteLLM 中共享的 httpx client (get_async_httpx_client)"""
+        params = deployment.get("litellm_params") or {}
+        provider = params.get("custom_llm_provider") or str(params.get("model", "")).split("/", 1)[0]
+        try:
+            from litellm.llms.custom_httpx.http_handler import get_async_httpx_client
+            return [get_async_httpx_client(llm_provider=provider).client]
+        except Exception:
+            return []
+
+    def discover(self, router: Any):
+        targets: Dict[str, List[Tuple[str, Any]]] = {}
+        seen = set()
+        for deployment in getattr(router, "model_list", None) or []:
+            api_base = _resolve_env((deployment.get("litellm_params") or {}).get("api_base"))
+            if not api_base:
+                continue
+            label = _upstream_label(api_base)
+            self.deployment_upstream[_deployment_id(deployment)] = label
+            for client in self._clients_for(deployment):
+                if (label, id(client)) in seen:
+                    continue
+                seen.add((label, id(client)))
+                targets.setdefault(label, []).append((api_base, client))
+                self._instrument(client, label)
+        self.targets = targets
+
+    def _tracer(self, on_connect: Callable[[float], None]) -> Callable:
+        """
+        httpcore trace 回调: 累计 TCP 建连 + TLS 握手耗时, 开始发送请求头时 (连接已就绪) 回调 on_connect;
+        复用已有连接时不会出现建连事件, 也不会回调。
+        """
+        started: Dict[str, float] = {}
+        # [建连耗时, 是否新建了连接, 传输是否支持 trace]
+        elapsed = [0.0, False, False]
+
+        async def trace(name: str, info: Dict):
+            elapsed[2] = True
+            phase, _, state = name.rpartition(".")
+            if phase in self.CONNECT_PHASES:
+                if state == "started":
+                    started[phase] = time.perf_counter()
+                elif state == "complete" and phase in started:
+                    elapsed[0] += time.perf_counter() - started.pop(phase)
+                    elapsed[1] = True
+            elif phase.endswith("send_request_headers") and state == "started" and elapsed[1]:
+                on_connect(elapsed[0])
+
+        trace.elapsed = elapsed  # type: ignore[attr-defined]
+        return trace
+
+    def _instrument(self, client: Any, label: str):
+        """给 client 加 request hook, 注入 trace 扩展, 记录真实请求新建连接的耗时"""
+        if id(client) in self._instrumented or not hasattr(client, "event_hooks"):
+            return
+        self._instrumented.add(id(client))
+        warmer = self
+
+        def record(seconds: float):
+            warmer.metrics.observe("vibe_upstream_connect_seconds", seconds, upstream=label, source="request")
+
+        async def inject_trace(request: Any):
+            request.extensions.setdefault("trace", warmer._tracer(record))
+
+        try:
+            hooks = dict(client.event_hooks)
+            hooks["request"] = list(hooks.get("request", [])) + [inject_trace]
+            client.event_hooks = hooks
+        except Exception:
+            pass
+
+    def pool_stats(self, client: Any) -> Optional[Tuple[int, int]]:
+        """(空闲连接数, 使用中连接数); 无法读取连接池时返回 None"""
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is None:
+            return None
+        idle = sum(1 for c in connections if c.is_idle())
+        return idle, len(connections) - idle
+
+    async def _probe(self, client: Any, url: str) -> Tuple[float, Optional[float]]:
+        """(请求耗时, 建连耗时); 复用连接时建连耗时为 0, 传输不支持 trace 时为 None"""
+        tracer = self._tracer(lambda seconds: None)
+        started = time.perf_counter()
+        response = await client.request("HEAD", url, timeout=self.timeout, extensions={"trace": tracer})
+        await response.aclose()
+        connect, new_connection, traced = tracer.elapsed  # type: ignore[attr-defined]
+        if not traced:
+            return time.perf_counter() - started, None
+        return time.perf_counter() - started, connect if new_connection else 0.0
+
+    async def warm_once(self, router: Any):
+        self.discover(router)
+        for label, targets in self.targets.items():
+            for url, client in targets:
+                try:
+                    first, connect = await self._probe(client, url)
+                    if connect is None:
+                        # 传输不支持 trace: 紧接着再请求一次 (复用刚建立的连接), 差值近似为建连耗时
+                        second, _ = await self._probe(client, url)
+                        connect = max(0.0, first - second)
+                    if connect > 0:
+                        self.metrics.observe("vibe_upstream_connect_seconds", connect, upstream=label, source="warm")
+                    self.metrics.observe("vibe_upstream_warm_seconds", first, upstream=label)
+                    self.metrics.inc("vibe_upstream_warm_total", upstream=label,
+                                     result="connected" if connect > 0 else "reused")
+                except Exception as e:
+                    self.metrics.inc("vibe_upstream_warm_total", upstream=label, result="error")
+                    _log(f"Connection warm-up to {label} failed: {e}", "WARN")
+
+    def ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            router = _get_llm_router()
+            if router is None:
+                await asyncio.sleep(1.0)
+                continue
+            try:
+                await self.warm_once(router)
+            except Exception as e:
+                _log(f"Connection warm-up failed: {e}", "WARN")
+            await asyncio.sleep(self.interval)
+
+
+# ============================================================
+# 分布式追踪 (OpenTelemetry 兼容, head + tail 采样)
+# ============================================================
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], start_ns: Optional[int] = None, **attributes):
+        self.name = name
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error = False
+
+    def end(self, error: bool = False, **attributes):
+        self.end_ns = time.time_ns()
+        self.error = self.error or error
+        self.attributes.update(attributes)
+
+
+class RequestTrace:
+    """一个请求的所有 span; 请求结束时才决定是否导出 (tail 采样)"""
+
+    __slots__ = ("trace_id", "root", "spans", "attempts", "head_sampled")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], head_sampled: bool, **attributes):
+        self.trace_id = trace_id
+        self.root = Span("vibe.request", parent_id, **attributes)
+        self.spans: List[Span] = [self.root]
+        # litellm_call_id -> 上游尝试 span
+        self.attempts: Dict[str, Span] = {}
+        self.head_sampled = head_sampled
+
+    def span(self, name: str, start_ns: Optional[int] = None, **attributes) -> Span:
+        span = Span(name, self.root.span_id, start_ns, **attributes)
+        self.spans.append(span)
+        return span
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(trace_id: str, span: Span) -> Dict[str, Any]:
+    encoded = {
+        "traceId": trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 2 if span.parent_id is None or span.name == "vibe.request" else 3,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns or span.start_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items() if v is not None],
+        "status": {"code": 2 if span.error else 1},
+    }
+    if span.parent_id:
+        encoded["parentSpanId"] = span.parent_id
+    return encoded
+
+
+class TraceExporter:
+    """
+    批量导出 OTLP/JSON (ExportTraceServiceRequest):
+    - file: 每批一行 JSON 追加到文件 (可直接回放给 collector)
+    - otlp: POST 到 OTLP/HTTP 端点, 例如 http://otel-collector:4318/v1/traces
+    """
+
+    def __init__(self, metrics: VibeMetrics, file_path: str = "", endpoint: str = "",
+                 service_name: str = "litellm-vibe-router", flush_interval: float = 2.0, max_batch: int = 512):
+        self.metrics = metrics
+        self.file_path = file_path
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: List[Dict[str, Any]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, trace: RequestTrace):
+        self._pending.extend(_otlp_span(trace.trace_id, span) for span in trace.spans)
+        if len(self._pending) > self.max_batch * 20:
+            dropped = len(self._pending) - self.max_batch * 20
+            del self._pending[:dropped]
+            self.metrics.inc("vibe_trace_spans_dropped_total", dropped)
+
+    def _payload(self, spans: List[Dict[str, Any]]) -> bytes:
+        return json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "vibe_router"}, "spans": spans}],
+        }]}, separators=(",", ":")).encode()
+
+    def _write(self, payload: bytes):
+        if self.file_path:
+            with open(self.file_path, "ab") as f:
+                f.write(payload + b"\n")
+        if self.endpoint:
+            import urllib.request
+            request = urllib.request.Request(self.endpoint, data=payload, method="POST",
+                                             headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(request, timeout=5) as response:
+                response.read()
+
+    async def flush(self):
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            try:
+                await asyncio.to_thread(self._write, self._payload(batch))
+                self.metrics.inc("vibe_trace_spans_exported_total", len(batch))
+            except Exception as e:
+                self.metrics.inc("vibe_trace_export_errors_total")
+                _log(f"Trace export failed: {e}", "WARN")
+                return
+
+    def ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+class Tracer:
+    """
+    每个请求先在内存中记录轻量 span, 请求结束时决定是否导出:
+    - head 采样: 按 sample_rate 随机, 或上游 traceparent 标记为已采样
+    - tail 采样: 失败或耗时超过 slow_ms 的请求总是导出
+    未导出的请求只付出几个小对象的开销; 未配置导出目标时不创建 Tracer。
+    """
+
+    def __init__(self, exporter: TraceExporter, sample_rate: float = 0.01, slow_ms: float = 10000.0,
+                 max_traces: int = 10000):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_traces = max_traces
+        self._traces: "OrderedDict[str, RequestTrace]" = OrderedDict()
+
+    def start(self, request_id: str, data: Dict, **attributes) -> RequestTrace:
+        trace = self._traces.get(request_id)
+        if trace is not None:
+            return trace
+        headers = (data.get("proxy_server_request") or {}).get("headers") or {}
+        parts = str(headers.get("traceparent", "")).split("-")
+        if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+            trace = RequestTrace(parts[1], parts[2], parts[3].endswith("1") or random.random() < self.sample_rate,
+                                 **attributes)
+        else:
+            trace = RequestTrace("%032x" % random.getrandbits(128), None, random.random() < self.sample_rate,
+                                 **attributes)
+        self._traces[request_id] = trace
+        while len(self._traces) > self.max_traces:
+            _, stale = self._traces.popitem(last=False)
+            self._decide(stale, error=False, incomplete=True)
+        return trace
+
+    def get(self, request_id: Optional[str]) -> Optional[RequestTrace]:
+        return self._traces.get(request_id) if request_id else None
+
+    def finish(self, request_id: Optional[str], error: bool = False, **attributes):
+        trace = self._traces.pop(request_id, None) if request_id else None
+        if trace is not None:
+            trace.root.end(error=error, **attributes)
+            self._decide(trace, error)
+
+    def _decide(self, trace: RequestTrace, error: bool, incomplete: bool = False):
+        for span in trace.spans:
+            if span.end_ns is None:
+                span.end(incomplete=True)
+        duration_ms = (trace.root.end_ns - trace.root.start_ns) / 1e6
+        if trace.head_sampled:
+            reason = "head"
+        elif error or any(span.error for span in trace.spans):
+            reason = "error"
+        elif duration_ms >= self.slow_ms or incomplete:
+            reason = "slow"
+        else:
+            return
+        trace.root.attributes["vibe.sampling"] = reason
+        self.exporter.metrics.inc("vibe_traces_sampled_total", reason=reason)
+        self.exporter.submit(trace)
+
+
+# ============================================================
+# 事件循环延迟监控 (阻塞回调检测)
+# ============================================================
+class LoopLagMonitor:
+    """
+    插件回调与所有流式响应共用 proxy 的事件循环, 任何同步阻塞都会拖慢并发请求:
+    - 心跳任务每 interval 秒醒来一次, 实际睡眠超出部分即事件循环延迟
+    - 看门狗线程发现心跳停滞超过 threshold 时, 采样事件循环线程的调用栈,
+      把这次阻塞归因到栈上最外层的插件函数 (hook / callback), 否则归为 other
+    """
+
+    def __init__(self, metrics: VibeMetrics, interval: float = 0.1, threshold_ms: float = 100.0,
+                 max_samples: int = 20):
+        self.metrics = metrics
+        self.interval = interval
+        self.threshold = threshold_ms / 1000.0
+        self.samples: deque = deque(maxlen=max_samples)
+        self._beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        # 当前停滞的栈采样 (看门狗写, 心跳在停滞结束后读取并清空)
+        self._stall: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _attribute(frame) -> Tuple[str, List[str]]:
+        stack = traceback.extract_stack(frame)
+        source = None
+        for entry in stack:
+            if entry.filename == __file__ and entry.name not in ("<module>", "_run"):
+                source = entry.name
+                break
+        if source is None and stack:
+            source = "other"
+        return source or "other", [f"{os.path.basename(e.filename)}:{e.lineno} {e.name}" for e in stack[-30:]]
+
+    def _watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            stalled = time.monotonic() - self._beat - self.interval
+            if stalled < self.threshold or self._stall is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            source, stack = self._attribute(frame)
+            self._stall = {"source": source, "stack": stack}
+
+    def ensure_started(self):
+        if self._task is None or self._task.done():
+            self._loop_thread = threading.get_ident()
+            self._beat = time.monotonic()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name="vibe-loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self._beat - self.interval)
+            self._beat = now
+            self.metrics.observe("vibe_event_loop_lag_seconds", lag)
+            if lag < self.threshold:
+                self._stall = None
+                continue
+            stall, self._stall = self._stall, None
+            source = stall["source"] if stall else "unknown"
+            self.metrics.inc("vibe_event_loop_blocks_total", source=source)
+            self.metrics.observe("vibe_event_loop_blocked_seconds", lag, source=source)
+            self.samples.append({"at": time.time(), "blocked_ms": round(lag * 1000.0, 1), "source": source,
+                                 "stack": stall["stack"] if stall else []})
+            _log(f"Event loop blocked {lag * 1000.0:.0f}ms by {source}", "WARN")
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "interval_seconds": self.interval,
+            "threshold_ms": self.threshold * 1000.0,
+            "lag_ms": {f"p{int(q * 100)}": round(value * 1000.0, 2) for q in VibeMetrics.QUANTILES
+                       for value in [self.metrics.quantile("vibe_event_loop_lag_seconds", q)] if value is not None},
+            "blocks": list(self.samples),
+        }
+
+
+# ============================================================
+# 按需采样 profiler (管理接口触发, 限时)
+# ============================================================
+class SamplingProfiler:
+    """
+    定时采样整个进程所有线程的调用栈, 输出 collapsed-stack 格式
+    (每行 "线程;帧;帧... 次数", 可直接交给 flamegraph.pl / speedscope)。
+    插件自身的帧加 [vibe] 前缀便于在火焰图中定位。未运行时没有任何开销。
+    """
+
+    def __init__(self, hz: float = 100.0, max_seconds: float = 300.0):
+        self.hz = hz
+        self.max_seconds = max_seconds
+        self.last: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._running = False
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        if code.co_filename == __file__:
+            return f"[vibe] {code.co_name}"
+        module = frame.f_globals.get("__name__") or os.path.basename(code.co_filename)
+        return f"{module}:{code.co_name}"
+
+    def _sample(self, seconds: float, hz: float) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        me = threading.get_ident()
+        period = 1.0 / hz
+        started = time.monotonic()
+        deadline = started + seconds
+        samples = 0
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(self._label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident) or f"thread-{ident}")
+                key = ";".join(reversed(labels))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            time.sleep(period)
+        return {"started_at": time.time() - (time.monotonic() - started), "seconds": seconds, "hz": hz,
+                "samples": samples, "stacks": counts}
+
+    async def run(self, seconds: float, hz: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """采样 seconds 秒; 已有采样在运行时返回 None"""
+        with self._lock:
+            if self._running:
+                return None
+            self._running = True
+        try:
+            seconds = max(0.1, min(seconds, self.max_seconds))
+            self.last = await asyncio.to_thread(self._sample, seconds, min(hz or self.hz, 1000.0))
+            return self.last
+        finally:
+            self._running = False
+
+    @staticmethod
+    def collapsed(result: Dict[str, Any]) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in
+                       sorted(result["stacks"].items(), key=lambda item: -item[1]))
+
+
+# ============================================================
+# 语义缓存 (CPU, 近似重复的简单 prompt)
+# ============================================================
+# 影响回答的请求参数: 参与命名空间, 参数不同的请求互不命中
+_SEMANTIC_CACHE_PARAMS = ("temperature", "top_p", "max_tokens", "max_completion_tokens", "stop",
+                          "response_format", "tools", "tool_choice", "seed")
+
+
+def _cacheable_prompt(data: Dict, max_chars: int) -> Optional[Tuple[str, str]]:
+    """
+    只缓存简单请求: 可选的 system 消息 (或 Anthropic 顶层 system) + 一条纯文本 user 消息
+    (工具定义只进入命名空间, 调用工具的回答不缓存)。
+    返回 (system 文本, user 文本); 不可缓存时返回 None
+    """
+    messages = data.get("messages") or []
+    if not isinstance(messages, list) or not messages or data.get("functions") or data.get("n", 1) != 1:
+        return None
+    if not all(isinstance(m, dict) for m in messages):
+        return None
+    system = _tool_result_text(data.get("system") or "")
+    if len(messages) == 2 and messages[0].get("role") == "system":
+        system = _tool_result_text(messages[0].get("content"))
+        messages = messages[1:]
+    if len(messages) != 1 or messages[0].get("role") != "user":
+        return None
+    prompt = _tool_result_text(messages[0].get("content"))
+    if prompt is None or system is None or not prompt.strip() or len(prompt) > max_chars:
+        return None
+    return system, prompt
+
+
+def _cacheable_answer(response: Any) -> Optional[str]:
+    """正常结束且没有调用工具的回答文本 (OpenAI choices 或 Anthropic content 块); 否则返回 None"""
+    choices = getattr(response, "choices", None)
+    if choices:
+        message = getattr(choices[0], "message", None)
+        if getattr(choices[0], "finish_reason", "stop") != "stop" or getattr(message, "tool_calls", None):
+            return None
+        answer = getattr(message, "content", None)
+    else:
+        get = response.get if isinstance(response, dict) else lambda key: getattr(response, key, None)
+        content = get("content")
+        if get("stop_reason") != "end_turn" or not isinstance(content, list):
+            return None
+        # tool_use 等非文本块使 _tool_result_text 返回 None
+        answer = _tool_result_text([part if isinstance(part, dict) else {"type": getattr(part, "type", None),
+                                                                         "text": getattr(part, "text", None)}
+                                    for part in content])
+    return answer if isinstance(answer, str) and answer.strip() else None
+
+
+class _SemanticIndex:
+    """
+    一个命名空间 (模型组 + 调用方 + system prompt + 请求参数) 的签名矩阵; 行按需扩容, 淘汰的行复用。
+    rows 按最近使用排序, 最旧的一条 O(1) 取得
+    """
+
+    __slots__ = ("vectors", "keys", "rows", "free")
+
+    def __init__(self, np: Any, dims: int, capacity: int):
+        self.vectors = np.zeros((capacity, dims), dtype=np.float32)
+        self.keys: List[Optional[str]] = [None] * capacity
+        self.rows: "OrderedDict[str, int]" = OrderedDict()
+        self.free: List[int] = list(range(capacity - 1, -1, -1))
+
+
+class SemanticCache:
+    """
+    prompt → 定长 hashed n-gram 签名 (字节 3/5-gram 与加权的词 1/2-gram 特征哈希到 dims 维, L2 归一化;
+    词特征让只改了一个标识符的 prompt 明显拉开距离),
+    每个命名空间一个签名矩阵, 查找为一次向量化点积 (余弦相似度) 取最大值。
+    总内存 (签名矩阵 + 回答) 不超过 max_bytes: 超出时从最久未使用的命名空间淘汰其最旧的一条,
+    命名空间的最后一条被淘汰时释放整个矩阵。淘汰都在取得写入目标的矩阵之前完成。
+    不同模型组 / 调用方 (key / team) / system prompt / 请求参数互不命中。
+    """
+
+    WORD_WEIGHT = 3.0
+    INITIAL_ROWS = 16
+
+    def __init__(self, np: Any, threshold: float = 0.95, dims: int = 512, max_entries: int = 2000,
+                 max_bytes: int = 64 * 1024 * 1024, ttl: float = 3600.0):
+        self.np = np
+        self.threshold = threshold
+        self.dims = dims
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        # 命名空间 -> 签名矩阵, 按最近使用排序
+        self._indexes: "OrderedDict[Tuple[str, str], _SemanticIndex]" = OrderedDict()
+        # (命名空间, key) -> (回答, 写入时间)
+        self._entries: Dict[Tuple[Tuple[str, str], str], Tuple[str, float]] = {}
+        self._counter = 0
+
+    def signature(self, text: str):
+        np = self.np
+        text = " ".join(text.lower().split())
+        raw = np.frombuffer(text.encode("utf-8"), dtype=np.uint8).astype(np.uint32)
+        vector = np.zeros(self.dims, dtype=np.float32)
+        for n, seed in ((3, 0x9E3779B1), (5, 0x85EBCA77)):
+            if raw.size < n:
+                continue
+            grams = np.zeros(raw.size - n + 1, dtype=np.uint32)
+            for i in range(n):
+                grams = grams * np.uint32(31) + raw[i:raw.size - n + 1 + i]
+            buckets = (grams * np.uint32(seed)) % np.uint32(self.dims)
+            vector += np.bincount(buckets, minlength=self.dims).astype(np.float32)
+        words = re.findall(r"\w+", text)
+        tokens = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        if tokens:
+            buckets = np.fromiter((zlib.crc32(t.encode("utf-8")) for t in tokens), dtype=np.uint32,
+                                  count=len(tokens)) % np.uint32(self.dims)
+            vector += np.bincount(buckets, minlength=self.dims).astype(np.float32) * self.WORD_WEIGHT
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    @staticmethod
+    def namespace(model: str, system: str, scope: str = "", params: Optional[Dict] = None) -> Tuple[str, str]:
+        """(模型组, system prompt / 调用方 / 参数的摘要)"""
+        if not (system or scope or params):
+            return model, ""
+        blob = json.dumps([system, scope, params or {}], sort_keys=True, default=str)
+        return model, hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+    def lookup(self, namespace: Tuple[str, str], vector) -> Optional[Tuple[str, float]]:
+        """返回 (缓存的回答, 相似度); 未命中返回 None"""
+        index = self._indexes.get(namespace)
+        if index is None:
+            return None
+        scores = index.vectors @ vector
+        row = int(scores.argmax())
+        similarity = float(scores[row])
+        key = index.keys[row]
+        if key is None or similarity < self.threshold:
+            return None
+        answer, stored = self._entries[(namespace, key)]
+        if time.monotonic() - stored > self.ttl:
+            self._evict(namespace, key)
+            return None
+        index.rows.move_to_end(key)
+        self._indexes.move_to_end(namespace)
+        return answer, similarity
+
+    def store(self, namespace: Tuple[str, str], vector, answer: str) -> bool:
+        """写入一条回答; 单条就超过内存上限时不写入, 返回 False"""
+        answer_bytes = self._entry_bytes(answer)
+        if answer_bytes + min(self.INITIAL_ROWS, self.max_entries) * (self.dims * 4 + 8) > self.max_bytes:
+            # 清空整个缓存也放不下, 不为它淘汰其他条目
+            return False
+        index = self._indexes.get(namespace)
+        if index is not None and len(index.rows) >= self.max_entries:
+            self._evict(namespace, next(iter(index.rows)))
+        while self._indexes and self.bytes + self._store_cost(namespace, answer_bytes) > self.max_bytes:
+            oldest = next(iter(self._indexes))
+            self._evict(oldest, next(iter(self._indexes[oldest].rows)))
+        if self.bytes + self._store_cost(namespace, answer_bytes) > self.max_bytes:
+            return False
+
+        # 淘汰之后再取 (或创建) 目标矩阵: 目标命名空间可能刚被整个淘汰
+        index = self._indexes.get(namespace)
+        if index is None:
+            index = self._indexes[namespace] = _SemanticIndex(self.np, self.dims,
+                                                              min(self.INITIAL_ROWS, self.max_entries))
+            self.bytes += self._index_bytes(index)
+        self._indexes.move_to_end(namespace)
+        if not index.free:
+            size = len(index.keys)
+            grown = self._grown_rows(size)
+            self.bytes -= self._index_bytes(index)
+            index.vectors = self.np.concatenate([index.vectors, self.np.zeros((grown - size, self.dims),
+                                                                             dtype=self.np.float32)])
+            index.keys.extend([None] * (grown - size))
+            index.free.extend(range(grown - 1, size - 1, -1))
+            self.bytes += self._index_bytes(index)
+        self._counter += 1
+        key = str(self._counter)
+        row = index.free.pop()
+        index.vectors[row] = vector
+        index.keys[row] = key
+        index.rows[key] = row
+        self._entries[(namespace, key)] = (answer, time.monotonic())
+        self.bytes += answer_bytes
+        return True
+
+    def _grown_rows(self, size: int) -> int:
+        return min(size * 2, self.max_entries)
+
+    def _store_cost(self, namespace: Tuple[str, str], answer_bytes: int) -> int:
+        """写入一条回答新增的内存: 回答 + 需要新建或扩容的矩阵"""
+        index = self._indexes.get(namespace)
+        if index is None:
+            return answer_bytes + min(self.INITIAL_ROWS, self.max_entries) * (self.dims * 4 + 8)
+        if index.free:
+            return answer_bytes
+        return answer_bytes + (self._grown_rows(len(index.keys)) - len(index.keys)) * (self.dims * 4 + 8)
+
+    def _evict(self, namespace: Tuple[str, str], key: str):
+        answer, _ = self._entries.pop((namespace, key))
+        self.bytes -= self._entry_bytes(answer)
+        index = self._indexes[namespace]
+        row = index.rows.pop(key)
+        if not index.rows:
+            # 命名空间已空: 释放整个签名矩阵, 不为不再出现的调用方 / system prompt 保留内存
+            del self._indexes[namespace]
+            self.bytes -= self._index_bytes(index)
+            return
+        index.vectors[row] = 0.0
+        index.keys[row] = None
+        index.free.append(row)
+
+    @staticmethod
+    def _index_bytes(index: _SemanticIndex) -> int:
+        # 签名矩阵 + 每行一个 key 槽位 (指针)
+        return int(index.vectors.nbytes) + 8 * len(index.keys)
+
+    @staticmethod
+    def _entry_bytes(answer: str) -> int:
+        return len(answer.encode("utf-8"))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# ============================================================
+# Embeddings 微批处理
+# ============================================================
+# 参与批次分组并透传给上游的 embeddings 参数 (参数不同的请求不会合并)
+_EMBEDDING_BATCH_PARAMS = ("dimensions", "input_type", "user")
+# /v1/embeddings 的 call_type: proxy 调用 pre-call hook 时为 aembedding
+_EMBEDDING_CALL_TYPES = ("aembedding", "embeddings")
+
+
+def _batchable_embedding(data: Dict) -> Optional[str]:
+    """
+    只合并单条文本输入的请求 (mock_response 只能返回一个向量);
+    token 数组输入和 base64 编码的请求原样发送。返回输入文本, 不可合并时返回 None
+    """
+    text = data.get("input")
+    if isinstance(text, list) and len(text) == 1:
+        text = text[0]
+    if not isinstance(text, str) or not text or data.get("encoding_format") not in (None, "float"):
+        return None
+    return text
+
+
+class _EmbeddingBatch:
+    __slots__ = ("inputs", "futures", "tokens", "timer")
+
+    def __init__(self):
+        self.inputs: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.tokens = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EmbeddingBatcher:
+    """
+    相同批次 key (模型组 + 参数 + 预算归属) 的单条 embeddings 请求在 window 内合并,
+    作为一次上游调用发出, 结果按输入顺序拆回各调用方。
+    批次达到 max_size 条或 max_tokens (估算) 时立即发送, 不等窗口结束。
+    send(key, inputs) 返回与 inputs 等长的向量列表; 失败时异常传给批次内所有调用方。
+    """
+
+    def __init__(self, metrics: VibeMetrics, send: Callable, window_ms: float = 5.0,
+                 max_size: int = 64, max_tokens: int = 8000):
+        self.metrics = metrics
+        self.send = send
+        self.window = window_ms / 1000.0
+        self.max_size = max_size
+        self.max_tokens = max_tokens
+        self._open: Dict[Tuple, _EmbeddingBatch] = {}
+        self._tasks: set = set()
+
+    async def submit(self, key: Tuple, text: str, tokens: int) -> Tuple[List[float], int, float]:
+        """加入批次并等待结果, 返回 (向量, 批次大小, 排队等待秒数)"""
+        loop = asyncio.get_running_loop()
+        batch = self._open.get(key)
+        if batch is not None and batch.tokens + tokens > self.max_tokens:
+            self._flush(key, "tokens")
+            batch = None
+        if batch is None:
+            batch = _EmbeddingBatch()
+            batch.timer = loop.call_later(self.window, self._flush, key, "window")
+            self._open[key] = batch
+        future = loop.create_future()
+        batch.inputs.append(text)
+        batch.futures.append(future)
+        batch.tokens += tokens
+        if len(batch.inputs) >= self.max_size:
+            self._flush(key, "size")
+        enqueued = loop.time()
+        vector, size, dispatched = await future
+        return vector, size, max(0.0, dispatched - enqueued)
+
+    def _flush(self, key: Tuple, reason: str):
+        batch = self._open.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        self.metrics.inc("vibe_embedding_batch_flushes_total", model_group=key[0], reason=reason)
+        task = asyncio.ensure_future(self._dispatch(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, key: Tuple, batch: _EmbeddingBatch):
+        size = len(batch.inputs)
+        dispatched = asyncio.get_running_loop().time()
+        self.metrics.observe("vibe_embedding_batch_size", size, model_group=key[0])
+        started = time.perf_counter()
+        try:
+            vectors = await self.send(key, batch.inputs)
+            if len(vectors) != size:
+                raise ValueError(f"expected {size} embeddings, got {len(vectors)}")
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.metrics.observe("vibe_embedding_batch_upstream_seconds", time.perf_counter() - started,
+                                 model_group=key[0])
+        for future, vector in zip(batch.futures, vectors):
+            if not future.done():
+                future.set_result((vector, size, dispatched))
+
+    def pending(self) -> int:
+        return sum(len(batch.inputs) for batch in self._open.values())
+
+
+# ============================================================
+# 路由状态快照 (容器重启后热启动)
+# ============================================================
+class StateSnapshotter:
+    """
+    定期把路由状态 (EWMA / 健康分 / 限流表 / 亲和绑定) 写入 gzip JSON 文件,
+    启动时读取并按快照年龄衰减。写入先写临时文件再 os.replace, 多 worker 同时写时后写者覆盖。
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str, stats: RoutingStats, affinity: AffinityMap, metrics: VibeMetrics,
+                 interval: float = 30.0, max_age: float = 3600.0, half_life: float = 300.0,
+                 affinity_limit: int = 1000):
+        self.path = path
+        self.stats = stats
+        self.affinity = affinity
+        self.metrics = metrics
+        self.interval = interval
+        self.max_age = max_age
+        self.half_life = half_life
+        self.affinity_limit = affinity_limit
+        self.restored_age: Optional[float] = None
+        # 快照中有延迟统计的 deployment id
+        self.restored_deployments: set = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def save(self):
+        import gzip
+        started = time.perf_counter()
+        state = {"version": self.VERSION, "saved_at": time.time(), "stats": self.stats.export_state(),
+                 "affinity": self.affinity.export_state(self.affinity_limit)}
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        self.metrics.observe("vibe_state_snapshot_seconds", time.perf_counter() - started)
+
+    def restore(self) -> int:
+        """读取快照; 文件不存在 / 版本不符 / 超过 max_age 时不恢复, 返回恢复的条目数"""
+        import gzip
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            _log(f"State snapshot {self.path} unreadable: {e}", "WARN")
+            return 0
+        age = time.time() - float(state.get("saved_at") or 0.0)
+        if state.get("version") != self.VERSION or age > self.max_age:
+            _log(f"State snapshot ignored (version={state.get('version')}, age={age:.0f}s)", "WARN")
+            return 0
+        restored = self.stats.restore_state(state.get("stats") or {}, age, self.half_life)
+        self.affinity.merge_state(state.get("affinity") or {})
+        self.restored_age = age
+        self.restored_deployments = set(((state.get("stats") or {}).get("tables") or {}).get("deployment_latency") or {})
+        return restored
+
+    def is_fresh(self) -> bool:
+        """恢复的快照不超过一个半衰期 (旧值至少保留一半权重)"""
+        return self.restored_age is not None and self.restored_age <= self.half_life
+
+    def ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.save)
+            except Exception as e:
+                self.metrics.inc("vibe_state_snapshot_errors_total")
+                _log(f"State snapshot failed: {e}", "WARN")
+
+
 class VibeIntelligentRouter(CustomLogger):
     """
     智能路由器：
@@ -52,6 +3028,24 @@ class VibeIntelligentRouter(CustomLogger):
         # auto-codex 和 auto-claude 不重写，让 LiteLLM 自己路由
     }
 
+    # 工具循环降级的目标轻量模型组
+    MINI_GROUPS = {
+        "auto-chat": "auto-chat-mini",
+        "auto-claude": "auto-claude-mini",
+        "auto-claude-max": "auto-claude-mini",
+        "auto-codex": "auto-codex-mini",
+    }
+
+    # 工具循环路由策略: off / continuation / continuation+summary
+    TOOL_LOOP_POLICIES = {
+        "off": set(),
+        "continuation": {TURN_TOOL_CONTINUATION},
+        "continuation+summary": {TURN_TOOL_CONTINUATION, TURN_FINAL_SUMMARY},
+    }
+
+    # 同时跟踪的在途请求上限 (超出后淘汰最旧的记录, 防止内存泄漏)
+    MAX_TRACKED_REQUESTS = 10000
+
     def __init__(self):
         super().__init__()
         _log("Initializing VibeIntelligentRouter...")
@@ -73,9 +3067,961 @@ class VibeIntelligentRouter(CustomLogger):
             "concurrent", "distributed", "recursive"
         }
 
+        # 指标注册表
+        self.metrics = VibeMetrics()
+
+        # 重试预算
+        self.retry_budget_enabled = _env_bool("VIBE_RETRY_BUDGET_ENABLED", True)
+        self.retry_budget = RetryBudget(
+            ratio=_env_float("VIBE_RETRY_BUDGET_RATIO", 0.2),
+            window_seconds=_env_float("VIBE_RETRY_BUDGET_WINDOW", 60.0),
+            min_retries=_env_int("VIBE_RETRY_BUDGET_MIN_RETRIES", 10),
+        )
+        self.metrics.register_collector(self._collect_retry_budget_metrics)
+
+        # 复杂度分析时每条消息最多扫描的文本字符数
+        self.content_scan_chars = _env_int("VIBE_CONTENT_SCAN_CHARS", 4000)
+
+        # 上下文窗口感知: 估算 token × 安全系数 超过 max_input_tokens 的层会被跳过
+        self.context_routing_enabled = _env_bool("VIBE_CONTEXT_ROUTING_ENABLED", True)
+        self.token_safety_margin = _env_float("VIBE_TOKEN_SAFETY_MARGIN", 1.1)
+
+        # 路由统计 (EWMA 延迟 / 健康分)
+        self.stats = RoutingStats(
+            alpha=_env_float("VIBE_LATENCY_EWMA_ALPHA", 0.2),
+            health_half_life=_env_float("VIBE_HEALTH_HALF_LIFE", 60.0),
+        )
+        # 健康分低于该值的 deployment 不参与选择 (全部低于时保留全部)
+        self.health_min_score = _env_float("VIBE_HEALTH_MIN_SCORE", 0.2)
+        if not 0.0 <= self.health_min_score < 1.0:
+            # 健康分按半衰期趋近 1 但不会达到 1, 阈值 >= 1 时任何失败过的 deployment 都永远无法恢复
+            _log(f"VIBE_HEALTH_MIN_SCORE={self.health_min_score} out of range [0, 1), using 0.2", "WARNING")
+            self.health_min_score = 0.2
+
+        # 流式响应卡顿检测
+        self.stall_detection_enabled = _env_bool("VIBE_STALL_DETECTION_ENABLED", False)
+        self.stream_ttft_limit = _env_float("VIBE_STREAM_TTFT_LIMIT", 30.0)
+        # 按模型覆盖 TTFT 上限: "gpt-5*=0,*opus*=0,auto-codex=90", 匹配模型组或上游模型名, 0 = 不限
+        # (推理模型首个 chunk 之前的思考时间可能远超默认上限)
+        self.stream_ttft_limits = _parse_limits(_env_str("VIBE_STREAM_TTFT_LIMITS", ""))
+        self.stream_stall_limit = _env_float("VIBE_STREAM_STALL_LIMIT", 60.0)
+        self.stream_max_reissues = _env_int("VIBE_STREAM_MAX_REISSUES", 1)
+
+        # 工具循环感知路由
+        policy = _env_str("VIBE_TOOL_LOOP_POLICY", "off").lower()
+        if policy not in self.TOOL_LOOP_POLICIES:
+            _log(f"Unknown VIBE_TOOL_LOOP_POLICY={policy}, using 'off'", "WARN")
+            policy = "off"
+        self.tool_loop_policy = policy
+        self.tool_loop_models = set(
+            m.strip() for m in _env_str("VIBE_TOOL_LOOP_MODELS", "auto-claude,auto-claude-max,auto-codex").split(",")
+            if m.strip()
+        )
+        # session -> 会话统计 (LRU)
+        self.session_stats_max = _env_int("VIBE_SESSION_STATS_MAX", 2000)
+        self._sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+        # 会话亲和路由
+        self.affinity_enabled = _env_bool("VIBE_AFFINITY_ENABLED", False)
+        self.affinity_prefix_messages = _env_int("VIBE_AFFINITY_PREFIX_MESSAGES", 1)
+        self.affinity = AffinityMap(
+            ttl_seconds=_env_float("VIBE_AFFINITY_TTL", 300.0),
+            max_entries=_env_int("VIBE_AFFINITY_MAX_ENTRIES", 10000),
+        )
+        self.metrics.register_collector(self._collect_affinity_metrics)
+
+        # 成本 / 预算感知路由
+        self.cost_routing_enabled = _env_bool("VIBE_COST_ROUTING_ENABLED", False)
+        self.latency_target_ms = _env_float("VIBE_LATENCY_TARGET_MS", 0.0)
+        self.expected_output_tokens = _env_int("VIBE_EXPECTED_OUTPUT_TOKENS", 500)
+        self.budgets = BudgetTracker(
+            period=_env_str("VIBE_BUDGET_PERIOD", "daily"),
+            default_key_budget=_env_float("VIBE_KEY_BUDGET_USD", 0.0),
+            default_team_budget=_env_float("VIBE_TEAM_BUDGET_USD", 0.0),
+        )
+
+        # Cascade 模式 (opt-in): 先试 -mini 模型组, 低置信度时升级
+        self.cascade_models = set(
+            m.strip() for m in _env_str("VIBE_CASCADE_MODELS", "").split(",") if m.strip()
+        )
+        self.cascade_timeout = _env_float("VIBE_CASCADE_TIMEOUT", 8.0)
+        self.cascade_max_tokens = _env_int("VIBE_CASCADE_MAX_TOKENS", 1024)
+        self.cascade_min_chars = _env_int("VIBE_CASCADE_MIN_CHARS", 20)
+        self.cascade_streaming = _env_bool("VIBE_CASCADE_STREAMING", False)
+        # 平均 logprob 恒 <= 0, 只有负数阈值有意义; 0 (默认) 表示不检查
+        min_logprob = _env_float("VIBE_CASCADE_MIN_AVG_LOGPROB", 0.0)
+        self.cascade_min_avg_logprob = min_logprob if min_logprob < 0 else None
+        self.metrics.register_collector(self._collect_cascade_metrics)
+
+        # 延迟分级: interactive 请求按预计完成时间选层, 并独占有并发上限的 deployment 的一部分槽位
+        self.latency_interactive_ms = _env_float("VIBE_LATENCY_INTERACTIVE_MS", 5000.0)
+        self.interactive_reserve = _env_float("VIBE_INTERACTIVE_RESERVE", 0.25)
+        # deployment id -> 在途请求数; litellm_call_id -> deployment id
+        self.inflight: Dict[str, int] = {}
+        self._inflight_calls: "OrderedDict[str, str]" = OrderedDict()
+        self.metrics.register_collector(self._collect_inflight_metrics)
+
+        # 优先级准入队列: 有并发上限 (max_concurrency / max_parallel_requests) 的层满载时排队,
+        # 超过最大等待时间后降级到其他层, 没有其他层时返回 429
+        self.admission_enabled = _env_bool("VIBE_ADMISSION_ENABLED", False)
+        self.admission_max_wait = _env_float("VIBE_ADMISSION_MAX_WAIT", 2.0)
+        self.admission = AdmissionQueue(
+            weights=_parse_weights(_env_str("VIBE_ADMISSION_WEIGHTS", "high=4,normal=2,low=1")),
+            ticket_ttl=_env_float("VIBE_ADMISSION_TICKET_TTL", 600.0),
+        )
+        self.metrics.register_collector(self._collect_admission_metrics)
+
+        # 上游连接预热: 启动时和定期对每个 api_base 建立并保持连接
+        self.warmer: Optional[ConnectionWarmer] = None
+        if _env_bool("VIBE_PREWARM_ENABLED", False):
+            self.warmer = ConnectionWarmer(
+                self.metrics,
+                interval=_env_float("VIBE_PREWARM_INTERVAL", 30.0),
+                timeout=_env_float("VIBE_PREWARM_TIMEOUT", 5.0),
+            )
+            self.metrics.register_collector(self._collect_upstream_metrics)
+
+        # Bulkhead 隔离: 每个上游 (或每个层) 的并发上限, 满载的上游不再被选中, 慢层不会拖垮其他层
+        self.bulkhead_by = _env_str("VIBE_BULKHEAD_BY", "upstream").lower()
+        self.bulkhead_default_limit = _env_int("VIBE_BULKHEAD_LIMIT", 0)
+        self.bulkhead_limits = {key: int(value) for key, value in
+                                _parse_weights(_env_str("VIBE_BULKHEAD_LIMITS", "")).items()}
+        self.bulkhead = Bulkhead(ttl=_env_float("VIBE_BULKHEAD_TTL", 600.0))
+        # deployment id -> bulkhead
+        self._bulkhead_of: Dict[str, str] = {}
+        if self.bulkhead_default_limit or self.bulkhead_limits:
+            self.metrics.register_collector(self._collect_bulkhead_metrics)
+
+        # 分布式追踪: 配置了导出目标 (文件 / OTLP 端点) 时启用
+        self.tracer: Optional[Tracer] = None
+        trace_file = _env_str("VIBE_TRACE_FILE", "")
+        trace_endpoint = _env_str("VIBE_TRACE_OTLP_ENDPOINT", "")
+        if trace_file or trace_endpoint:
+            self.tracer = Tracer(
+                TraceExporter(self.metrics, file_path=trace_file, endpoint=trace_endpoint,
+                              service_name=_env_str("VIBE_TRACE_SERVICE_NAME", "litellm-vibe-router")),
+                sample_rate=_env_float("VIBE_TRACE_SAMPLE_RATE", 0.01),
+                slow_ms=_env_float("VIBE_TRACE_SLOW_MS", 10000.0),
+            )
+
+        # 事件循环延迟监控 (opt-in): 心跳任务 + 看门狗线程 (阻塞时采样调用栈)
+        self.loop_monitor: Optional[LoopLagMonitor] = None
+        if _env_bool("VIBE_LOOP_MONITOR_ENABLED", False):
+            self.loop_monitor = LoopLagMonitor(
+                self.metrics,
+                interval=_env_float("VIBE_LOOP_MONITOR_INTERVAL", 0.1),
+                threshold_ms=_env_float("VIBE_LOOP_BLOCK_THRESHOLD_MS", 100.0),
+            )
+
+        # 按需 profiler: POST /vibe/profile?seconds=30 触发
+        self.profiler = SamplingProfiler(
+            hz=_env_float("VIBE_PROFILE_HZ", 100.0),
+            max_seconds=_env_float("VIBE_PROFILE_MAX_SECONDS", 300.0),
+        )
+
+        # 语义缓存 (可选, 需要 NumPy): 近似重复的简单 prompt 直接返回缓存的回答
+        self.semantic_cache: Optional[SemanticCache] = None
+        self.semantic_cache_models = set(
+            m.strip() for m in _env_str("VIBE_SEMANTIC_CACHE_MODELS", "auto-chat-mini").split(",") if m.strip()
+        )
+        self.semantic_cache_max_chars = _env_int("VIBE_SEMANTIC_CACHE_MAX_CHARS", 2000)
+        self._semantic_pending: "OrderedDict[str, Tuple[Tuple[str, str], Any]]" = OrderedDict()
+        if _env_bool("VIBE_SEMANTIC_CACHE_ENABLED", False):
+            try:
+                import numpy
+                self.semantic_cache = SemanticCache(
+                    numpy,
+                    threshold=_env_float("VIBE_SEMANTIC_CACHE_THRESHOLD", 0.95),
+                    dims=_env_int("VIBE_SEMANTIC_CACHE_DIMS", 512),
+                    max_entries=_env_int("VIBE_SEMANTIC_CACHE_MAX_ENTRIES", 2000),
+                    max_bytes=_env_int("VIBE_SEMANTIC_CACHE_MAX_MB", 64) * 1024 * 1024,
+                    ttl=_env_float("VIBE_SEMANTIC_CACHE_TTL", 3600.0),
+                )
+                self.metrics.register_collector(self._collect_semantic_cache_metrics)
+            except ImportError:
+                _log("VIBE_SEMANTIC_CACHE_ENABLED requires numpy, semantic cache disabled", "WARN")
+
+        # Embeddings 微批处理 (opt-in): 同一模型组的单条 embeddings 请求在几毫秒内合并为一次上游调用
+        self.embedding_batcher: Optional[EmbeddingBatcher] = None
+        self.embedding_batch_models = set(
+            m.strip() for m in _env_str("VIBE_EMBEDDING_BATCH_MODELS", "").split(",") if m.strip()
+        )
+        if _env_bool("VIBE_EMBEDDING_BATCH_ENABLED", False):
+            self.embedding_batcher = EmbeddingBatcher(
+                self.metrics, self._send_embedding_batch,
+                window_ms=_env_float("VIBE_EMBEDDING_BATCH_WINDOW_MS", 5.0),
+                max_size=_env_int("VIBE_EMBEDDING_BATCH_MAX_SIZE", 64),
+                max_tokens=_env_int("VIBE_EMBEDDING_BATCH_MAX_TOKENS", 8000),
+            )
+            self.metrics.register_collector(self._collect_embedding_batch_metrics)
+
+        # 历史压缩 (opt-in): 工具结果去重 / 截断, 超出 token 预算时丢弃最旧的轮次
+        self.compaction_enabled = _env_bool("VIBE_COMPACTION_ENABLED", False)
+        self.compaction_models = set(
+            m.strip() for m in _env_str("VIBE_COMPACTION_MODELS", ",".join(sorted(set(self.MINI_GROUPS.values()))))
+            .split(",") if m.strip()
+        )
+        # 0 = 按模型组中最小的 max_input_tokens 自动计算
+        self.compaction_max_tokens = _env_int("VIBE_COMPACTION_MAX_TOKENS", 0)
+        self.compaction_keep_recent = _env_int("VIBE_COMPACTION_KEEP_RECENT", 10)
+        self.compaction_tool_max_chars = _env_int("VIBE_COMPACTION_TOOL_MAX_CHARS", 20000)
+
+        # 候选排名索引: 统计变化时增量更新, 请求路径只查表
+        # 过滤后只把排名前 k 个候选交给 router (0 = 全部保留, 由 routing_strategy 在其中选择)
+        self.ranking = CandidateRanking(self.stats, self.health_min_score, self.expected_output_tokens,
+                                        top_k=_env_int("VIBE_RANKING_TOP_K", 0))
+
+        # 编译路由表: 候选链不一致的模型组在构建时被拒绝 (VIBE_ROUTING_TABLE_STRICT=false 时只记录错误)
+        self.metrics.register_collector(self._collect_routing_table_metrics)
+
+        # 上游 429 后该 deployment 暂停参与选择的秒数 (响应带 Retry-After 时以其为准)
+        self.rate_limit_cooldown = _env_float("VIBE_RATE_LIMIT_COOLDOWN", 30.0)
+
+        # 跨 worker 共享路由状态: off / shm (单机多 worker) / redis (多机, 复用 proxy 的 Redis)
+        self.shared_state = self._create_shared_state(_env_str("VIBE_SHARED_STATE", "off").lower())
+
+        # 热启动: 路由状态定期写入快照文件, 启动时恢复; 冷启动阶段通过 vibe_cold_start 指标可见
+        self.started_at = time.monotonic()
+        self.cold_start_samples = _env_int("VIBE_COLD_START_SAMPLES", 20)
+        self.snapshotter = self._create_snapshotter(_env_str("VIBE_STATE_FILE", ""))
+        self.metrics.register_collector(self._collect_cold_start_metrics)
+
+        # vibe_request_id -> 已发起的上游尝试次数
+        self._request_attempts: "OrderedDict[str, int]" = OrderedDict()
+        # vibe_request_id -> 各阶段时间戳 (同一个 dict 也写入 metadata["vibe_timings"])
+        self._request_timings: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+        # 带 metadata.vibe_bench 标签的请求的开销分解, 供 GET /vibe/overhead 汇总
+        self.overhead_samples: deque = deque(maxlen=_env_int("VIBE_OVERHEAD_SAMPLES", 20000))
+
         _log(f"Supported virtual models: {list(self.SIMPLE_TASK_TARGETS.keys())}")
+        if self.cascade_models:
+            _log(f"Cascade mode: models={sorted(self.cascade_models)}, timeout={self.cascade_timeout}s")
+        if self.tool_loop_policy != "off":
+            _log(f"Tool-loop routing: policy={self.tool_loop_policy}, models={sorted(self.tool_loop_models)}")
+        if self.shared_state is not None:
+            _log(f"Shared routing state: backend={self.shared_state.backend.name}, "
+                 f"interval={self.shared_state.interval}s")
+        if self.retry_budget_enabled:
+            _log(f"Retry budget: ratio={self.retry_budget.ratio}, "
+                 f"window={self.retry_budget.window_seconds}s, min={self.retry_budget.min_retries}")
         _log("✓ Router initialized successfully")
 
+    def _create_shared_state(self, backend_name: str) -> Optional[SharedRoutingState]:
+        interval = _env_float("VIBE_SHARED_STATE_INTERVAL", 1.0)
+        stale_seconds = max(10.0, interval * 10)
+        try:
+            if backend_name == "off":
+                return None
+            if backend_name == "shm":
+                backend: SharedStateBackend = SharedMemoryBackend(
+                    segment=_env_str("VIBE_SHARED_STATE_NAME", "vibe_router_state"),
+                    slots=_env_int("VIBE_SHARED_STATE_SLOTS", 16),
+                    slot_bytes=_env_int("VIBE_SHARED_STATE_SLOT_KB", 512) * 1024,
+                    stale_seconds=stale_seconds,
+                )
+            elif backend_name == "redis":
+                backend = RedisStateBackend(prefix=_env_str("VIBE_SHARED_STATE_NAME", "vibe_router_state"),
+                                            stale_seconds=stale_seconds)
+            else:
+                _log(f"Unknown VIBE_SHARED_STATE={backend_name}, shared state disabled", "WARN")
+                return None
+        except Exception as e:
+            _log(f"Shared state backend '{backend_name}' unavailable: {e}", "WARN")
+            return None
+        shared = SharedRoutingState(backend, self.stats, self.affinity, self.metrics, interval=interval,
+                                    affinity_limit=_env_int("VIBE_SHARED_STATE_AFFINITY_LIMIT", 1000))
+        self.metrics.register_collector(self._collect_shared_state_metrics)
+        return shared
+
+    def _create_snapshotter(self, path: str) -> Optional[StateSnapshotter]:
+        if not path:
+            return None
+        snapshotter = StateSnapshotter(
+            path, self.stats, self.affinity, self.metrics,
+            interval=_env_float("VIBE_STATE_SNAPSHOT_INTERVAL", 30.0),
+            max_age=_env_float("VIBE_STATE_MAX_AGE", 3600.0),
+            half_life=_env_float("VIBE_STATE_HALF_LIFE", 300.0),
+        )
+        restored = snapshotter.restore()
+        if restored:
+            _log(f"✓ Restored {restored} routing stats from {path} (age {snapshotter.restored_age:.0f}s)")
+        import atexit
+        atexit.register(self._save_snapshot_on_exit)
+        return snapshotter
+
+    def _save_snapshot_on_exit(self):
+        try:
+            self.snapshotter.save()
+        except Exception as e:
+            _log(f"State snapshot on exit failed: {e}", "WARN")
+
+    def cold_deployments(self) -> List[str]:
+        """路由表中既没有启动后的延迟样本, 也没有被新鲜快照覆盖的 deployment"""
+        table = _routing_table()
+        if table is None:
+            return []
+        snapshotter = self.snapshotter
+        covered = snapshotter.restored_deployments if snapshotter is not None and snapshotter.is_fresh() else set()
+        return [deployment_id for deployment_id in table.by_id
+                if not self.stats.samples.get(deployment_id) and deployment_id not in covered]
+
+    def is_cold(self) -> bool:
+        """
+        冷启动: 启动后观测到的延迟样本数还不足 cold_start_samples, 且没有新鲜快照 /
+        快照过旧 / 快照没有覆盖路由表中的全部 deployment
+        """
+        if sum(self.stats.samples.values()) >= self.cold_start_samples:
+            return False
+        snapshotter = self.snapshotter
+        if snapshotter is None or not snapshotter.is_fresh():
+            return True
+        return bool(self.cold_deployments())
+
+    def _collect_cold_start_metrics(self, metrics: VibeMetrics):
+        metrics.set("vibe_cold_start", 1.0 if self.is_cold() else 0.0)
+        metrics.set("vibe_cold_deployments", len(self.cold_deployments()))
+        metrics.set("vibe_uptime_seconds", time.monotonic() - self.started_at)
+        if self.snapshotter is not None and self.snapshotter.restored_age is not None:
+            metrics.set("vibe_state_restore_age_seconds", self.snapshotter.restored_age)
+
+    def _collect_shared_state_metrics(self, metrics: VibeMetrics):
+        metrics.set("vibe_shared_state_peers", self.shared_state.peers, backend=self.shared_state.backend.name)
+
+    def _collect_admission_metrics(self, metrics: VibeMetrics):
+        if not self.admission_enabled:
+            return
+        for priority in PRIORITY_LEVELS:
+            metrics.set("vibe_admission_queue_depth", self.admission.depth(priority), priority=priority)
+        for deployment_id, capacity in self.admission.capacity.items():
+            metrics.set("vibe_admission_slots_used", self.admission.occupancy.get(deployment_id, 0),
+                        deployment=deployment_id)
+            metrics.set("vibe_admission_slots_total", capacity, deployment=deployment_id)
+
+    async def _admit(self, model: str, deployments: List, metadata: Dict, timeout: float) -> Optional[List]:
+        """
+        候选中有并发上限的层时排队取得槽位, 只返回取得槽位的那个 deployment;
+        等待超时后去掉这些层降级, 没有其他层时返回 None (由调用方拒绝请求)。
+        """
+        scarce = [(d, _deployment_capacity(d)) for d in deployments if _deployment_capacity(d)]
+        if not scarce:
+            return deployments
+        priority = metadata.get("vibe_priority", "normal")
+        started = time.perf_counter()
+        granted = await self.admission.acquire(
+            metadata["vibe_request_id"], [(_deployment_id(d), capacity) for d, capacity in scarce],
+            priority, metadata.get("vibe_flow", "anonymous"), timeout,
+        )
+        waited = time.perf_counter() - started
+        self.metrics.observe("vibe_admission_wait_seconds", waited, priority=priority)
+        if granted is not None:
+            self.metrics.inc("vibe_admission_total", priority=priority,
+                             outcome="immediate" if waited < 0.001 else "queued")
+            return [d for d, _ in scarce if _deployment_id(d) == granted]
+        others = [d for d in deployments if not _deployment_capacity(d)]
+        if others:
+            self.metrics.inc("vibe_admission_total", priority=priority, outcome="fallback")
+            return others
+        self.metrics.inc("vibe_admission_total", priority=priority, outcome="shed")
+        return None
+
+    async def _admission_gate(self, data: Dict):
+        """
+        pre-call hook 中排队: 在 router 选择 deployment 之前等待槽位, 容量不足时在这里返回 429。
+        (在 async_filter_deployments 中抛出的 429 会被 router 当作可重试错误, 负载高时成倍放大尝试次数)
+        """
+        model = data.get("model") or ""
+        deployments = _group_deployments(model)
+        table = _routing_table()
+        if not deployments and table is not None:
+            wildcard = table.match_wildcard(model)
+            deployments = _group_deployments(wildcard) if wildcard else ()
+        if not deployments:
+            return
+        started = time.perf_counter()
+        if await self._admit(model, list(deployments), data["metadata"], self.admission_max_wait) is None:
+            waited = time.perf_counter() - started
+            raise _http_error(429, f"{model} is at capacity (waited {waited:.1f}s); retry later")
+
+    async def _admit_selected(self, model: str, candidates: List, metadata: Dict, attempt: int) -> List:
+        """
+        router 选择时: 已在 pre-call hook 取得槽位且该 deployment 仍在候选中则直接使用;
+        否则 (候选变化 / 重试) 不再排队, 只尝试立即取得槽位, 取不到时返回空列表。
+        插件内部调用不经过 pre-call hook, 首次尝试在这里排队。
+        """
+        request_id = metadata.get("vibe_request_id")
+        held = self.admission.held(request_id)
+        if held is not None and attempt == 1:
+            for deployment in candidates:
+                if _deployment_id(deployment) == held:
+                    return [deployment]
+        if not any(_deployment_capacity(d) for d in candidates):
+            self.admission.release(request_id)
+            return candidates
+        timeout = self.admission_max_wait if attempt == 1 and metadata.get("vibe_internal") else 0.0
+        return await self._admit(model, candidates, metadata, timeout) or []
+
+    def _collect_upstream_metrics(self, metrics: VibeMetrics):
+        """每个上游的在途请求数和连接池使用情况"""
+        inflight: Dict[str, int] = {}
+        for deployment_id, count in self.inflight.items():
+            upstream = self.warmer.deployment_upstream.get(deployment_id)
+            if upstream:
+                inflight[upstream] = inflight.get(upstream, 0) + count
+        for upstream, targets in self.warmer.targets.items():
+            metrics.set("vibe_upstream_inflight", inflight.get(upstream, 0), upstream=upstream)
+            idle = active = 0
+            for _, client in targets:
+                stats = self.warmer.pool_stats(client)
+                if stats:
+                    idle, active = idle + stats[0], active + stats[1]
+            metrics.set("vibe_upstream_pool_connections", idle, upstream=upstream, state="idle")
+            metrics.set("vibe_upstream_pool_connections", active, upstream=upstream, state="active")
+
+    def _collect_semantic_cache_metrics(self, metrics: VibeMetrics):
+        metrics.set("vibe_semantic_cache_entries", len(self.semantic_cache))
+        metrics.set("vibe_semantic_cache_bytes", self.semantic_cache.bytes)
+
+    def _semantic_cache_lookup(self, data: Dict, original_model: str, user_api_key_dict: Any = None):
+        """
+        命中时把缓存的回答作为 mock_response 返回; 未命中时记下签名, 成功后写入缓存。
+        命名空间包含调用方 (API key / team) 和影响回答的请求参数, 不会把一个调用方的回答返回给另一个
+        """
+        prompt = _cacheable_prompt(data, self.semantic_cache_max_chars)
+        if prompt is None:
+            return
+        started = time.perf_counter()
+        vector = self.semantic_cache.signature(prompt[1])
+        if vector is None:
+            return
+        key_id = getattr(user_api_key_dict, "api_key", None) or getattr(user_api_key_dict, "token", None)
+        scope = f"{key_id or ''}|{getattr(user_api_key_dict, 'team_id', None) or ''}"
+        params = {name: data[name] for name in _SEMANTIC_CACHE_PARAMS if data.get(name) is not None}
+        namespace = SemanticCache.namespace(original_model, prompt[0], scope, params)
+        hit = self.semantic_cache.lookup(namespace, vector)
+        self.metrics.observe("vibe_semantic_cache_lookup_seconds", time.perf_counter() - started)
+        self.metrics.inc("vibe_semantic_cache_lookups_total", model_group=original_model,
+                         result="hit" if hit else "miss")
+        metadata = data["metadata"]
+        if hit is None:
+            self._semantic_pending[metadata["vibe_request_id"]] = (namespace, vector)
+            while len(self._semantic_pending) > self.MAX_TRACKED_REQUESTS:
+                self._semantic_pending.popitem(last=False)
+            return
+        answer, similarity = hit
+        data["mock_response"] = answer
+        metadata["vibe_short_circuit"] = "semantic_cache"
+        metadata["vibe_semantic_similarity"] = round(similarity, 4)
+        metadata["virtual_model"] = original_model
+        metadata["routing_reason"] = "semantic_cache_hit"
+        _log(f"Semantic cache hit for {original_model} (similarity={similarity:.3f})")
+
+    def _semantic_cache_store(self, metadata: Dict, response_obj: Any):
+        pending = self._semantic_pending.pop(metadata.get("vibe_request_id"), None)
+        if pending is None:
+            return
+        answer = _cacheable_answer(response_obj)
+        if answer is not None:
+            stored = self.semantic_cache.store(pending[0], pending[1], answer)
+            self.metrics.inc("vibe_semantic_cache_stores_total", model_group=pending[0][0],
+                             result="stored" if stored else "too_large")
+
+    def _collect_embedding_batch_metrics(self, metrics: VibeMetrics):
+        metrics.set("vibe_embedding_batch_pending", self.embedding_batcher.pending())
+
+    async def _batch_embedding(self, data: Dict, original_model: str):
+        """合并成功时把本请求的向量作为 mock_response 返回; 不可合并或批次失败时原样单独发送"""
+        text = _batchable_embedding(data)
+        tokens = _estimate_text_tokens(text) if text is not None else 0
+        if text is None or tokens > self.embedding_batcher.max_tokens or _get_llm_router() is None:
+            self.metrics.inc("vibe_embedding_batch_requests_total", model_group=original_model, result="bypass")
+            return
+        metadata = data["metadata"]
+        key = (original_model, tuple((name, data[name]) for name in _EMBEDDING_BATCH_PARAMS if data.get(name) is not None),
+               metadata.get("vibe_budget_key"), metadata.get("vibe_budget_team"))
+        try:
+            vector, size, waited = await self.embedding_batcher.submit(key, text, tokens)
+        except Exception as e:
+            self.metrics.inc("vibe_embedding_batch_requests_total", model_group=original_model, result="error")
+            _log(f"Embedding batch for {original_model} failed ({type(e).__name__}: {str(e)[:120]}), "
+                 f"sending alone", "WARN")
+            return
+        self.metrics.inc("vibe_embedding_batch_requests_total", model_group=original_model, result="batched")
+        self.metrics.observe("vibe_embedding_batch_wait_seconds", waited, model_group=original_model)
+        data["mock_response"] = vector
+        metadata["vibe_short_circuit"] = "embedding_batch"
+        metadata["vibe_embedding_batch"] = {"size": size, "wait_ms": round(waited * 1000.0, 2)}
+
+    async def _send_embedding_batch(self, key: Tuple, inputs: List[str]) -> List[Any]:
+        """一个批次的上游调用: 经 LiteLLM router (保留重试 / fallback), 花费记到批次的 key / team"""
+        router = _get_llm_router()
+        if router is None:
+            raise RuntimeError("LiteLLM router unavailable")
+        model, params, budget_key, budget_team = key
+        metadata = {"vibe_request_id": uuid.uuid4().hex, "vibe_internal": "embedding_batch",
+                    "vibe_retry_scope": model}
+        if budget_key:
+            metadata["vibe_budget_key"] = budget_key
+        if budget_team:
+            metadata["vibe_budget_team"] = budget_team
+        try:
+            response = await router.aembedding(model=model, input=list(inputs), metadata=metadata, **dict(params))
+        finally:
+            self._finish_request(metadata["vibe_request_id"])
+        items = sorted(response.data, key=lambda item: item["index"] if isinstance(item, dict) else item.index)
+        return [item["embedding"] if isinstance(item, dict) else item.embedding for item in items]
+
+    @staticmethod
+    def _collect_routing_table_metrics(metrics: VibeMetrics):
+        table = _routing_table()
+        if table is None:
+            return
+        metrics.set("vibe_routing_table_groups", len(table.groups))
+        metrics.set("vibe_routing_table_deployments", len(table.by_id))
+        for group in set(table.groups) | set(table.rejected):
+            metrics.set("vibe_routing_table_errors", len(table.errors.get(group, ())), model_group=group)
+
+    def start_background_tasks(self):
+        """启动后台任务 (需要运行中的事件循环; 重复调用无副作用)"""
+        if self.shared_state is not None:
+            self.shared_state.ensure_started()
+        if self.snapshotter is not None:
+            self.snapshotter.ensure_started()
+        if self.warmer is not None:
+            self.warmer.ensure_started()
+        if self.tracer is not None:
+            self.tracer.exporter.ensure_started()
+        if self.loop_monitor is not None:
+            self.loop_monitor.ensure_started()
+
+    def _collect_bulkhead_metrics(self, metrics: VibeMetrics):
+        for key in sorted(set(self._bulkhead_of.values())):
+            limit = self._bulkhead_limit(key)
+            if not limit:
+                continue
+            active = self.bulkhead.active.get(key, 0)
+            metrics.set("vibe_bulkhead_active", active, bulkhead=key)
+            metrics.set("vibe_bulkhead_limit", limit, bulkhead=key)
+            metrics.set("vibe_bulkhead_saturation", active / limit, bulkhead=key)
+
+    def _bulkhead_key(self, deployment: Dict) -> str:
+        """bulkhead 标识: 按上游 (api_base 的 host:port) 或按层 (模型组/L<n>)"""
+        if self.bulkhead_by == "layer":
+            return f"{deployment.get('model_name')}/L{_deployment_info(deployment).get('fallback_order', 1)}"
+        params = deployment.get("litellm_params") or {}
+        api_base = _resolve_env(params.get("api_base"))
+        return _upstream_label(api_base) if api_base else str(params.get("custom_llm_provider") or "default")
+
+    def _bulkhead_limit(self, key: str) -> int:
+        return self.bulkhead_limits.get(key, self.bulkhead_default_limit)
+
+    def _filter_by_bulkhead(self, model: str, deployments: List, metadata: Dict) -> List:
+        """
+        跳过在途请求已达 bulkhead 上限的 deployment (不排队, 直接选下一层);
+        所有候选都满载时保留全部候选, 由选择结束时的槽位预留决定是否拒绝。
+        """
+        available = []
+        for deployment in deployments:
+            key = self._bulkhead_key(deployment)
+            self._bulkhead_of[_deployment_id(deployment)] = key
+            if not self.bulkhead.has_room(key, self._bulkhead_limit(key)):
+                self._count(metadata, "vibe_bulkhead_rejections_total", bulkhead=key)
+                continue
+            available.append(deployment)
+        return available or deployments
+
+    def _reserve_bulkhead(self, model: str, candidates: List, metadata: Dict) -> List:
+        """
+        选择结束时预留槽位 (检查与占用之间没有 await, 并发请求不会同时越过上限):
+        按候选顺序取第一个有空位的 deployment; 先遇到没有上限的候选时不需要预留,
+        把所有没有上限的候选保留给 router 选择。所有候选都满载时返回空列表, 不再向已饱和的上游堆积请求。
+        """
+        request_id = metadata.get("vibe_request_id")
+        for deployment in candidates:
+            key = self._bulkhead_key(deployment)
+            self._bulkhead_of[_deployment_id(deployment)] = key
+            limit = self._bulkhead_limit(key)
+            if not limit:
+                self.bulkhead.release(request_id)
+                return [d for d in candidates if not self._bulkhead_limit(self._bulkhead_key(d))]
+            if self.bulkhead.try_reserve(request_id, key, limit):
+                return [deployment]
+        self.metrics.inc("vibe_bulkhead_saturated_total", model_group=model)
+        _log(f"All upstreams for {model} are saturated, no deployment selected", "WARN")
+        return []
+
+    def _collect_inflight_metrics(self, metrics: VibeMetrics):
+        for deployment_id, count in self.inflight.items():
+            metrics.set("vibe_inflight_requests", count, deployment=deployment_id)
+
+    def _inflight_start(self, kwargs: Dict):
+        call_id = kwargs.get("litellm_call_id")
+        deployment_id = _kwargs_deployment_id(kwargs)
+        if not call_id or not deployment_id or call_id in self._inflight_calls:
+            return
+        self._inflight_calls[call_id] = deployment_id
+        self._adjust_inflight(deployment_id, 1)
+        while len(self._inflight_calls) > self.MAX_TRACKED_REQUESTS:
+            _, stale = self._inflight_calls.popitem(last=False)
+            self._adjust_inflight(stale, -1)
+
+    def _inflight_end(self, kwargs: Dict):
+        deployment_id = self._inflight_calls.pop(kwargs.get("litellm_call_id"), None)
+        if deployment_id is not None:
+            self._adjust_inflight(deployment_id, -1)
+
+    def _adjust_inflight(self, deployment_id: str, delta: int):
+        self.inflight[deployment_id] = max(0, self.inflight.get(deployment_id, 0) + delta)
+
+    def _collect_retry_budget_metrics(self, metrics: VibeMetrics):
+        """渲染指标前计算每个 scope 的剩余令牌和预算消耗比例"""
+        for scope in self.retry_budget.scopes():
+            metrics.set("vibe_retry_budget_tokens", self.retry_budget.tokens(scope), scope=scope)
+            metrics.set("vibe_retry_budget_utilization", self.retry_budget.utilization(scope), scope=scope)
+
+    def _collect_affinity_metrics(self, metrics: VibeMetrics):
+        lookups = {result: metrics.counter("vibe_affinity_lookups_total", result=result)
+                   for result in ("hit", "miss", "broken")}
+        total = sum(lookups.values())
+        metrics.set("vibe_affinity_hit_ratio", lookups["hit"] / total if total else 0.0)
+        metrics.set("vibe_affinity_entries", len(self.affinity))
+
+    async def _apply_budget(self, user_api_key_dict: Any, data: Dict):
+        """读取 key/team 剩余预算写入 metadata; 预算耗尽且模型组没有免费层时拒绝请求"""
+        remaining = await self.budgets.remaining(user_api_key_dict)
+        if not remaining:
+            return
+        metadata = data["metadata"]
+        for scope, (identifier, _) in self.budgets.limits(user_api_key_dict).items():
+            metadata[f"vibe_budget_{scope}"] = identifier
+            self.metrics.set("vibe_budget_remaining_usd", remaining[scope]["remaining_usd"],
+                             scope=scope, id=identifier[:12])
+        left = min(item["remaining_usd"] for item in remaining.values())
+        metadata["vibe_budget_remaining"] = left
+        if left > 0:
+            return
+
+        group = _group_deployments(data.get("model", ""))
+        if group and not any(_estimate_deployment_cost(d, 1, 1) == 0 for d in group):
+            self.metrics.inc("vibe_budget_rejections_total", model_group=data.get("model"))
+            raise self._budget_exceeded(remaining)
+        _log(f"Budget exhausted, restricting {data.get('model')} to free layers", "WARN")
+
+    @staticmethod
+    def _budget_exceeded(remaining: Dict) -> Exception:
+        return _http_error(429, "vibe-router budget exceeded: " + ", ".join(
+            f"{scope} spent ${item['spent_usd']:.4f} of ${item['limit_usd']:.2f}" for scope, item in remaining.items()
+        ))
+
+    def _reconcile_spend(self, kwargs: Dict, response_obj: Any, metadata: Dict) -> float:
+        """按实际 usage 和 deployment 单价计算本次调用花费; 没有单价时退回 LiteLLM 的 response_cost"""
+        usage = getattr(response_obj, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        litellm_params = kwargs.get("litellm_params") or {}
+        prices = _deployment_prices(litellm_params.get("model_info"), litellm_params)
+        if prices is not None:
+            cost = prompt_tokens * prices[0] + completion_tokens * prices[1]
+        else:
+            cost = float(kwargs.get("response_cost") or 0.0)
+        self.metrics.inc("vibe_spend_usd_total", cost, model_group=metadata.get("model_group", "unknown"))
+        return cost
+
+    def _collect_cascade_metrics(self, metrics: VibeMetrics):
+        for virtual_model in self.cascade_models:
+            accepted = metrics.counter("vibe_cascade_total", virtual_model=virtual_model, outcome="accepted")
+            escalated = (metrics.counter("vibe_cascade_total", virtual_model=virtual_model, outcome="escalated")
+                         + metrics.counter("vibe_cascade_total", virtual_model=virtual_model, outcome="error"))
+            total = accepted + escalated
+            metrics.set("vibe_cascade_escalation_ratio", escalated / total if total else 0.0,
+                        virtual_model=virtual_model)
+
+    def _cascade_applies(self, data: Dict, original_model: str, call_type: str) -> bool:
+        return (original_model in self.cascade_models
+                and original_model in self.MINI_GROUPS
+                and call_type in _OPENAI_CHAT_CALL_TYPES
+                and data.get("model") == original_model
+                and bool(data.get("messages"))
+                and "mock_response" not in data
+                and (self.cascade_streaming or not data.get("stream")))
+
+    async def _run_cascade(self, data: Dict, original_model: str):
+        """
+        先用 -mini 模型组 (紧 deadline + token 上限, 不重试) 回答;
+        通过接受检查时把答案作为 mock_response 返回, 否则保持原请求不变走完整链路。
+        """
+        router = _get_llm_router()
+        if router is None:
+            return
+        mini = self.MINI_GROUPS[original_model]
+        metadata = data["metadata"]
+        internal_metadata = {
+            key: metadata[key] for key in ("vibe_estimated_tokens", "vibe_budget_key", "vibe_budget_team",
+                                           "vibe_session", "vibe_budget_remaining")
+            if key in metadata
+        }
+        internal_metadata.update({"vibe_request_id": uuid.uuid4().hex, "vibe_internal": "cascade",
+                                  "vibe_retry_scope": mini})
+        params = {key: data[key] for key in _CASCADE_PASSTHROUGH_PARAMS if key in data}
+        if self.cascade_min_avg_logprob is not None:
+            params["logprobs"] = True
+
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                router.acompletion(model=mini, messages=data["messages"], max_tokens=self.cascade_max_tokens,
+                                   num_retries=0, timeout=self.cascade_timeout, metadata=internal_metadata,
+                                   **params),
+                timeout=self.cascade_timeout,
+            )
+            accepted, reason, content = _cascade_verdict(response, self.cascade_min_chars,
+                                                         self.cascade_min_avg_logprob)
+        except Exception as e:
+            response, accepted, reason, content = None, False, "error", ""
+            _log(f"Cascade: {mini} failed ({type(e).__name__}: {str(e)[:120]}), escalating", "WARN")
+        finally:
+            self._finish_request(internal_metadata["vibe_request_id"])
+        mini_seconds = time.monotonic() - started
+
+        mini_cost = 0.0
+        if response is not None:
+            usage = getattr(response, "usage", None)
+            deployment = _find_deployment((getattr(response, "_hidden_params", None) or {}).get("model_id"), mini)
+            if deployment is not None and usage is not None:
+                mini_cost = _estimate_deployment_cost(deployment, getattr(usage, "prompt_tokens", 0) or 0,
+                                                      getattr(usage, "completion_tokens", 0) or 0) or 0.0
+
+        outcome = "accepted" if accepted else ("error" if reason == "error" else "escalated")
+        self.metrics.inc("vibe_cascade_total", virtual_model=original_model, outcome=outcome)
+        self.metrics.observe("vibe_cascade_mini_seconds", mini_seconds, virtual_model=original_model)
+        metadata["vibe_cascade"] = {"outcome": outcome, "reason": reason, "mini_seconds": round(mini_seconds, 3)}
+
+        # 与“始终使用大模型”对比的净收益: 接受时省下大模型的 EWMA 延迟/花费, 升级时多付 mini 的开销
+        big_latency = self.stats.group_latency.get(original_model)
+        big_cost = self.stats.group_cost.get(original_model)
+        if accepted:
+            if big_latency is not None:
+                self.metrics.observe("vibe_cascade_net_latency_saved_seconds", big_latency - mini_seconds,
+                                     virtual_model=original_model)
+            if big_cost is not None:
+                self.metrics.observe("vibe_cascade_net_cost_saved_usd", big_cost - mini_cost,
+                                 virtual_model=original_model)
+            data["mock_response"] = content
+            metadata["vibe_short_circuit"] = "cascade"
+            metadata["virtual_model"] = original_model
+            metadata["routed_model"] = mini
+            metadata["routing_reason"] = "cascade_accepted"
+            _log(f"Cascade: {original_model} answered by {mini} in {mini_seconds:.2f}s")
+        else:
+            self.metrics.observe("vibe_cascade_net_latency_saved_seconds", -mini_seconds,
+                                 virtual_model=original_model)
+            self.metrics.observe("vibe_cascade_net_cost_saved_usd", -mini_cost, virtual_model=original_model)
+            metadata["virtual_model"] = original_model
+            metadata["routing_reason"] = "cascade_escalated"
+            _log(f"Cascade: escalating {original_model} ({reason}, mini took {mini_seconds:.2f}s)")
+
+    def _session(self, session_key: str) -> Dict[str, Any]:
+        session = self._sessions.pop(session_key, None)
+        if session is None:
+            session = {"turns": {}, "downgraded": 0, "latency_saved_s": 0.0,
+                       "premium_tokens_avoided": 0, "last_seen": 0.0}
+        session["last_seen"] = time.time()
+        self._sessions[session_key] = session
+        while len(self._sessions) > self.session_stats_max:
+            self._sessions.popitem(last=False)
+        return session
+
+    def _apply_tool_loop_routing(self, data: Dict, original_model: str):
+        """Agent 工具循环: 按策略把工具结果续写等轻量轮次路由到对应的 -mini 模型组"""
+        metadata = data["metadata"]
+        turn_type = _classify_turn(data)
+        session_key = _session_key(data)
+        metadata["vibe_turn_type"] = turn_type
+        metadata["vibe_session"] = session_key
+
+        session = self._session(session_key)
+        session["turns"][turn_type] = session["turns"].get(turn_type, 0) + 1
+        self.metrics.inc("vibe_turns_total", virtual_model=original_model, turn_type=turn_type)
+
+        target = self._tool_loop_target(original_model, turn_type)
+        if target is None:
+            return
+
+        data["model"] = target
+        metadata["virtual_model"] = original_model
+        metadata["routed_model"] = target
+        metadata["routing_reason"] = turn_type
+        metadata["selected_model"] = target
+        session["downgraded"] += 1
+        self.metrics.inc("vibe_tool_loop_downgrades_total", virtual_model=original_model, target=target)
+        _log(f"Tool-loop routing: {turn_type} {original_model} → {target} (session={session_key})")
+
+    def _tool_loop_target(self, original_model: str, turn_type: str) -> Optional[str]:
+        """按工具循环策略返回降级目标模型组; 不降级时返回 None"""
+        if original_model not in self.tool_loop_models:
+            return None
+        if turn_type not in self.TOOL_LOOP_POLICIES[self.tool_loop_policy]:
+            return None
+        return self.MINI_GROUPS.get(original_model)
+
+    def _record_tool_loop_savings(self, metadata: Dict, duration: float, prompt_tokens: int):
+        """降级轮次完成后, 与原模型组的 EWMA 延迟对比, 累计会话节省"""
+        virtual_model = metadata.get("virtual_model")
+        session_key = metadata.get("vibe_session")
+        if not virtual_model or not session_key or metadata.get("routed_model") is None:
+            return
+        if metadata.get("routing_reason") not in (TURN_TOOL_CONTINUATION, TURN_FINAL_SUMMARY):
+            return
+
+        session = self._session(session_key)
+        baseline = self.stats.group_latency.get(virtual_model)
+        if baseline is not None:
+            saved = baseline - duration
+            session["latency_saved_s"] += saved
+            self.metrics.observe("vibe_tool_loop_latency_saved_seconds", saved, virtual_model=virtual_model)
+        session["premium_tokens_avoided"] += prompt_tokens
+        self.metrics.inc("vibe_tool_loop_premium_tokens_avoided_total", prompt_tokens, virtual_model=virtual_model)
+
+    def _compaction_budget(self, model: str, metadata: Dict) -> Optional[int]:
+        """输入 token 预算: 显式配置, 或模型组中最小上下文层能容纳的输入 (扣除安全系数和预计输出)"""
+        if self.compaction_max_tokens > 0:
+            return self.compaction_max_tokens
+        limits = [limit for limit in (_deployment_context_limit(d) for d in _group_deployments(model)) if limit]
+        if not limits:
+            return None
+        output_tokens = metadata.get("vibe_expected_output_tokens") or self.expected_output_tokens
+        return int(min(limits) / self.token_safety_margin) - output_tokens
+
+    def _compact_history(self, data: Dict):
+        """长对话压缩: 去重 / 截断工具结果, 仍超出预算时丢弃最旧的轮次; 记录节省的 token"""
+        model = data.get("model")
+        metadata = data["metadata"]
+        before = metadata.get("vibe_estimated_tokens") or _estimate_request_tokens(data)
+        messages, deduped, truncated = _compact_tool_results(data["messages"], self.compaction_tool_max_chars)
+        compacted = {**data, "messages": messages}
+        dropped, dropped_tokens = 0, 0
+        budget = self._compaction_budget(model, metadata)
+        if budget is not None and _estimate_request_tokens(compacted) > budget:
+            # 切点记在会话里: 对话只在末尾追加, 沿用同一切点时保留部分的前缀不变
+            session = self._session(metadata.get("vibe_session") or _session_key(data))
+            fixed = _estimate_request_tokens({**compacted, "messages": []})
+            messages, dropped, dropped_tokens = _drop_oldest_turns(
+                messages, budget - fixed, self.compaction_keep_recent, session.get("compaction_cut"))
+            if dropped:
+                session["compaction_cut"] = dropped
+            compacted["messages"] = messages
+        if not (deduped or truncated or dropped):
+            return
+
+        data["messages"] = messages
+        after = _estimate_request_tokens(compacted)
+        saved = max(0, before - after)
+        if "vibe_estimated_tokens" in metadata:
+            metadata["vibe_estimated_tokens"] = after
+        metadata["vibe_compaction"] = {"tokens_before": before, "tokens_after": after, "deduped": deduped,
+                                       "truncated": truncated, "dropped_messages": dropped}
+        for action, count in (("dedupe", deduped), ("truncate", truncated), ("drop", dropped)):
+            if count:
+                self.metrics.inc("vibe_compaction_actions_total", count, model_group=model, action=action)
+        self.metrics.inc("vibe_compaction_tokens_saved_total", saved, model_group=model)
+        self.metrics.observe("vibe_compaction_tokens_saved", saved, model_group=model)
+        session_key = metadata.get("vibe_session")
+        if session_key:
+            session = self._session(session_key)
+            session["compaction_tokens_saved"] = session.get("compaction_tokens_saved", 0) + saved
+        _log(f"Compaction: {model} {before} → {after} tokens (deduped={deduped}, truncated={truncated}, "
+             f"dropped={dropped} messages / ~{dropped_tokens} tokens)")
+
+    def session_report(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """最近活跃会话的轮次分布与节省情况 (最新的在前)"""
+        report = []
+        for session_key, session in reversed(self._sessions.items()):
+            report.append({"session": session_key, **session,
+                           "latency_saved_s": round(session["latency_saved_s"], 3)})
+            if len(report) >= limit:
+                break
+        return report
+
+    def _track_attempt(self, request_id: str) -> int:
+        """记录一次上游尝试, 返回该请求的尝试序号 (1 = 首次)"""
+        attempts = self._request_attempts.pop(request_id, 0) + 1
+        self._request_attempts[request_id] = attempts
+        while len(self._request_attempts) > self.MAX_TRACKED_REQUESTS:
+            self._request_attempts.popitem(last=False)
+        return attempts
+
+    def _finish_request(self, request_id: Optional[str]):
+        if request_id:
+            self._request_attempts.pop(request_id, None)
+
+    def _stamp(self, metadata: Dict, stage: str, at: Optional[float] = None, overwrite: bool = False):
+        """记录请求经过某个阶段的时间 (time.time(), 与 proxy 的 arrival_time 同一时钟)"""
+        request_id = metadata.get("vibe_request_id")
+        if not request_id:
+            return
+        timings = self._request_timings.get(request_id)
+        if timings is None:
+            timings = metadata.get("vibe_timings")
+            if not isinstance(timings, dict):
+                timings = {}
+            self._request_timings[request_id] = timings
+            metadata["vibe_timings"] = timings
+            while len(self._request_timings) > self.MAX_TRACKED_REQUESTS:
+                self._request_timings.popitem(last=False)
+        if overwrite or stage not in timings:
+            timings[stage] = at if at is not None else time.time()
+
+    # (阶段, 起点时间戳, 终点时间戳)
+    OVERHEAD_STAGES = (
+        ("proxy_setup", "arrival", "pre_call_start"),          # 鉴权 / key 查询 / 别名映射 / 解析请求体
+        ("pre_call_hook", "pre_call_start", "pre_call_end"),
+        ("router_selection", "pre_call_end", "filter_start"),  # LiteLLM router: 模型组、cooldown、健康检查
+        ("vibe_filter", "filter_start", "selected"),
+        ("admission_wait", "selected", "filter_end"),
+        ("request_translation", "filter_end", "pre_api_call"),
+        ("upstream", "pre_api_call", "upstream_end"),
+        ("callback", "upstream_end", "callback_end"),
+    )
+
+    def _record_overhead(self, metadata: Dict, end_time: Any):
+        request_id = metadata.get("vibe_request_id")
+        timings = self._request_timings.pop(request_id, None) if request_id else None
+        if not timings:
+            return
+        timings["upstream_end"] = end_time.timestamp() if hasattr(end_time, "timestamp") else time.time()
+        timings["callback_end"] = time.time()
+        stages = {}
+        for stage, begin, end in self.OVERHEAD_STAGES:
+            if begin in timings and end in timings:
+                stages[stage] = max(0.0, timings[end] - timings[begin])
+                self.metrics.observe("vibe_overhead_seconds", stages[stage], stage=stage)
+        if "upstream" in stages:
+            stages["proxy_total"] = sum(value for stage, value in stages.items() if stage not in ("upstream", "callback"))
+            self.metrics.observe("vibe_overhead_seconds", stages["proxy_total"], stage="proxy_total")
+        run = metadata.get("vibe_bench")
+        if run:
+            self.overhead_samples.append({"run": str(run), "stages": stages})
+
+    def overhead_report(self, run: Optional[str] = None) -> Dict[str, Any]:
+        """按阶段汇总开销分解 (毫秒): 指定 run 时只统计该批 benchmark 请求"""
+        per_stage: Dict[str, List[float]] = {}
+        count = 0
+        for sample in self.overhead_samples:
+            if run and sample["run"] != run:
+                continue
+            count += 1
+            for stage, value in sample["stages"].items():
+                per_stage.setdefault(stage, []).append(value * 1000.0)
+        report = {}
+        for stage, values in per_stage.items():
+            values.sort()
+            report[stage] = {
+                "mean": round(sum(values) / len(values), 3),
+                "p50": round(values[len(values) // 2], 3),
+                "p95": round(values[min(len(values) - 1, int(0.95 * len(values)))], 3),
+                "p99": round(values[min(len(values) - 1, int(0.99 * len(values)))], 3),
+            }
+        return {"run": run, "requests": count, "stages_ms": report}
+
     def _calculate_complexity(self, messages: List[Dict]) -> int:
         """
         计算消息复杂度评分
@@ -88,10 +4034,11 @@ class VibeIntelligentRouter(CustomLogger):
 
         # 分析最后一条消息 (用户的请求)
         last_msg = messages[-1]
-        content = str(last_msg.get("content", "")).lower()
+        features = _walk_content(last_msg.get("content", ""), self.content_scan_chars)
+        content = features.text
 
         # 因子 1: 消息长度 (越长越复杂)
-        content_length = len(content.strip())
+        content_length = features.text_chars if features.truncated else len(content.strip())
         score += min(content_length, 200)  # 上限 200
 
         # 因子 2: 简单指标 (降低分数)
@@ -117,6 +4064,10 @@ class VibeIntelligentRouter(CustomLogger):
         if len(messages) > 5:
             score += 30
 
+        # 因子 7: 多模态内容 (图片/文件 = 复杂)
+        if features.media_parts > 0:
+            score += 50 * min(features.media_parts, 3)
+
         return max(0, score)  # 确保非负
 
     async def async_log_pre_api_call(
@@ -128,6 +4079,10 @@ class VibeIntelligentRouter(CustomLogger):
         """在 API 调用之前记录日志（用于测试 callback 系统）"""
         try:
             _log(f"[PRE_API_CALL] Model: {model}, kwargs model: {kwargs.get('model')}")
+            self._inflight_start(kwargs)
+            self._stamp(_get_metadata(kwargs), "pre_api_call")
+            if self.tracer is not None:
+                self._trace_attempt_start(kwargs)
             
             # 检测是否是 auto-* 模型
             request_model = kwargs.get('model', model)
@@ -181,6 +4136,7 @@ class VibeIntelligentRouter(CustomLogger):
           - 添加用户反馈机制优化算法
         ======================================================================
         """
+        hook_started = time.time()
         try:
             _log(f"Hook triggered - call_type={call_type}")
 
@@ -193,9 +4149,61 @@ class VibeIntelligentRouter(CustomLogger):
             original_model = data.get("model")
             _log(f"Original model: {original_model}")
 
+            # 路由表构建时整个候选链都被拒绝的模型组 (同层重复的上游 / 缺少环境变量) 直接返回 503
+            table = _routing_table()
+            if table is not None and original_model in table.rejected:
+                self.metrics.inc("vibe_routing_table_rejections_total", model_group=original_model)
+                raise _http_error(503, f"vibe-router: invalid fallback chain for {original_model}: "
+                                       + "; ".join(table.rejected[original_model]))
+
             # 添加元数据用于可观察性
             if "metadata" not in data:
                 data["metadata"] = {}
+            data["metadata"].setdefault("vibe_request_id", uuid.uuid4().hex)
+            arrival = (data.get("proxy_server_request") or {}).get("arrival_time")
+            if arrival:
+                self._stamp(data["metadata"], "arrival", arrival)
+            self._stamp(data["metadata"], "pre_call_start", hook_started)
+            trace = None
+            if self.tracer is not None:
+                trace = self.tracer.start(data["metadata"]["vibe_request_id"], data,
+                                          **{"gen_ai.request.model": original_model, "vibe.call_type": call_type})
+                hook_span = trace.span("vibe.pre_call_hook")
+
+            # 延迟分级: x-vibe-latency-class / x-vibe-latency-ms 请求头或 metadata
+            latency_class, latency_budget_ms = _latency_request(data, user_api_key_dict, self.latency_interactive_ms)
+            data["metadata"]["vibe_latency_class"] = latency_class
+            if latency_budget_ms:
+                data["metadata"]["vibe_latency_budget_ms"] = latency_budget_ms
+            self.metrics.inc("vibe_latency_class_requests_total", latency_class=latency_class)
+            if self.admission_enabled:
+                data["metadata"]["vibe_priority"] = _request_priority(data, user_api_key_dict, latency_class)
+                key_id = getattr(user_api_key_dict, "api_key", None) or getattr(user_api_key_dict, "token", None)
+                data["metadata"]["vibe_flow"] = str(key_id or getattr(user_api_key_dict, "user_id", None) or "anonymous")
+
+            # ============================================================
+            # 重试预算：预算耗尽时直接禁用重试，快速失败
+            # ============================================================
+            if self.retry_budget_enabled and original_model:
+                budget_scope = original_model
+                data["metadata"]["vibe_retry_scope"] = budget_scope
+                self.retry_budget.record_request(budget_scope)
+                if not self.retry_budget.has_budget(budget_scope):
+                    data["num_retries"] = 0
+                    data["metadata"]["vibe_retry_budget"] = "exhausted"
+                    self.metrics.inc("vibe_retry_budget_denied_total", scope=budget_scope, stage="admission")
+                    _log(f"Retry budget exhausted for {budget_scope}, failing fast (num_retries=0)", "WARN")
+
+            # ============================================================
+            # Token 估算：供 deployment 过滤时跳过上下文不足的层
+            # ============================================================
+            if self.context_routing_enabled and call_type in _CHAT_CALL_TYPES and data.get("messages"):
+                estimated_tokens = _estimate_request_tokens(data)
+                data["metadata"]["vibe_estimated_tokens"] = estimated_tokens
+                max_output = data.get("max_tokens") or data.get("max_completion_tokens")
+                if max_output:
+                    data["metadata"]["vibe_expected_output_tokens"] = min(int(max_output), self.expected_output_tokens)
+                _log(f"Estimated prompt tokens: {estimated_tokens}")
 
             # ============================================================
             # 路由决策：区分 auto-* 虚拟模型和直接模型请求
@@ -205,6 +4213,12 @@ class VibeIntelligentRouter(CustomLogger):
                 _log(f"Routing: VIRTUAL MODEL (fallback chain: {original_model})")
                 data["metadata"]["routing_mode"] = "virtual_model_fallback"
                 data["metadata"]["selected_model"] = original_model
+                if call_type in _CHAT_CALL_TYPES and data.get("messages"):
+                    self._apply_tool_loop_routing(data, original_model)
+                    if self.affinity_enabled:
+                        fingerprint = _conversation_fingerprint(data, self.affinity_prefix_messages)
+                        if fingerprint:
+                            data["metadata"]["vibe_affinity_key"] = f"{data['model']}:{fingerprint}"
             else:
                 # 非 auto-* 模型：转发到 New API (通过配置文件的通配符)
                 _log(f"Routing: DIRECT MODEL → New API ({original_model})")
@@ -212,6 +4226,62 @@ class VibeIntelligentRouter(CustomLogger):
                 data["metadata"]["selected_model"] = original_model
                 data["metadata"]["target_backend"] = "new-api"
 
+            # ============================================================
+            # 历史压缩：发往 mini / 小上下文层之前压缩长对话 (在亲和指纹之后, 不影响指纹)
+            # ============================================================
+            if self.compaction_enabled and call_type in _CHAT_CALL_TYPES and data.get("messages") \
+                    and data.get("model") in self.compaction_models:
+                self._compact_history(data)
+
+            # ============================================================
+            # 预算：key / team 剩余预算 (花费记录在 DualCache)
+            # ============================================================
+            if self.budgets.cache is None and cache is not None:
+                self.budgets.cache = cache
+            if self.shared_state is not None:
+                if isinstance(self.shared_state.backend, RedisStateBackend) and self.shared_state.backend.redis is None:
+                    self.shared_state.backend.bind(cache)
+            self.start_background_tasks()
+            if user_api_key_dict is not None:
+                await self._apply_budget(user_api_key_dict, data)
+
+            # ============================================================
+            # Embeddings 微批处理：合并为一次上游调用，结果拆回本请求
+            # ============================================================
+            if self.embedding_batcher is not None and call_type in _EMBEDDING_CALL_TYPES \
+                    and "mock_response" not in data \
+                    and (not self.embedding_batch_models or original_model in self.embedding_batch_models):
+                await self._batch_embedding(data, original_model)
+
+            # ============================================================
+            # 语义缓存：近似重复的简单 prompt 直接返回缓存的回答
+            # ============================================================
+            if self.semantic_cache is not None and original_model in self.semantic_cache_models \
+                    and call_type in _CHAT_CALL_TYPES and "mock_response" not in data:
+                self._semantic_cache_lookup(data, original_model, user_api_key_dict)
+
+            # ============================================================
+            # Cascade：先试 mini 模型，通过接受检查则直接返回
+            # ============================================================
+            if self.cascade_models and original_model and self._cascade_applies(data, original_model, call_type):
+                await self._run_cascade(data, original_model)
+
+            # ============================================================
+            # 准入控制：有并发上限的层满载时排队, 超时且没有其他层时返回 429
+            # ============================================================
+            if self.admission_enabled and "mock_response" not in data:
+                await self._admission_gate(data)
+
+            if trace is not None:
+                metadata = data["metadata"]
+                hook_span.end(**{"vibe.routed_model": data.get("model"), "vibe.routing_mode": metadata.get("routing_mode"),
+                                 "vibe.turn_type": metadata.get("vibe_turn_type"),
+                                 "vibe.estimated_tokens": metadata.get("vibe_estimated_tokens"),
+                                 "vibe.latency_class": metadata.get("vibe_latency_class"),
+                                 "vibe.short_circuit": metadata.get("vibe_short_circuit")})
+
+            self._stamp(data["metadata"], "pre_call_end")
+
             # 直接返回原始请求，由 LiteLLM 配置文件路由规则处理
             return data
 
@@ -272,23 +4342,624 @@ class VibeIntelligentRouter(CustomLogger):
             # return data
 
         except Exception as e:
+            if getattr(e, "status_code", None) in (429, 503):
+                if self.tracer is not None:
+                    self.tracer.finish((data.get("metadata") or {}).get("vibe_request_id"), error=True,
+                                       **{"http.response.status_code": e.status_code, "error.type": "rejected"})
+                raise
             _log(f"ERROR in async_pre_call_hook: {str(e)}", "ERROR")
             import traceback
             _log(traceback.format_exc(), "ERROR")
             # 返回未修改的 data 以防止破坏请求
             return data
 
+    async def async_filter_deployments(
+        self,
+        model: str,
+        healthy_deployments: List,
+        messages: Optional[List] = None,
+        request_kwargs: Optional[Dict] = None,
+        parent_otel_span: Optional[Any] = None,
+    ) -> List:
+        """
+        Router 每次选择 deployment (包括每次重试) 之前调用
+
+        重试预算在这里逐次扣减：第 2 次及以后的尝试需要令牌，
+        预算耗尽时返回空列表，截断 fallback 链，不再向上游发请求。
+
+        随后依次应用各个候选过滤阶段 (上下文窗口 ...)。
+        """
+        try:
+            metadata = _get_metadata(request_kwargs)
+            request_id = metadata.get("vibe_request_id")
+            if not request_id:
+                return healthy_deployments
+
+            attempt = self._track_attempt(request_id)
+            if attempt == 1 and metadata.get("vibe_internal") and self.retry_budget_enabled:
+                # 插件内部发起的调用 (cascade / embeddings 批次) 不经过 pre-call hook, 首次尝试在这里计入
+                self.retry_budget.record_request(metadata.get("vibe_retry_scope", model))
+            self._stamp(metadata, "filter_start")
+            trace = self.tracer.get(request_id) if self.tracer is not None else None
+            if trace is not None and attempt > 1:
+                trace.span("vibe.fallback_hop", **{"vibe.attempt": attempt, "vibe.model_group": model,
+                                                   "vibe.candidates": len(healthy_deployments)}).end()
+            if attempt > 1 and self.retry_budget_enabled:
+                scope = metadata.get("vibe_retry_scope", model)
+                if not self.retry_budget.try_acquire_retry(scope):
+                    self.metrics.inc("vibe_retry_budget_denied_total", scope=scope, stage="attempt")
+                    _log(f"Retry budget exhausted for {scope}, cutting fallback chain at attempt {attempt}", "WARN")
+                    return []
+                self.metrics.inc("vibe_retries_total", scope=scope)
+
+            candidates = self._select_deployments(model, healthy_deployments, metadata)
+            self._stamp(metadata, "selected")
+            if self.admission_enabled and candidates:
+                candidates = await self._admit_selected(model, candidates, metadata, attempt)
+            if (self.bulkhead_default_limit or self.bulkhead_limits) and candidates:
+                candidates = self._reserve_bulkhead(model, candidates, metadata)
+            self._stamp(metadata, "filter_end")
+            return candidates
+        except Exception as e:
+            _log(f"Error in async_filter_deployments: {e}", "ERROR")
+            return healthy_deployments
+
+    def _selection_stages(self) -> List[Tuple[str, Callable[[str, List, Dict], List]]]:
+        """候选过滤阶段, 按顺序执行: 先排除不可用的层, 再按偏好缩小范围"""
+        stages = [("rejected", self._filter_rejected), ("excluded", self._filter_excluded),
+                  ("rate_limit", self._filter_rate_limited)]
+        if self.bulkhead_default_limit or self.bulkhead_limits:
+            stages.append(("bulkhead", self._filter_by_bulkhead))
+        if self.health_min_score > 0:
+            stages.append(("health", self._filter_by_health))
+        if self.context_routing_enabled:
+            stages.append(("context", self._filter_by_context))
+        stages.append(("latency", self._filter_by_latency))
+        stages.append(("budget", self._filter_by_budget))
+        if self.affinity_enabled:
+            stages.append(("affinity", self._apply_affinity))
+        if self.cost_routing_enabled:
+            stages.append(("cost", self._apply_cost_routing))
+        return stages
+
+    def _select_deployments(self, model: str, deployments: List, metadata: Dict) -> List:
+        """
+        候选 deployment 过滤流水线; 某阶段过滤后为空时保留该阶段之前的候选。
+        dry-run (explain) 时记录每个阶段后剩余的候选, 且各阶段不产生副作用。
+        """
+        table = _routing_table()
+        if table is not None and table is not self.ranking.table:
+            self.ranking.rebuild(table)
+        candidates = deployments
+        trace = metadata.get("vibe_trace") if metadata.get("vibe_dry_run") else None
+        for name, stage in self._selection_stages():
+            candidates = stage(model, candidates, metadata)
+            if trace is not None:
+                trace.append({"stage": name, "candidates": [_deployment_label(d) for d in candidates]})
+        return self.ranking.order(candidates)
+
+    def _count(self, metadata: Dict, name: str, value: float = 1.0, **labels):
+        """过滤阶段的计数指标; dry-run 请求不计数"""
+        if not metadata.get("vibe_dry_run"):
+            self.metrics.inc(name, value, **labels)
+
+    @staticmethod
+    def _filter_rejected(model: str, deployments: List, metadata: Dict) -> List:
+        """排除路由表构建时拒绝的 deployment (缺少环境变量 / 同层重复的上游); 全部被拒绝时不回退"""
+        table = _routing_table()
+        if table is None or not table.rejected_ids:
+            return deployments
+        return [d for d in deployments if _deployment_id(d) not in table.rejected_ids]
+
+    def _filter_excluded(self, model: str, deployments: List, metadata: Dict) -> List:
+        """排除本请求明确不再使用的 deployment (例如流卡顿后重发)"""
+        excluded = metadata.get("vibe_exclude_deployments")
+        if not excluded:
+            return deployments
+        return [d for d in deployments if _deployment_id(d) not in excluded] or deployments
+
+    def _filter_rate_limited(self, model: str, deployments: List, metadata: Dict) -> List:
+        """跳过近期返回 429 的 deployment (限流表可能来自其他 worker)"""
+        now = time.monotonic()
+        available = [d for d in deployments if not self.stats.is_rate_limited(_deployment_id(d), now)]
+        if available and len(available) < len(deployments):
+            self._count(metadata, "vibe_rate_limit_skips_total", len(deployments) - len(available), model_group=model)
+        return available or deployments
+
+    def _filter_by_health(self, model: str, deployments: List, metadata: Dict) -> List:
+        """跳过健康分过低 (近期频繁失败 / 流卡顿) 的 deployment"""
+        now = time.monotonic()
+        healthy = [d for d in deployments if self.ranking.is_healthy(_deployment_id(d), now)]
+        if healthy and len(healthy) < len(deployments):
+            self._count(metadata, "vibe_health_skips_total", len(deployments) - len(healthy), model_group=model)
+        return healthy or deployments
+
+    def _reserved_for_interactive(self, deployment: Dict) -> bool:
+        """有并发上限的 deployment 保留 interactive_reserve 比例的槽位, 非 interactive 请求不能占用"""
+        capacity = _deployment_capacity(deployment)
+        if not capacity or self.interactive_reserve <= 0:
+            return False
+        reserved = max(1, round(capacity * self.interactive_reserve))
+        return self.inflight.get(_deployment_id(deployment), 0) >= capacity - reserved
+
+    def _filter_by_latency(self, model: str, deployments: List, metadata: Dict) -> List:
+        """
+        - 非 interactive 请求不占用为 interactive 保留的槽位
+        - 有延迟预算时只保留预计完成时间在预算内的层 (没有统计的层视为满足, 以便探索);
+          都不满足时只保留预计最快的层
+        """
+        latency_class = metadata.get("vibe_latency_class", LATENCY_STANDARD)
+        candidates = deployments
+        if latency_class != LATENCY_INTERACTIVE:
+            unreserved = [d for d in candidates if not self._reserved_for_interactive(d)]
+            if unreserved and len(unreserved) < len(candidates):
+                self._count(metadata, "vibe_interactive_reserve_skips_total", len(candidates) - len(unreserved),
+                            model_group=model, latency_class=latency_class)
+            candidates = unreserved or candidates
+
+        budget_ms = metadata.get("vibe_latency_budget_ms")
+        if not budget_ms or len(candidates) <= 1:
+            return candidates
+        output_tokens = metadata.get("vibe_expected_output_tokens") or self.expected_output_tokens
+        predicted = [(self.stats.predict_seconds(_deployment_id(d), output_tokens), d) for d in candidates]
+        fits = [d for seconds, d in predicted if seconds is None or seconds * 1000.0 <= budget_ms]
+        if fits:
+            return fits
+        self._count(metadata, "vibe_latency_budget_misses_total", model_group=model, latency_class=latency_class)
+        fastest = min(seconds for seconds, _ in predicted)
+        return [d for seconds, d in predicted if seconds <= fastest]
+
+    def _request_cost(self, deployment: Dict, metadata: Dict) -> Optional[float]:
+        return _estimate_deployment_cost(deployment, metadata.get("vibe_estimated_tokens") or 0,
+                                         metadata.get("vibe_expected_output_tokens") or self.expected_output_tokens)
+
+    def _filter_by_budget(self, model: str, deployments: List, metadata: Dict) -> List:
+        """只保留预计花费不超过剩余预算的层 (免费层始终保留)"""
+        if "vibe_budget_remaining" not in metadata:
+            return deployments
+        remaining = metadata["vibe_budget_remaining"]
+        affordable = []
+        for deployment in deployments:
+            cost = self._request_cost(deployment, metadata)
+            if cost is None or cost <= 0 or cost <= remaining:
+                affordable.append(deployment)
+        if not affordable and remaining <= 0:
+            # 预算已耗尽: 返回空列表让 router 快速失败, 不产生新的花费
+            _log(f"Budget exhausted and no free layer left in {model}", "WARN")
+            return []
+        return affordable or deployments
+
+    def _apply_cost_routing(self, model: str, deployments: List, metadata: Dict) -> List:
+        """在满足延迟目标的层中选择预计花费最低的层 (同价的层都保留, 由 router 打散)"""
+        if len(deployments) <= 1:
+            return deployments
+        candidates = deployments
+        if self.latency_target_ms > 0:
+            target_s = self.latency_target_ms / 1000.0
+            fast = [d for d in deployments
+                    if self.stats.deployment_latency.get(_deployment_id(d), 0.0) <= target_s]
+            candidates = fast or deployments
+
+        priced = [(self._request_cost(d, metadata), d) for d in candidates]
+        known = [cost for cost, _ in priced if cost is not None]
+        if not known:
+            return candidates
+        cheapest = min(known)
+        chosen = [d for cost, d in priced if cost is not None and cost <= cheapest + 1e-12]
+        self._count(metadata, "vibe_cost_routing_decisions_total", model_group=model,
+                    deployment=_deployment_label(chosen[0]))
+        return chosen
+
+    @staticmethod
+    def _on_preferred_layer(model_group: Optional[str], deployment_id: str) -> bool:
+        """
+        deployment 是否在模型组的首选层 (最小 fallback_order)。
+        只绑定到首选层: 一次 fallback 落到付费的 L3/L4 后, 会话不会因为每次成功都续期而一直留在那里
+        """
+        table = _routing_table()
+        entries = table.entries.get(model_group or "") if table is not None else None
+        if not entries:
+            return False
+        return any(e.id == deployment_id and e.layer == entries[0].layer for e in entries)
+
+    def _apply_affinity(self, model: str, deployments: List, metadata: Dict) -> List:
+        """
+        对话已绑定 deployment 且其仍在候选中时, 只返回该 deployment。
+        绑定的 deployment 不在候选中 (cooldown / 上下文不足) 时解除绑定, 正常选择。
+        """
+        key = metadata.get("vibe_affinity_key")
+        if not key:
+            return deployments
+        dry_run = metadata.get("vibe_dry_run")
+        pinned = self.affinity.peek(key) if dry_run else self.affinity.get(key)
+        if pinned is None:
+            self._count(metadata, "vibe_affinity_lookups_total", result="miss")
+            return deployments
+        for deployment in deployments:
+            if _deployment_id(deployment) == pinned:
+                self._count(metadata, "vibe_affinity_lookups_total", result="hit")
+                return [deployment]
+        if dry_run:
+            return deployments
+        self.affinity.unpin(key, pinned)
+        self._count(metadata, "vibe_affinity_lookups_total", result="broken")
+        _log(f"Affinity pin for {model} broken: deployment {pinned} unavailable")
+        return deployments
+
+    def _filter_by_context(self, model: str, deployments: List, metadata: Dict) -> List:
+        """跳过上下文窗口放不下本次请求的层, 避免 400 错误浪费一次 fallback"""
+        estimated_tokens = metadata.get("vibe_estimated_tokens")
+        if not estimated_tokens:
+            return deployments
+
+        needed = estimated_tokens * self.token_safety_margin
+        fitting = []
+        for deployment in deployments:
+            limit = _deployment_context_limit(deployment)
+            if limit is not None and limit < needed:
+                self._count(metadata, "vibe_context_skips_total", model_group=model,
+                            deployment=_deployment_label(deployment))
+                continue
+            fitting.append(deployment)
+
+        if not fitting:
+            _log(f"No deployment in {model} fits ~{estimated_tokens} tokens, keeping all candidates", "WARN")
+            return deployments
+        if len(fitting) < len(deployments):
+            _log(f"Context routing: {len(deployments) - len(fitting)} layer(s) of {model} "
+                 f"skipped for ~{estimated_tokens} tokens")
+        return fitting
+
+    async def explain_route(self, request: Dict, user_api_key_dict: Any = None) -> Dict[str, Any]:
+        """
+        Dry-run 路由解释: 复用 hook 与候选过滤流水线的判定逻辑, 但不调用任何上游,
+        不修改重试预算 / 会话 / 亲和 / 指标等状态。
+        """
+        data = {key: value for key, value in request.items() if key != "metadata"}
+        latency_class, latency_budget_ms = _latency_request(request, user_api_key_dict, self.latency_interactive_ms)
+        metadata: Dict[str, Any] = {"vibe_dry_run": True, "vibe_trace": [], "vibe_latency_class": latency_class}
+        if latency_budget_ms:
+            metadata["vibe_latency_budget_ms"] = latency_budget_ms
+        data["metadata"] = metadata
+        original_model = data.get("model") or ""
+        messages = data.get("messages") or []
+
+        features: Dict[str, Any] = {"messages": len(messages)}
+        turn_type = None
+        if messages:
+            last = messages[-1] if isinstance(messages[-1], dict) else {}
+            content = _walk_content(last.get("content"), self.content_scan_chars)
+            turn_type = _classify_turn(data)
+            estimated_tokens = _estimate_request_tokens(data)
+            metadata["vibe_estimated_tokens"] = estimated_tokens
+            max_output = data.get("max_tokens") or data.get("max_completion_tokens")
+            if max_output:
+                metadata["vibe_expected_output_tokens"] = min(int(max_output), self.expected_output_tokens)
+            features.update({
+                "complexity_score": self._calculate_complexity(messages),
+                "estimated_tokens": estimated_tokens,
+                "text_chars": content.text_chars,
+                "media_parts": content.media_parts,
+                "tool_results": content.tool_results,
+                "turn_type": turn_type,
+            })
+
+        target = original_model
+        reason = "virtual_model_fallback" if original_model.startswith("auto-") else "passthrough_to_new_api"
+        if original_model.startswith("auto-") and turn_type:
+            downgrade = self._tool_loop_target(original_model, turn_type)
+            if downgrade:
+                target, reason = downgrade, turn_type
+
+        affinity = None
+        if self.affinity_enabled and messages:
+            fingerprint = _conversation_fingerprint(data, self.affinity_prefix_messages)
+            if fingerprint:
+                metadata["vibe_affinity_key"] = f"{target}:{fingerprint}"
+                affinity = {"key": metadata["vibe_affinity_key"],
+                            "pinned_deployment": self.affinity.peek(metadata["vibe_affinity_key"])}
+
+        budgets = await self.budgets.remaining(user_api_key_dict) if user_api_key_dict is not None else {}
+        if budgets:
+            metadata["vibe_budget_remaining"] = min(item["remaining_usd"] for item in budgets.values())
+
+        router = _get_llm_router()
+        table = _routing_table()
+        deployments = _group_deployments(target)
+        wildcard = None
+        if not deployments and table is not None:
+            wildcard = table.match_wildcard(target)
+            deployments = _group_deployments(wildcard) if wildcard else ()
+        cooldown = await _get_cooldown_ids(router)
+        available = [d for d in deployments if not cooldown or _deployment_id(d) not in cooldown]
+        chosen = self._select_deployments(wildcard or target, available, metadata) if available else []
+        chosen_ids = {_deployment_id(d) for d in chosen}
+
+        now = time.monotonic()
+        candidates = []
+        for deployment in sorted(deployments, key=lambda d: _deployment_info(d).get("fallback_order", 1)):
+            deployment_id = _deployment_id(deployment)
+            params = deployment.get("litellm_params") or {}
+            limit = _deployment_context_limit(deployment)
+            estimated = metadata.get("vibe_estimated_tokens")
+            candidates.append({
+                "id": deployment_id,
+                "label": _deployment_label(deployment),
+                "layer": _deployment_info(deployment).get("fallback_order", 1),
+                "upstream_model": params.get("model"),
+                "api_base": params.get("api_base"),
+                "context_limit": limit,
+                "fits_context": None if limit is None or not estimated else estimated * self.token_safety_margin <= limit,
+                "estimated_cost_usd": self._request_cost(deployment, metadata),
+                "health": round(self.stats.health_score(deployment_id, now), 3),
+                "ewma_latency_s": self.stats.deployment_latency.get(deployment_id),
+                "ewma_ttft_s": self.stats.deployment_ttft.get(deployment_id),
+                "predicted_s": self.stats.predict_seconds(
+                    deployment_id, metadata.get("vibe_expected_output_tokens") or self.expected_output_tokens),
+                "inflight": self.inflight.get(deployment_id, 0),
+                "in_cooldown": None if cooldown is None else deployment_id in cooldown,
+                "rate_limited": self.stats.is_rate_limited(deployment_id, now),
+                "eligible": deployment_id in chosen_ids,
+            })
+
+        scope = original_model
+        return {
+            "virtual_model": original_model,
+            "routed_model": target,
+            "routing_reason": reason,
+            "latency_class": latency_class,
+            "latency_budget_ms": latency_budget_ms,
+            "wildcard_group": wildcard,
+            "features": features,
+            "affinity": affinity,
+            "budgets": budgets,
+            "retry_budget_tokens": {
+                "scope": round(self.retry_budget.tokens(scope), 2),
+                "global": round(self.retry_budget.tokens(RetryBudget.GLOBAL_SCOPE), 2),
+            } if self.retry_budget_enabled and scope else None,
+            "cascade": self._cascade_applies(data, original_model, "acompletion") if self.cascade_models else False,
+            "candidates": candidates,
+            "selection_trace": metadata["vibe_trace"],
+            # router 在剩余候选中按 routing_strategy 选择; 只剩一个时即为最终 deployment
+            "chosen_deployment": _deployment_label(chosen[0]) if len(chosen) == 1 else None,
+        }
+
+    async def async_post_call_streaming_iterator_hook(self, user_api_key_dict, response, request_data: Dict):
+        """
+        包装流式响应，检测卡顿:
+        - 首个 chunk 超过 TTFT 上限未到达: 排除该 deployment 重新发起请求 (客户端尚未收到任何内容)
+        - 中途两个 chunk 间隔超过卡顿上限: 中止流并返回明确的错误, 不再等到 request_timeout
+        卡顿次数计入 deployment 健康分。
+        流结束、出错或被客户端取消时都归还 bulkhead 槽位。
+        """
+        request_id = ((request_data or {}).get("metadata") or {}).get("vibe_request_id")
+        try:
+            stream = self._watch_stream(response, request_data) if self.stall_detection_enabled else response
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self.bulkhead.release(request_id)
+
+    async def _watch_stream(self, response: Any, request_data: Dict):
+        metadata = (request_data or {}).get("metadata") or {}
+        model_group = metadata.get("model_group") or (request_data or {}).get("model")
+        deployment_id = _response_deployment_id(response)
+        iterator = response.__aiter__()
+        started = time.monotonic()
+        last_chunk = started
+        sent = 0
+        reissues = 0
+        ttft_limit = self._stream_ttft_limit(model_group, deployment_id)
+
+        while True:
+            limit = ttft_limit if sent == 0 else self.stream_stall_limit
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), timeout=limit)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                phase = "ttft" if sent == 0 else "mid_stream"
+                self._record_stall(deployment_id, model_group, phase)
+                await self._close_stream(iterator)
+                if sent == 0 and reissues < self.stream_max_reissues:
+                    reissues += 1
+                    replacement = await self._reissue_stream(request_data, deployment_id)
+                    if replacement is not None:
+                        deployment_id = _response_deployment_id(replacement)
+                        ttft_limit = self._stream_ttft_limit(model_group, deployment_id)
+                        iterator = replacement.__aiter__()
+                        started = last_chunk = time.monotonic()
+                        continue
+                raise _http_error(504, f"vibe-router: upstream stream stalled ({phase}, "
+                                       f"no data for {limit:g}s after {sent} chunks)")
+
+            now = time.monotonic()
+            if sent == 0:
+                ttft = now - started
+                self.stats.observe_ttft(deployment_id, ttft)
+                self.metrics.observe("vibe_stream_ttft_seconds", ttft, model_group=model_group or "unknown")
+            else:
+                self.metrics.observe("vibe_stream_chunk_gap_seconds", now - last_chunk,
+                                     model_group=model_group or "unknown")
+            last_chunk = now
+            sent += 1
+            yield chunk
+
+    def _stream_ttft_limit(self, model_group: Optional[str], deployment_id: Optional[str]) -> Optional[float]:
+        """首个 chunk 的等待上限 (秒); 按模型覆盖为 0 时返回 None (不限)"""
+        if self.stream_ttft_limits:
+            deployment = _find_deployment(deployment_id)
+            upstream = str(((deployment or {}).get("litellm_params") or {}).get("model") or "")
+            for pattern, limit in self.stream_ttft_limits.items():
+                if fnmatch.fnmatchcase(model_group or "", pattern) or (upstream and fnmatch.fnmatchcase(upstream, pattern)):
+                    return limit or None
+        return self.stream_ttft_limit or None
+
+    def _record_stall(self, deployment_id: Optional[str], model_group: Optional[str], phase: str):
+        deployment = _find_deployment(deployment_id)
+        label = _deployment_label(deployment) if deployment else (deployment_id or "unknown")
+        self.stats.record_outcome(deployment_id, ok=False, weight=2)
+        self.metrics.inc("vibe_stream_stalls_total", deployment=label, phase=phase)
+        _log(f"Stream stall detected: {label} ({phase}) in {model_group}", "WARN")
+
+    @staticmethod
+    async def _close_stream(iterator: Any):
+        close = getattr(iterator, "aclose", None)
+        if close is None:
+            return
+        try:
+            await close()
+        except Exception:
+            pass
+
+    async def _reissue_stream(self, request_data: Dict, stalled_deployment: Optional[str]) -> Optional[Any]:
+        """排除卡顿的 deployment, 用同一请求重新发起流式调用"""
+        router = _get_llm_router()
+        if router is None or not request_data.get("messages"):
+            return None
+        metadata = dict(request_data.get("metadata") or {})
+        excluded = list(metadata.get("vibe_exclude_deployments") or [])
+        if stalled_deployment:
+            excluded.append(stalled_deployment)
+        metadata.update({"vibe_request_id": uuid.uuid4().hex, "vibe_exclude_deployments": excluded})
+        metadata.pop("vibe_affinity_key", None)
+        params = {key: request_data[key] for key in _REISSUE_PARAMS if key in request_data}
+        try:
+            response = await router.acompletion(model=request_data.get("model"), messages=request_data["messages"],
+                                                stream=True, metadata=metadata, **params)
+        except Exception as e:
+            _log(f"Stream re-issue failed: {type(e).__name__}: {str(e)[:120]}", "ERROR")
+            return None
+        self.metrics.inc("vibe_stream_reissues_total", model_group=request_data.get("model"))
+        _log(f"Stream re-issued for {request_data.get('model')} excluding {stalled_deployment}", "WARN")
+        return response
+
+    def _observe_generation(self, kwargs: Dict, response_obj: Any, deployment_id: Optional[str],
+                            start_time: Any, end_time: Any):
+        """记录输出吞吐; 流式请求用 completion_start_time 扣除首 token 等待"""
+        usage = getattr(response_obj, "usage", None)
+        output_tokens = getattr(usage, "completion_tokens", 0) or 0
+        first_token = kwargs.get("completion_start_time")
+        generation_start = start_time
+        if kwargs.get("stream") and first_token and first_token > start_time:
+            generation_start = first_token
+        try:
+            generation_seconds = (end_time - generation_start).total_seconds()
+        except (TypeError, AttributeError):
+            return
+        self.stats.observe_throughput(deployment_id, output_tokens, generation_seconds)
+
+    def _trace_attempt_start(self, kwargs: Dict):
+        metadata = _get_metadata(kwargs)
+        trace = self.tracer.get(metadata.get("vibe_request_id"))
+        call_id = kwargs.get("litellm_call_id")
+        if trace is None or not call_id or call_id in trace.attempts:
+            return
+        litellm_params = kwargs.get("litellm_params") or {}
+        model_info = litellm_params.get("model_info") or {}
+        api_base = _resolve_env(litellm_params.get("api_base"))
+        trace.attempts[call_id] = trace.span("vibe.upstream_attempt", **{
+            "vibe.deployment_id": _kwargs_deployment_id(kwargs),
+            "vibe.model_group": metadata.get("model_group"),
+            "vibe.layer": model_info.get("fallback_order"),
+            "gen_ai.request.model": kwargs.get("model"),
+            "server.address": _upstream_label(api_base) if api_base else None,
+            "vibe.stream": bool(kwargs.get("stream")),
+        })
+
+    def _trace_attempt_end(self, kwargs: Dict, response_obj: Any, start_time: Any, error: Optional[Any] = None):
+        """结束上游尝试 span: 状态码 / 错误类型 / TTFT / token 数 / 响应字节数"""
+        metadata = _get_metadata(kwargs)
+        trace = self.tracer.get(metadata.get("vibe_request_id"))
+        span = trace.attempts.pop(kwargs.get("litellm_call_id"), None) if trace is not None else None
+        if span is None:
+            return
+        if error is not None:
+            span.end(error=True, **{"error.type": type(error).__name__,
+                                    "http.response.status_code": getattr(error, "status_code", None)})
+            return
+        attributes: Dict[str, Any] = {"http.response.status_code": 200}
+        first_token = kwargs.get("completion_start_time")
+        if first_token and start_time and first_token > start_time:
+            attributes["vibe.ttft_ms"] = round((first_token - start_time).total_seconds() * 1000.0, 1)
+        usage = getattr(response_obj, "usage", None)
+        attributes["gen_ai.usage.input_tokens"] = getattr(usage, "prompt_tokens", None)
+        attributes["gen_ai.usage.output_tokens"] = getattr(usage, "completion_tokens", None)
+        attributes["gen_ai.response.model"] = getattr(response_obj, "model", None)
+        try:
+            content = response_obj.choices[0].message.content or ""
+            attributes["vibe.response_bytes"] = len(content.encode("utf-8"))
+        except (AttributeError, IndexError, TypeError):
+            pass
+        span.end(**attributes)
+
+    async def async_post_call_failure_hook(self, request_data: Dict, original_exception: Exception,
+                                           user_api_key_dict: Any, *args, **kwargs):
+        """整个请求最终失败 (所有 fallback 用尽) 时结束追踪, 丢弃尝试计数和阶段计时"""
+        request_id = (request_data.get("metadata") or {}).get("vibe_request_id")
+        self._finish_request(request_id)
+        self._request_timings.pop(request_id, None)
+        self.admission.release(request_id)
+        self.bulkhead.release(request_id)
+        if self.tracer is not None:
+            self.tracer.finish(request_id, error=True, **{
+                "error.type": type(original_exception).__name__,
+                "http.response.status_code": getattr(original_exception, "status_code", None)})
+
     async def async_log_success_event(self, kwargs, response_obj, start_time, end_time):
         """记录成功的路由"""
         try:
             model = kwargs.get("model", "unknown")
-            metadata = kwargs.get("metadata", {})
+            metadata = _get_metadata(kwargs)
             virtual_model = metadata.get("virtual_model")
+            self._finish_request(metadata.get("vibe_request_id"))
+            self._inflight_end(kwargs)
+            self.admission.release(metadata.get("vibe_request_id"))
+            self.bulkhead.release(metadata.get("vibe_request_id"))
+            if self.tracer is not None:
+                self._trace_attempt_end(kwargs, response_obj, start_time)
+                self.tracer.finish(metadata.get("vibe_request_id"), **{
+                    "gen_ai.response.model": getattr(response_obj, "model", None),
+                    "vibe.deployment_id": _kwargs_deployment_id(kwargs)})
+            duration = (end_time - start_time).total_seconds()
+            if self.semantic_cache is not None:
+                self._semantic_cache_store(metadata, response_obj)
+            if metadata.get("vibe_short_circuit"):
+                # mock_response 返回的结果: 没有上游调用, 不计入延迟/花费统计
+                _log(f"✓ SHORT-CIRCUIT: {virtual_model or model} ({metadata['vibe_short_circuit']})")
+                return
+            deployment_id = _kwargs_deployment_id(kwargs)
+            self.stats.observe_latency(metadata.get("model_group"), deployment_id, duration)
+            self.stats.record_outcome(deployment_id, ok=True)
+            self._observe_generation(kwargs, response_obj, deployment_id, start_time, end_time)
+            latency_class = metadata.get("vibe_latency_class")
+            if latency_class:
+                self.metrics.observe("vibe_request_latency_seconds", duration, latency_class=latency_class)
+                budget_ms = metadata.get("vibe_latency_budget_ms")
+                if budget_ms and duration * 1000.0 > budget_ms:
+                    self.metrics.inc("vibe_latency_budget_exceeded_total", latency_class=latency_class)
+            if self.affinity_enabled and deployment_id and metadata.get("vibe_affinity_key") \
+                    and self._on_preferred_layer(metadata.get("model_group"), deployment_id):
+                self.affinity.pin(metadata["vibe_affinity_key"], deployment_id)
+
+            cost = self._reconcile_spend(kwargs, response_obj, metadata)
+            self.stats.observe_cost(metadata.get("model_group"), cost)
+            for scope in ("key", "team"):
+                identifier = metadata.get(f"vibe_budget_{scope}")
+                if identifier:
+                    await self.budgets.record(scope, identifier, cost)
+            session_key = metadata.get("vibe_session")
+            if session_key:
+                session = self._session(session_key)
+                session["spend_usd"] = session.get("spend_usd", 0.0) + cost
 
             if virtual_model:
-                duration = (end_time - start_time).total_seconds()
+                usage = getattr(response_obj, "usage", None)
+                prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+                self._record_tool_loop_savings(metadata, duration, prompt_tokens)
                 routing_reason = metadata.get("routing_reason", "default")
                 _log(f"✓ SUCCESS: {virtual_model} -> {model} ({duration:.2f}s, reason={routing_reason})")
+            self._record_overhead(metadata, end_time)
         except Exception as e:
             _log(f"Error in success logger: {e}", "ERROR")
 
@@ -296,9 +4967,22 @@ class VibeIntelligentRouter(CustomLogger):
         """记录失败的路由"""
         try:
             model = kwargs.get("model", "unknown")
-            metadata = kwargs.get("metadata", {})
+            metadata = _get_metadata(kwargs)
             virtual_model = metadata.get("virtual_model", model)
             error = str(response_obj) if response_obj else "unknown"
+            self.metrics.inc("vibe_upstream_failures_total", model_group=metadata.get("model_group", model))
+            self.stats.record_outcome(_kwargs_deployment_id(kwargs), ok=False)
+            self._inflight_end(kwargs)
+            self.admission.release(metadata.get("vibe_request_id"))
+            self.bulkhead.release(metadata.get("vibe_request_id"))
+            if self.tracer is not None:
+                self._trace_attempt_end(kwargs, response_obj, start_time, error=kwargs.get("exception") or response_obj)
+            exception = kwargs.get("exception") or response_obj
+            if getattr(exception, "status_code", None) == 429:
+                self.stats.mark_rate_limited(_kwargs_deployment_id(kwargs), _retry_after(exception, self.rate_limit_cooldown))
+            affinity_key = metadata.get("vibe_affinity_key")
+            if affinity_key and self.affinity.unpin(affinity_key, _kwargs_deployment_id(kwargs)):
+                self.metrics.inc("vibe_affinity_lookups_total", result="broken")
 
             _log(f"✗ FAILURE: {virtual_model} -> {model}", "ERROR")
             _log(f"  Error: {error[:200]}", "ERROR")
@@ -318,4 +5002,107 @@ _log("-" * 70)
 proxy_handler_instance = router_instance
 callback_handler = router_instance
 
+
+def _is_proxy_admin(user_api_key_dict: Any) -> bool:
+    """调用方是 proxy admin (user_role=proxy_admin) 或使用 master key"""
+    role = getattr(user_api_key_dict, "user_role", None)
+    if getattr(role, "value", role) == "proxy_admin":
+        return True
+    api_key = getattr(user_api_key_dict, "api_key", None)
+    if not api_key:
+        return False
+    try:
+        from litellm.proxy.proxy_server import master_key
+        from litellm.proxy.utils import hash_token
+    except ImportError:
+        return False
+    return bool(master_key) and api_key in (master_key, hash_token(master_key))
+
+
+def _require_proxy_admin(user_api_key_dict: Any):
+    """管理接口 (profiler / 会话 / 事件循环 / 开销报告) 只允许 proxy admin 调用"""
+    if not _is_proxy_admin(user_api_key_dict):
+        raise _http_error(403, "vibe-router: this endpoint requires the proxy admin role or the master key")
+
+
+def _install_admin_routes(instance: VibeIntelligentRouter):
+    """在 LiteLLM proxy 的 FastAPI app 上注册 /vibe/* 管理接口 (复用 proxy 的 key 鉴权)"""
+    try:
+        from fastapi import Depends, Request
+        from fastapi.responses import PlainTextResponse
+        from litellm.proxy.proxy_server import app
+        from litellm.proxy.auth.user_api_key_auth import user_api_key_auth
+    except ImportError as e:
+        _log(f"Admin routes unavailable: {e}", "WARN")
+        return
+
+    async def proxy_admin_auth(user_api_key_dict=Depends(user_api_key_auth)):
+        _require_proxy_admin(user_api_key_dict)
+
+    auth = [Depends(user_api_key_auth)]
+    admin = [Depends(proxy_admin_auth)]
+
+    async def vibe_metrics():
+        return PlainTextResponse(instance.metrics.render(), media_type="text/plain; version=0.0.4")
+
+    async def vibe_sessions(limit: int = 100):
+        return {"policy": instance.tool_loop_policy, "sessions": instance.session_report(limit)}
+
+    async def vibe_budget(user_api_key_dict=Depends(user_api_key_auth)):
+        return {"period": instance.budgets.period, "budgets": await instance.budgets.remaining(user_api_key_dict)}
+
+    async def vibe_route_explain(request: Request, user_api_key_dict=Depends(user_api_key_auth)):
+        body = await request.json()
+        if isinstance(body, dict) and isinstance(body.get("requests"), list):
+            return {"results": [await instance.explain_route(item, user_api_key_dict)
+                                for item in body["requests"] if isinstance(item, dict)]}
+        return await instance.explain_route(body, user_api_key_dict)
+
+    async def vibe_overhead(run: Optional[str] = None):
+        return instance.overhead_report(run)
+
+    async def vibe_loop():
+        if instance.loop_monitor is None:
+            return {"enabled": False}
+        return {"enabled": True, **instance.loop_monitor.report()}
+
+    async def vibe_profile(seconds: float = 30.0, hz: Optional[float] = None, format: str = "collapsed"):
+        result = await instance.profiler.run(seconds, hz)
+        if result is None:
+            raise _http_error(409, "A profile is already running")
+        if format == "json":
+            return result
+        return PlainTextResponse(SamplingProfiler.collapsed(result))
+
+    async def vibe_profile_last(format: str = "collapsed"):
+        if instance.profiler.last is None:
+            raise _http_error(404, "No profile has been taken yet")
+        if format == "json":
+            return instance.profiler.last
+        return PlainTextResponse(SamplingProfiler.collapsed(instance.profiler.last))
+
+    app.add_api_route("/vibe/metrics", vibe_metrics, methods=["GET"], dependencies=auth, include_in_schema=False)
+    app.add_api_route("/vibe/sessions", vibe_sessions, methods=["GET"], dependencies=admin, include_in_schema=False)
+    app.add_api_route("/vibe/budget", vibe_budget, methods=["GET"], include_in_schema=False)
+    app.add_api_route("/vibe/route/explain", vibe_route_explain, methods=["POST"], include_in_schema=False)
+    app.add_api_route("/vibe/loop", vibe_loop, methods=["GET"], dependencies=admin, include_in_schema=False)
+    app.add_api_route("/vibe/overhead", vibe_overhead, methods=["GET"], dependencies=admin, include_in_schema=False)
+    app.add_api_route("/vibe/profile", vibe_profile, methods=["POST"], dependencies=admin, include_in_schema=False)
+    app.add_api_route("/vibe/profile", vibe_profile_last, methods=["GET"], dependencies=admin, include_in_schema=False)
+    _log("✓ Admin routes registered: /vibe/metrics, /vibe/sessions, /vibe/budget, /vibe/route/explain, /vibe/loop, "
+         "/vibe/profile, /vibe/overhead")
+
+
+_install_admin_routes(router_instance)
+
+# proxy 已创建 router 时 (例如配置热加载后重新导入插件) 立即编译路由表, 在加载时报告不一致的候选链
+_routing_table()
+
+# proxy 启动时在事件循环中加载插件: 立即启动后台任务 (预热连接等), 否则在第一个请求时启动
+try:
+    asyncio.get_running_loop()
+    router_instance.start_background_tasks()
+except RuntimeError:
+    pass
+
 _log("Plugin module loaded successfully ✓")
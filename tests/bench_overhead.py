@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Proxy 开销分解 Benchmark: 直连 mock 上游 vs 经过 LiteLLM + vibe_router
+
+测试原理：
+1. 本脚本启动一个 OpenAI 兼容的 mock 上游 (固定延迟, 固定回复)
+2. 同一批请求先直连 mock, 再经过 proxy 转发到 mock
+3. 两者延迟之差即 proxy 开销; 插件在请求 metadata 中记录各阶段时间戳,
+   通过 GET /vibe/overhead?run=<标签> 取回分解:
+     proxy_setup          鉴权 / key 查询 / 别名映射 / 解析请求体
+     pre_call_hook        vibe_router 预处理 hook
+     router_selection     LiteLLM router 选择 (模型组、cooldown、健康检查)
+     vibe_filter          vibe_router 候选过滤
+     admission_wait       准入队列等待
+     request_translation  请求转换为上游格式
+     upstream             上游请求 (mock 延迟 + 网络)
+     callback             响应返回后到成功回调执行完毕
+4. 覆盖多种请求体大小和并发度
+
+前置条件 - 在 config_final.yaml 的 model_list 中添加指向 mock 的模型后重启 proxy:
+
+  - model_name: vibe-bench
+    litellm_params:
+      model: openai/mock
+      api_base: http://host.docker.internal:8090/v1
+      api_key: mock
+
+用法:
+  python3 tests/bench_overhead.py
+  python3 tests/bench_overhead.py --sizes 256,4096,65536 --concurrency 1,8,32 --requests 200
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+import requests
+
+# 从 .env 文件加载配置
+ENV_FILE = os.path.join(os.path.dirname(__file__), '.env')
+if os.path.exists(ENV_FILE):
+    with open(ENV_FILE) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#') and '=' in line:
+                key, value = line.split('=', 1)
+                os.environ.setdefault(key.strip(), value.strip())
+
+API_KEY = os.environ.get('LITELLM_MASTER_KEY', 'sk-litellm-master-key-12345678')
+BASE_URL = os.environ.get('LITELLM_BASE_URL', 'http://localhost:4000')
+
+STAGES = [
+    "proxy_setup", "pre_call_hook", "router_selection", "vibe_filter", "admission_wait",
+    "request_translation", "callback", "proxy_total",
+]
+
+
+class MockUpstream(BaseHTTPRequestHandler):
+    """OpenAI 兼容的 /v1/chat/completions, 固定延迟后返回固定回复"""
+
+    delay = 0.05
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.delay)
+        model = json.loads(body or b"{}").get("model", "mock")
+        payload = json.dumps({
+            "id": "chatcmpl-" + uuid.uuid4().hex,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "ok"}}],
+            "usage": {"prompt_tokens": max(1, len(body) // 4), "completion_tokens": 1,
+                      "total_tokens": max(1, len(body) // 4) + 1},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_mock(port: int, delay: float) -> ThreadingHTTPServer:
+    MockUpstream.delay = delay
+    server = ThreadingHTTPServer(("0.0.0.0", port), MockUpstream)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def run_batch(url: str, headers: Dict, body: Dict, total: int, concurrency: int) -> Tuple[List[float], int]:
+    """并发发送 total 个相同请求, 返回成功请求的延迟 (毫秒) 和失败数"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            response = session.post(url, headers=headers, json=body, timeout=120)
+            return (time.perf_counter() - started) * 1000.0 if response.status_code == 200 else None
+        except requests.RequestException:
+            return None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    latencies = [r for r in results if r is not None]
+    return latencies, len(results) - len(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LiteLLM + vibe_router 开销分解 benchmark")
+    parser.add_argument("--sizes", default="256,4096,65536", help="请求体 prompt 字符数, 逗号分隔")
+    parser.add_argument("--concurrency", default="1,8,32", help="并发度, 逗号分隔")
+    parser.add_argument("--requests", type=int, default=100, help="每个组合的请求数")
+    parser.add_argument("--model", default="vibe-bench", help="proxy 中指向 mock 的模型名")
+    parser.add_argument("--mock-port", type=int, default=8090)
+    parser.add_argument("--mock-delay-ms", type=float, default=50.0)
+    parser.add_argument("--output", default="", help="结果另存为 JSON")
+    args = parser.parse_args()
+
+    start_mock(args.mock_port, args.mock_delay_ms / 1000.0)
+    direct_url = f"http://127.0.0.1:{args.mock_port}/v1/chat/completions"
+    proxy_url = f"{BASE_URL}/v1/chat/completions"
+    auth = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
+    sizes = [int(x) for x in args.sizes.split(",") if x]
+    levels = [int(x) for x in args.concurrency.split(",") if x]
+    prefix = uuid.uuid4().hex[:8]
+
+    print("=" * 100)
+    print("Proxy 开销分解 Benchmark")
+    print("=" * 100)
+    print(f"  proxy: {BASE_URL}  model: {args.model}  mock 延迟: {args.mock_delay_ms:.0f}ms  每组请求: {args.requests}")
+
+    results = []
+    for size in sizes:
+        for concurrency in levels:
+            run = f"{prefix}-{size}-{concurrency}"
+            body = {"model": args.model, "messages": [{"role": "user", "content": "x" * size}], "max_tokens": 1}
+            direct, direct_errors = run_batch(direct_url, {"Content-Type": "application/json"}, body,
+                                              args.requests, concurrency)
+            proxied, proxy_errors = run_batch(proxy_url, auth, dict(body, metadata={"vibe_bench": run}),
+                                              args.requests, concurrency)
+            try:
+                breakdown = requests.get(f"{BASE_URL}/vibe/overhead", params={"run": run},
+                                         headers=auth, timeout=30).json()
+            except (requests.RequestException, ValueError):
+                breakdown = {"requests": 0, "stages_ms": {}}
+            results.append({
+                "size": size, "concurrency": concurrency, "run": run,
+                "direct_ms": {"p50": percentile(direct, 0.5), "p95": percentile(direct, 0.95)},
+                "proxy_ms": {"p50": percentile(proxied, 0.5), "p95": percentile(proxied, 0.95)},
+                "errors": {"direct": direct_errors, "proxy": proxy_errors},
+                "breakdown": breakdown,
+            })
+
+    print()
+    print(f"{'size':>7} {'conc':>5} {'direct p50':>11} {'proxy p50':>10} {'added p50':>10} {'added p95':>10}  "
+          + " ".join(f"{stage[:11]:>11}" for stage in STAGES))
+    print("-" * (58 + 12 * len(STAGES)))
+    for r in results:
+        stages = r["breakdown"].get("stages_ms", {})
+        added_p50 = r["proxy_ms"]["p50"] - r["direct_ms"]["p50"]
+        added_p95 = r["proxy_ms"]["p95"] - r["direct_ms"]["p95"]
+        print(f"{r['size']:>7} {r['concurrency']:>5} {r['direct_ms']['p50']:>9.1f}ms {r['proxy_ms']['p50']:>8.1f}ms "
+              f"{added_p50:>8.1f}ms {added_p95:>8.1f}ms  "
+              + " ".join(f"{stages[stage]['p50']:>9.2f}ms" if stage in stages else f"{'-':>11}" for stage in STAGES))
+        if r["errors"]["direct"] or r["errors"]["proxy"]:
+            print(f"{'':>13} 失败: 直连 {r['errors']['direct']}, proxy {r['errors']['proxy']}")
+    print()
+    print("阶段列为 p50 (ms), 来自插件时间戳; added = proxy 延迟 - 直连延迟")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"结果已保存到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
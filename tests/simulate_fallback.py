@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Fallback 配置离线模拟器 (离散事件仿真)
+
+读取 config_final.yaml 的 model_list 和 router_settings, 把录制的或合成的请求到达序列
+回放到每个 deployment 的延迟 / 错误率 / 配额模型上, 预测每套配置的:
+  - 吞吐 (成功请求/秒) 与成功率
+  - 端到端延迟 p50 / p95 / p99
+  - 实际服务的层级分布 (model_info.fallback_order)
+  - 花费 (model_info 中的 input/output_cost_per_token)
+
+模拟的 router 行为 (与 LiteLLM router 对齐的简化版):
+  - 从模型组中未冷却的 deployment 里选择: simple-shuffle 随机, ordered 按层级从低到高
+  - 失败后最多重试 num_retries 次, 每次重新选择; 单次尝试超过 timeout 视为失败
+  - 429 (超出 rpm / max_parallel_requests) 立即冷却 cooldown_time 秒;
+    其他错误 60 秒内超过 allowed_fails 次才冷却
+  - 组内没有可用 deployment 时按 router_settings.fallbacks 转到下一个模型组
+
+Deployment 性能模型 (--profiles, JSON), 按以下顺序匹配, 都没有时使用 "*":
+  "<model_name>/L<层级>" → litellm_params.model → "*"
+
+  {
+    "*":              {"latency_ms": 3000, "p95_ms": 8000, "error_rate": 0.01},
+    "auto-claude/L1": {"ttft_ms": 900, "tokens_per_second": 60, "error_rate": 0.02, "rpm": 50},
+    "glm-5":          {"latency_ms": 4000, "p95_ms": 12000, "max_concurrency": 20}
+  }
+
+录制的到达序列 (--trace, JSONL, 每行一个请求, t 为相对秒数):
+  {"t": 0.12, "model": "auto-claude", "input_tokens": 1800, "output_tokens": 400}
+
+用法:
+  # 当前配置, 合成流量 (20 req/s, 10 分钟)
+  python3 tests/simulate_fallback.py --rps 20 --duration 600 --mix auto-claude=0.7,auto-chat=0.3
+
+  # 扫描配置组合 (笛卡尔积), 默认按成功率、p95 排序
+  python3 tests/simulate_fallback.py --profiles profiles.json --trace arrivals.jsonl \\
+      --sweep num_retries=0,1,2,3 --sweep cooldown_time=5,10,30,60 --sweep timeout=30,60,120 \\
+      --sweep routing_strategy=simple-shuffle,ordered --output sweep.json
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import sys
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import yaml
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), '..', 'config_final.yaml')
+DEFAULT_PROFILE = {"latency_ms": 3000.0, "p95_ms": 8000.0, "error_rate": 0.01}
+SWEEP_KEYS = ("num_retries", "cooldown_time", "timeout", "allowed_fails", "routing_strategy")
+
+# 事件类型 (同一时刻先处理完成, 再处理到达)
+DONE, ARRIVAL = 0, 1
+
+
+class Deployment:
+    __slots__ = ("name", "group", "layer", "model", "profile", "input_cost", "output_cost", "max_parallel",
+                 "inflight", "starts", "fails", "cooldown_until")
+
+    def __init__(self, entry: Dict, profiles: Dict[str, Dict]):
+        params = entry.get("litellm_params") or {}
+        info = entry.get("model_info") or {}
+        self.group = entry["model_name"]
+        self.layer = int(info.get("fallback_order", 1))
+        self.model = str(params.get("model"))
+        self.name = f"{self.group}/L{self.layer}"
+        self.profile = dict(DEFAULT_PROFILE)
+        self.profile.update(profiles.get("*", {}))
+        self.profile.update(profiles.get(self.model, {}))
+        self.profile.update(profiles.get(self.name, {}))
+        self.input_cost = float(info.get("input_cost_per_token") or 0.0)
+        self.output_cost = float(info.get("output_cost_per_token") or 0.0)
+        self.max_parallel = params.get("max_parallel_requests") or info.get("max_concurrency") \
+            or self.profile.get("max_concurrency")
+        self.inflight = 0
+        self.starts: deque = deque()
+        self.fails: deque = deque()
+        self.cooldown_until = 0.0
+
+    def sample_latency(self, rng: random.Random, output_tokens: int) -> float:
+        """秒: 给了 tokens_per_second 时 = TTFT + 输出 token / 速度, 否则按总延迟的对数正态分布"""
+        profile = self.profile
+        if profile.get("tokens_per_second"):
+            ttft = _lognormal(rng, profile.get("ttft_ms", 800.0), profile.get("ttft_p95_ms"))
+            return ttft / 1000.0 + output_tokens / float(profile["tokens_per_second"])
+        return _lognormal(rng, profile["latency_ms"], profile.get("p95_ms")) / 1000.0
+
+
+def _lognormal(rng: random.Random, median_ms: float, p95_ms: Optional[float]) -> float:
+    sigma = math.log(p95_ms / median_ms) / 1.645 if p95_ms and p95_ms > median_ms else 0.25
+    return median_ms * math.exp(rng.gauss(0.0, sigma))
+
+
+def load_config(path: str) -> Tuple[List[Dict], Dict]:
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    return config.get("model_list") or [], config.get("router_settings") or {}
+
+
+def load_trace(path: str) -> List[Dict]:
+    arrivals = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                arrivals.append(json.loads(line))
+    arrivals.sort(key=lambda a: a["t"])
+    return arrivals
+
+
+def synthetic_trace(rps: float, duration: float, mix: Dict[str, float], seed: int,
+                    input_tokens: int, output_tokens: int) -> List[Dict]:
+    """泊松到达; token 数按均值的指数分布抽样"""
+    rng = random.Random(seed)
+    groups, weights = list(mix), list(mix.values())
+    arrivals, t = [], 0.0
+    while True:
+        t += rng.expovariate(rps)
+        if t >= duration:
+            return arrivals
+        arrivals.append({
+            "t": t, "model": rng.choices(groups, weights)[0],
+            "input_tokens": max(1, int(rng.expovariate(1.0 / input_tokens))),
+            "output_tokens": max(1, int(rng.expovariate(1.0 / output_tokens))),
+        })
+
+
+def _fallback_map(settings: Dict) -> Dict[str, List[str]]:
+    mapping: Dict[str, List[str]] = {}
+    for item in settings.get("fallbacks") or []:
+        if isinstance(item, dict):
+            for group, targets in item.items():
+                mapping[group] = list(targets)
+    return mapping
+
+
+def simulate(model_list: List[Dict], settings: Dict, profiles: Dict[str, Dict], arrivals: List[Dict],
+             seed: int = 0) -> Dict[str, Any]:
+    """回放一次, 返回汇总指标"""
+    rng = random.Random(seed)
+    num_retries = int(settings.get("num_retries", 0) or 0)
+    cooldown_time = float(settings.get("cooldown_time", 5) or 0)
+    timeout = float(settings.get("timeout", 600) or 600)
+    allowed_fails = int(settings.get("allowed_fails", 3) or 0)
+    ordered = settings.get("routing_strategy") == "ordered"
+    fallbacks = _fallback_map(settings)
+
+    groups: Dict[str, List[Deployment]] = defaultdict(list)
+    for entry in model_list:
+        if entry.get("model_name") and "*" not in entry["model_name"]:
+            groups[entry["model_name"]].append(Deployment(entry, profiles))
+    for deployments in groups.values():
+        deployments.sort(key=lambda d: d.layer)
+
+    def pick(group: str, now: float, tried: set) -> Optional[Deployment]:
+        for name in [group] + fallbacks.get(group, []):
+            candidates = [d for d in groups.get(name, ()) if d.cooldown_until <= now and id(d) not in tried]
+            if not candidates:
+                candidates = [d for d in groups.get(name, ()) if d.cooldown_until <= now]
+            if candidates:
+                return candidates[0] if ordered else rng.choice(candidates)
+        return None
+
+    def fail(deployment: Deployment, now: float, rate_limited: bool):
+        if rate_limited:
+            deployment.cooldown_until = now + cooldown_time
+            return
+        deployment.fails.append(now)
+        while deployment.fails and deployment.fails[0] <= now - 60.0:
+            deployment.fails.popleft()
+        if len(deployment.fails) > allowed_fails:
+            deployment.cooldown_until = now + cooldown_time
+            deployment.fails.clear()
+
+    events: List[Tuple[float, int, int, Any]] = []
+    sequence = itertools.count()
+    for index, arrival in enumerate(arrivals):
+        events.append((float(arrival["t"]), ARRIVAL, next(sequence), index))
+    heapq.heapify(events)
+
+    latencies: List[float] = []
+    served = defaultdict(int)
+    failed = defaultdict(int)
+    attempts_total = 0
+    cost = 0.0
+    last_done = 0.0
+
+    def attempt(now: float, index: int, tries: int, tried: set):
+        nonlocal attempts_total
+        request = arrivals[index]
+        deployment = pick(request["model"], now, tried)
+        if deployment is None:
+            failed["no_deployment"] += 1
+            return
+        attempts_total += 1
+        tried.add(id(deployment))
+        rpm = deployment.profile.get("rpm")
+        while deployment.starts and deployment.starts[0] <= now - 60.0:
+            deployment.starts.popleft()
+        if (rpm and len(deployment.starts) >= rpm) or \
+                (deployment.max_parallel and deployment.inflight >= deployment.max_parallel):
+            fail(deployment, now, rate_limited=True)
+            retry(now, index, tries, tried, "rate_limited")
+            return
+        deployment.starts.append(now)
+        deployment.inflight += 1
+        latency = deployment.sample_latency(rng, int(request.get("output_tokens", 200)))
+        if latency > timeout:
+            outcome = "timeout"
+            latency = timeout
+        elif rng.random() < deployment.profile.get("error_rate", 0.0):
+            outcome = "error"
+            latency *= rng.random()
+        else:
+            outcome = "ok"
+        heapq.heappush(events, (now + latency, DONE, next(sequence), (index, tries, tried, deployment, outcome)))
+
+    def retry(now: float, index: int, tries: int, tried: set, reason: str):
+        if tries < num_retries:
+            attempt(now, index, tries + 1, tried)
+        else:
+            failed[reason] += 1
+
+    while events:
+        now, kind, _, payload = heapq.heappop(events)
+        if kind == ARRIVAL:
+            attempt(now, payload, 0, set())
+            continue
+        index, tries, tried, deployment, outcome = payload
+        deployment.inflight -= 1
+        if outcome == "ok":
+            request = arrivals[index]
+            latencies.append(now - float(request["t"]))
+            served[deployment.layer] += 1
+            cost += deployment.input_cost * request.get("input_tokens", 0) \
+                + deployment.output_cost * request.get("output_tokens", 0)
+            last_done = max(last_done, now)
+        else:
+            fail(deployment, now, rate_limited=False)
+            retry(now, index, tries, tried, outcome)
+
+    total = len(arrivals)
+    ok = len(latencies)
+    latencies.sort()
+    span = max(last_done, float(arrivals[-1]["t"]) if arrivals else 0.0) or 1.0
+
+    def pct(q: float) -> Optional[float]:
+        return round(latencies[min(ok - 1, int(q * ok))] * 1000.0, 1) if ok else None
+
+    return {
+        "requests": total,
+        "success_rate": round(ok / total, 4) if total else 0.0,
+        "throughput_rps": round(ok / span, 3),
+        "latency_ms": {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99)},
+        "layer_mix": {f"L{layer}": round(count / ok, 4) for layer, count in sorted(served.items())} if ok else {},
+        "failures": dict(failed),
+        "attempts_per_request": round(attempts_total / total, 3) if total else 0.0,
+        "cost_usd": round(cost, 4),
+    }
+
+
+def _run_one(job: Tuple[Dict, List[Dict], Dict, Dict, List[Dict], int]) -> Dict[str, Any]:
+    overrides, model_list, settings, profiles, arrivals, seed = job
+    result = simulate(model_list, dict(settings, **overrides), profiles, arrivals, seed)
+    result["config"] = overrides
+    return result
+
+
+def _parse_value(value: str) -> Any:
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fallback 配置离线模拟器")
+    parser.add_argument("--config", default=DEFAULT_CONFIG, help="LiteLLM 配置文件")
+    parser.add_argument("--profiles", default="", help="deployment 性能模型 (JSON)")
+    parser.add_argument("--trace", default="", help="录制的到达序列 (JSONL); 不给则生成泊松流量")
+    parser.add_argument("--rps", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=600.0, help="合成流量时长 (秒)")
+    parser.add_argument("--mix", default="", help="模型组流量占比, 例如 auto-claude=0.7,auto-chat=0.3")
+    parser.add_argument("--input-tokens", type=int, default=2000, help="合成流量平均输入 token")
+    parser.add_argument("--output-tokens", type=int, default=300, help="合成流量平均输出 token")
+    parser.add_argument("--sweep", action="append", default=[],
+                        help=f"扫描参数, 可重复: key=v1,v2 (key: {', '.join(SWEEP_KEYS)})")
+    parser.add_argument("--sort", default="success", choices=["p50", "p95", "p99", "success", "cost", "throughput"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output", default="", help="结果另存为 JSON")
+    args = parser.parse_args()
+
+    model_list, settings = load_config(args.config)
+    profiles: Dict[str, Dict] = {}
+    if args.profiles:
+        with open(args.profiles) as f:
+            profiles = json.load(f)
+    if args.trace:
+        arrivals = load_trace(args.trace)
+    else:
+        groups = sorted({e["model_name"] for e in model_list if "*" not in e.get("model_name", "*")})
+        mix = {k: float(v) for k, v in (p.split("=", 1) for p in args.mix.split(",") if "=" in p)} \
+            or {g: 1.0 for g in groups}
+        arrivals = synthetic_trace(args.rps, args.duration, mix, args.seed, args.input_tokens, args.output_tokens)
+    if not arrivals:
+        print("到达序列为空", file=sys.stderr)
+        sys.exit(1)
+
+    axes = []
+    for item in args.sweep:
+        key, _, values = item.partition("=")
+        if key not in SWEEP_KEYS:
+            parser.error(f"不支持的扫描参数: {key}")
+        axes.append([(key, _parse_value(v)) for v in values.split(",") if v])
+    combos = [dict(c) for c in itertools.product(*axes)] if axes else [{}]
+    jobs = [(combo, model_list, settings, profiles, arrivals, args.seed) for combo in combos]
+
+    if len(jobs) > 1 and args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(_run_one, jobs, chunksize=max(1, len(jobs) // (args.jobs * 4))))
+    else:
+        results = [_run_one(job) for job in jobs]
+
+    sort_keys = {
+        "p50": lambda r: r["latency_ms"]["p50"] or float("inf"),
+        "p95": lambda r: r["latency_ms"]["p95"] or float("inf"),
+        "p99": lambda r: r["latency_ms"]["p99"] or float("inf"),
+        "success": lambda r: (-r["success_rate"], r["latency_ms"]["p95"] or float("inf")),
+        "cost": lambda r: r["cost_usd"],
+        "throughput": lambda r: -r["throughput_rps"],
+    }
+    results.sort(key=sort_keys[args.sort])
+
+    print("=" * 110)
+    print(f"Fallback 配置模拟: {len(arrivals)} 个请求 × {len(results)} 套配置")
+    print(f"基础配置: num_retries={settings.get('num_retries')} cooldown_time={settings.get('cooldown_time')} "
+          f"timeout={settings.get('timeout')} routing_strategy={settings.get('routing_strategy')}")
+    print("=" * 110)
+    labels = [" ".join(f"{k}={v}" for k, v in r["config"].items()) or "(当前配置)" for r in results[:50]]
+    width = max(len(label) for label in labels)
+    print(f"{'配置':<{width}} {'成功率':>7} {'吞吐/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'尝试':>5} {'花费$':>9}  层级分布")
+    print("-" * 110)
+    for label, r in zip(labels, results):
+        latency = r["latency_ms"]
+        fmt = lambda v: f"{v / 1000.0:>7.2f}s" if v is not None else f"{'-':>8}"
+        mix = " ".join(f"{layer}:{share:.0%}" for layer, share in r["layer_mix"].items())
+        print(f"{label:<{width}} {r['success_rate']:>7.1%} {r['throughput_rps']:>8.2f} {fmt(latency['p50'])} "
+              f"{fmt(latency['p95'])} {fmt(latency['p99'])} {r['attempts_per_request']:>5.2f} "
+              f"{r['cost_usd']:>9.2f}  {mix}")
+    if len(results) > 50:
+        print(f"... 其余 {len(results) - 50} 套配置见 --output")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"结果已保存到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
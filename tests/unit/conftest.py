@@ -0,0 +1,91 @@
+"""
+vibe_router 插件单元测试的公共 fixture
+
+不需要运行中的 proxy: 直接导入 config/vibe_router.py (需要安装 litellm),
+每个测试用独立的 VibeIntelligentRouter 实例, 通过环境变量设置开关。
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+# 使用 litellm 自带的模型价格表, 导入时不在后台线程联网拉取
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+pytest.importorskip("litellm")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "config"))
+
+import vibe_router  # noqa: E402
+
+
+@pytest.fixture
+def vr():
+    return vibe_router
+
+
+@pytest.fixture
+def make_router(monkeypatch):
+    """按给定的 VIBE_* 环境变量创建新的 router 实例"""
+
+    def factory(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        return vibe_router.VibeIntelligentRouter()
+
+    return factory
+
+
+@pytest.fixture
+def model_list(monkeypatch):
+    """把 _get_llm_router 换成只带 model_list 的 router, 返回设置 model_list 的函数"""
+
+    class FakeRouter:
+        def __init__(self):
+            self.model_list = []
+
+    router = FakeRouter()
+    monkeypatch.setattr(vibe_router, "_get_llm_router", lambda: router)
+    # 新 list 可能复用旧 list 的 id, 不等检查间隔, 立即按内容重新判断
+    monkeypatch.setattr(vibe_router, "_ROUTING_TABLE_CHECKED", (None, 0.0))
+
+    def install(deployments):
+        router.model_list = deployments
+        return router
+
+    return install
+
+
+def deployment(group, deployment_id, order=1, **info):
+    """构造一个 model_list 条目"""
+    return {
+        "model_name": group,
+        "litellm_params": {"model": f"openai/{deployment_id}", "api_base": f"https://{deployment_id}.example/v1"},
+        "model_info": {"id": deployment_id, "fallback_order": order, **info},
+    }
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def callback_kwargs(metadata, deployment_id=None, **extra):
+    """构造成功 / 失败日志回调的 kwargs"""
+    return {"model": metadata.get("model_group", "m"),
+            "litellm_params": {"metadata": metadata, "model_info": {"id": deployment_id}},
+            **extra}
+
+
+def log_success(router, metadata, deployment_id, response=None, seconds=1.0):
+    import datetime
+    end = datetime.datetime.now()
+    start = end - datetime.timedelta(seconds=seconds)
+    run(router.async_log_success_event(callback_kwargs(metadata, deployment_id), response, start, end))
+
+
+def log_failure(router, metadata, deployment_id, exception=None):
+    import datetime
+    now = datetime.datetime.now()
+    kwargs = callback_kwargs(metadata, deployment_id, exception=exception)
+    run(router.async_log_failure_event(kwargs, exception, now, now))
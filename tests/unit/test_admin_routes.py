@@ -0,0 +1,29 @@
+"""管理接口的 proxy admin 鉴权 (user-043)"""
+
+from types import SimpleNamespace
+
+import pytest
+
+
+def test_proxy_admin_role_is_allowed(vr):
+    from litellm.proxy._types import LitellmUserRoles
+    vr._require_proxy_admin(SimpleNamespace(user_role=LitellmUserRoles.PROXY_ADMIN, api_key="hashed"))
+    vr._require_proxy_admin(SimpleNamespace(user_role="proxy_admin", api_key=None))
+
+
+def test_master_key_is_allowed(vr, monkeypatch):
+    from litellm.proxy import proxy_server
+    from litellm.proxy.utils import hash_token
+    monkeypatch.setattr(proxy_server, "master_key", "sk-master")
+    assert vr._is_proxy_admin(SimpleNamespace(user_role=None, api_key="sk-master"))
+    assert vr._is_proxy_admin(SimpleNamespace(user_role=None, api_key=hash_token("sk-master")))
+
+
+@pytest.mark.parametrize("key", [SimpleNamespace(user_role="internal_user", api_key="hashed"),
+                                 SimpleNamespace(user_role=None, api_key=None), None])
+def test_virtual_keys_are_rejected(vr, monkeypatch, key):
+    from litellm.proxy import proxy_server
+    monkeypatch.setattr(proxy_server, "master_key", "sk-master")
+    with pytest.raises(Exception) as error:
+        vr._require_proxy_admin(key)
+    assert getattr(error.value, "status_code", None) == 403
@@ -0,0 +1,102 @@
+"""准入控制: 加权公平排队、槽位回收后的放行、pre-call hook 中的 429 (user-038)"""
+
+import asyncio
+
+import pytest
+
+from conftest import deployment, run
+
+
+def queue(vr, ttl=600.0):
+    return vr.AdmissionQueue({"high": 4, "normal": 2, "low": 1}, ticket_ttl=ttl)
+
+
+def test_release_dispatches_waiter(vr):
+    admission = queue(vr)
+
+    async def scenario():
+        assert await admission.acquire("r1", [("d", 1)], "normal", "k1", 0) == "d"
+        waiter = asyncio.ensure_future(admission.acquire("r2", [("d", 1)], "normal", "k2", 1.0))
+        await asyncio.sleep(0)
+        assert admission.depth() == 1
+        admission.release("r1")
+        return await waiter
+
+    assert run(scenario()) == "d"
+
+
+def test_capacity_increase_dispatches_waiter(vr):
+    admission = queue(vr)
+
+    async def scenario():
+        await admission.acquire("r1", [("d", 1)], "normal", "k1", 0)
+        waiter = asyncio.ensure_future(admission.acquire("r2", [("d", 1)], "normal", "k2", 1.0))
+        await asyncio.sleep(0)
+        admission.reconfigure({"d": 2})
+        return await asyncio.wait_for(waiter, 0.1)
+
+    assert run(scenario()) == "d"
+
+
+def test_expired_ticket_is_reclaimed_for_waiter(vr):
+    admission = queue(vr, ttl=0.05)
+
+    async def scenario():
+        await admission.acquire("leaked", [("d", 1)], "normal", "k1", 0)
+        return await admission.acquire("r2", [("d", 1)], "normal", "k2", 1.0)
+
+    assert run(scenario()) == "d"
+    assert admission.held("leaked") is None
+
+
+def test_cancelled_waiter_returns_granted_slot(vr):
+    admission = queue(vr)
+
+    async def scenario():
+        await admission.acquire("r1", [("d", 1)], "normal", "k1", 0)
+        waiter = asyncio.ensure_future(admission.acquire("r2", [("d", 1)], "normal", "k2", 1.0))
+        await asyncio.sleep(0)
+        admission.release("r1")
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    run(scenario())
+    assert admission.occupancy["d"] == 0
+
+
+def test_weighted_fairness_prefers_high_priority(vr):
+    admission = queue(vr)
+
+    async def scenario():
+        await admission.acquire("r0", [("d", 1)], "normal", "k0", 0)
+        low = asyncio.ensure_future(admission.acquire("low", [("d", 1)], "low", "k1", 1.0))
+        await asyncio.sleep(0)
+        high = asyncio.ensure_future(admission.acquire("high", [("d", 1)], "high", "k2", 1.0))
+        await asyncio.sleep(0)
+        admission.release("r0")
+        await high
+        return low.done()
+
+    assert run(scenario()) is False
+
+
+def test_full_group_is_rejected_in_pre_call_hook(make_router, model_list):
+    model_list([deployment("auto-chat", "capped", max_concurrency=1)])
+    router = make_router(VIBE_ADMISSION_ENABLED="true", VIBE_ADMISSION_MAX_WAIT="0.01")
+    first = run(router.async_pre_call_hook(None, None, {"model": "auto-chat", "messages": []}, "completion"))
+    assert router.admission.held(first["metadata"]["vibe_request_id"]) == "capped"
+    with pytest.raises(Exception) as error:
+        run(router.async_pre_call_hook(None, None, {"model": "auto-chat", "messages": []}, "completion"))
+    assert getattr(error.value, "status_code", None) == 429
+
+
+def test_filter_uses_slot_from_pre_call_and_never_raises(make_router, model_list):
+    capped = deployment("auto-chat", "capped", max_concurrency=1)
+    model_list([capped])
+    router = make_router(VIBE_ADMISSION_ENABLED="true", VIBE_ADMISSION_MAX_WAIT="0.01")
+    data = run(router.async_pre_call_hook(None, None, {"model": "auto-chat", "messages": []}, "completion"))
+    kwargs = {"metadata": data["metadata"]}
+    assert run(router.async_filter_deployments("auto-chat", [capped], request_kwargs=kwargs)) == [capped]
+    other = {"metadata": {"vibe_request_id": "other"}}
+    assert run(router.async_filter_deployments("auto-chat", [capped], request_kwargs=other)) == []
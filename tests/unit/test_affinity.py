@@ -0,0 +1,61 @@
+"""会话亲和: 指纹、只绑定首选层、opt-in (user-030)"""
+
+from conftest import deployment, log_failure, log_success, run
+
+
+def conversation(turns=1):
+    messages = [{"role": "user", "content": "refactor the parser"}]
+    for i in range(turns):
+        messages += [{"role": "assistant", "content": f"step {i}"}, {"role": "user", "content": f"next {i}"}]
+    return {"model": "auto-claude", "system": "You are Claude Code.", "messages": messages}
+
+
+def test_fingerprint_is_stable_as_conversation_grows(vr):
+    assert vr._conversation_fingerprint(conversation(1), 1) == vr._conversation_fingerprint(conversation(5), 1)
+    other = conversation(1)
+    other["messages"][0]["content"] = "write docs"
+    assert vr._conversation_fingerprint(other, 1) != vr._conversation_fingerprint(conversation(1), 1)
+
+
+def test_affinity_is_opt_in(make_router):
+    router = make_router()
+    data = run(router.async_pre_call_hook(None, None, conversation(), "anthropic_messages"))
+    assert "vibe_affinity_key" not in data["metadata"]
+
+
+def setup_router(make_router, model_list):
+    primary = [deployment("auto-claude", "l1-a", 1), deployment("auto-claude", "l1-b", 1)]
+    paid = deployment("auto-claude", "l3", 3)
+    model_list(primary + [paid])
+    return make_router(VIBE_AFFINITY_ENABLED="true"), primary, paid
+
+
+def test_success_on_preferred_layer_pins_for_anthropic_messages(make_router, model_list):
+    router, primary, paid = setup_router(make_router, model_list)
+    data = run(router.async_pre_call_hook(None, None, conversation(), "anthropic_messages"))
+    metadata = dict(data["metadata"], model_group="auto-claude")
+    log_success(router, metadata, "l1-b")
+    assert router.affinity.peek(metadata["vibe_affinity_key"]) == "l1-b"
+    selected = router._select_deployments("auto-claude", primary + [paid], dict(metadata, vibe_request_id="n"))
+    assert [d["model_info"]["id"] for d in selected] == ["l1-b"]
+
+
+def test_success_on_fallback_layer_does_not_pin_or_refresh(make_router, model_list):
+    router, primary, paid = setup_router(make_router, model_list)
+    data = run(router.async_pre_call_hook(None, None, conversation(), "anthropic_messages"))
+    metadata = dict(data["metadata"], model_group="auto-claude")
+    log_success(router, metadata, "l3")
+    assert router.affinity.peek(metadata["vibe_affinity_key"]) is None
+
+    log_success(router, metadata, "l1-a")
+    expires = router.affinity._pins[metadata["vibe_affinity_key"]][1]
+    log_failure(router, metadata, "l1-b")
+    log_success(router, metadata, "l3")
+    assert router.affinity._pins[metadata["vibe_affinity_key"]] == ("l1-a", expires)
+
+
+def test_failure_breaks_the_pin(make_router, model_list):
+    router, primary, paid = setup_router(make_router, model_list)
+    router.affinity.pin("k", "l1-a")
+    log_failure(router, {"vibe_affinity_key": "k", "model_group": "auto-claude"}, "l1-a")
+    assert router.affinity.peek("k") is None
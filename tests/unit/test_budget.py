@@ -0,0 +1,76 @@
+"""按 deployment 单价的成本路由与 key / team 预算 (user-031)"""
+
+import types
+
+import pytest
+
+from conftest import deployment, run
+
+
+class MemoryCache:
+    """DualCache 的最小替身 (只用到 get / increment)"""
+
+    def __init__(self):
+        self.values = {}
+
+    async def async_get_cache(self, key, **kwargs):
+        return self.values.get(key)
+
+    async def async_increment_cache(self, key, value, **kwargs):
+        self.values[key] = self.values.get(key, 0.0) + value
+
+
+def key(budget_usd):
+    return types.SimpleNamespace(api_key="sk-a", token=None, team_id=None, metadata={"vibe_budget_usd": budget_usd},
+                                 team_metadata=None, user_id=None)
+
+
+def test_cost_estimate_uses_model_info_prices(vr):
+    paid = deployment("auto-chat", "paid", input_cost_per_token=1e-6, output_cost_per_token=2e-6)
+    assert vr._estimate_deployment_cost(paid, 1000, 500) == pytest.approx(0.002)
+    assert vr._estimate_deployment_cost(deployment("auto-chat", "unpriced"), 1000, 500) is None
+
+
+def test_cost_routing_prefers_cheapest_layer(make_router):
+    router = make_router(VIBE_COST_ROUTING_ENABLED="true")
+    cheap = deployment("auto-chat", "cheap", input_cost_per_token=1e-7, output_cost_per_token=1e-7)
+    dear = deployment("auto-chat", "dear", input_cost_per_token=1e-5, output_cost_per_token=1e-5)
+    chosen = router._apply_cost_routing("auto-chat", [dear, cheap], {"vibe_estimated_tokens": 100})
+    assert chosen == [cheap]
+
+
+def test_exhausted_budget_keeps_only_free_layers(make_router):
+    router = make_router()
+    free = deployment("auto-chat", "free", input_cost_per_token=0, output_cost_per_token=0)
+    paid = deployment("auto-chat", "paid", input_cost_per_token=1e-6, output_cost_per_token=1e-6)
+    metadata = {"vibe_budget_remaining": 0.0, "vibe_estimated_tokens": 100}
+    assert router._filter_by_budget("auto-chat", [paid, free], metadata) == [free]
+    assert router._filter_by_budget("auto-chat", [paid], metadata) == []
+
+
+def test_request_is_rejected_when_budget_is_spent_and_no_free_layer(make_router, model_list):
+    model_list([deployment("auto-chat", "paid", input_cost_per_token=1e-6, output_cost_per_token=1e-6)])
+    router = make_router()
+    cache = MemoryCache()
+    cache.values[router.budgets.spend_key("key", "sk-a")] = 5.0
+    with pytest.raises(Exception) as error:
+        run(router.async_pre_call_hook(key(1.0), cache, {"model": "auto-chat", "messages": [
+            {"role": "user", "content": "hi"}]}, "completion"))
+    assert getattr(error.value, "status_code", None) == 429
+
+
+def test_success_records_spend_for_key(make_router, model_list):
+    paid = deployment("auto-chat", "paid", input_cost_per_token=1e-3, output_cost_per_token=1e-3)
+    model_list([paid])
+    router = make_router()
+    cache = MemoryCache()
+    data = run(router.async_pre_call_hook(key(10.0), cache, {"model": "auto-chat", "messages": [
+        {"role": "user", "content": "hi"}]}, "completion"))
+    response = types.SimpleNamespace(usage=types.SimpleNamespace(prompt_tokens=100, completion_tokens=50),
+                                     choices=[], model="m")
+    kwargs_metadata = dict(data["metadata"], model_group="auto-chat")
+    import datetime
+    now = datetime.datetime.now()
+    run(router.async_log_success_event({"model": "auto-chat", "litellm_params": {
+        "metadata": kwargs_metadata, "model_info": paid["model_info"], **paid["model_info"]}}, response, now, now))
+    assert cache.values[router.budgets.spend_key("key", "sk-a")] == pytest.approx(0.15)
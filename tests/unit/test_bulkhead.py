@@ -0,0 +1,89 @@
+"""Bulkhead 隔离: 选择时预留槽位、释放路径、TTL 回收 (user-040)"""
+
+import asyncio
+
+from conftest import deployment, log_failure, log_success, run
+
+
+def upstreams():
+    return [deployment("auto-chat", "a"), deployment("auto-chat", "b", 2)]
+
+
+def select(router, request_id, candidates):
+    kwargs = {"metadata": {"vibe_request_id": request_id, "model_group": "auto-chat"}}
+    return run(router.async_filter_deployments("auto-chat", candidates, request_kwargs=kwargs))
+
+
+def test_slot_is_reserved_at_selection(make_router):
+    router = make_router(VIBE_BULKHEAD_LIMIT="1")
+    a, b = upstreams()
+    assert select(router, "r1", [a, b]) == [a]
+    assert select(router, "r2", [a, b]) == [b]
+    # 两个上游都满载: 不再选择任何 deployment
+    assert select(router, "r3", [a, b]) == []
+    assert router.bulkhead.active == {"a.example": 1, "b.example": 1}
+
+
+def test_concurrent_selection_never_exceeds_limit(make_router):
+    router = make_router(VIBE_BULKHEAD_LIMIT="2")
+    a, _ = upstreams()
+
+    async def burst():
+        kwargs = [{"metadata": {"vibe_request_id": f"r{i}"}} for i in range(10)]
+        return await asyncio.gather(*(router.async_filter_deployments("auto-chat", [a], request_kwargs=k)
+                                      for k in kwargs))
+
+    assert sum(1 for chosen in run(burst()) if chosen) == 2
+
+
+def test_success_and_failure_release_slots(make_router):
+    router = make_router(VIBE_BULKHEAD_LIMIT="1")
+    a, _ = upstreams()
+    select(router, "r1", [a])
+    log_success(router, {"vibe_request_id": "r1", "model_group": "auto-chat"}, "a")
+    assert select(router, "r2", [a]) == [a]
+    log_failure(router, {"vibe_request_id": "r2", "model_group": "auto-chat"}, "a", Exception("boom"))
+    assert router.bulkhead.active["a.example"] == 0
+
+
+def test_retry_moves_the_reservation(make_router):
+    router = make_router(VIBE_BULKHEAD_LIMIT="1", VIBE_RETRY_BUDGET_ENABLED="false")
+    a, b = upstreams()
+    assert select(router, "r1", [a, b]) == [a]
+    assert select(router, "r1", [b]) == [b]
+    assert router.bulkhead.active == {"a.example": 0, "b.example": 1}
+
+
+def test_cancelled_stream_releases_slot(make_router):
+    router = make_router(VIBE_BULKHEAD_LIMIT="1")
+    a, _ = upstreams()
+    select(router, "r1", [a])
+
+    async def endless():
+        while True:
+            yield "chunk"
+            await asyncio.sleep(0)
+
+    async def consume_one():
+        stream = router.async_post_call_streaming_iterator_hook(
+            None, endless(), {"model": "auto-chat", "metadata": {"vibe_request_id": "r1"}})
+        await stream.__anext__()
+        await stream.aclose()
+
+    run(consume_one())
+    assert router.bulkhead.active["a.example"] == 0
+
+
+def test_leaked_slot_expires(vr):
+    bulkhead = vr.Bulkhead(ttl=0.0)
+    assert bulkhead.try_reserve("leaked", "up", 1)
+    assert bulkhead.try_reserve("next", "up", 1)
+    assert list(bulkhead.reservations) == ["next"]
+
+
+def test_unlimited_candidates_skip_reservation(make_router):
+    router = make_router(VIBE_BULKHEAD_LIMITS="a.example=1")
+    a, b = upstreams()
+    assert select(router, "r1", [a, b]) == [a]
+    assert select(router, "r2", [a, b]) == [b]
+    assert list(router.bulkhead.reservations) == ["r1"]
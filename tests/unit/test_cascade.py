@@ -0,0 +1,79 @@
+"""Cascade: 接受检查、升级、重试预算计费 (user-032)"""
+
+import types
+
+import pytest
+
+from conftest import run
+
+
+def response(content, finish_reason="stop", logprobs=None):
+    message = types.SimpleNamespace(content=content, tool_calls=None)
+    choice = types.SimpleNamespace(message=message, finish_reason=finish_reason,
+                                   logprobs=types.SimpleNamespace(content=logprobs) if logprobs else None)
+    return types.SimpleNamespace(choices=[choice], usage=None, _hidden_params={})
+
+
+def test_verdict_rejects_truncated_short_and_uncertain_answers(vr):
+    assert vr._cascade_verdict(response("A complete and confident answer."), 10, None)[0]
+    assert vr._cascade_verdict(response("Partial answer that was cut", "length"), 10, None)[1] == "finish_length"
+    assert vr._cascade_verdict(response("ok"), 10, None)[1] == "too_short"
+    assert vr._cascade_verdict(response("I'm not sure, but maybe it is this."), 10, None)[1] == "uncertain"
+
+
+def test_verdict_checks_average_logprob(vr):
+    tokens = [types.SimpleNamespace(logprob=-2.0)] * 3
+    answer = response("A complete and confident answer.", logprobs=tokens)
+    assert vr._cascade_verdict(answer, 10, -0.5)[1] == "low_logprob"
+    assert vr._cascade_verdict(answer, 10, -3.0)[0]
+
+
+def test_invalid_logprob_setting_does_not_break_loading(make_router):
+    assert make_router(VIBE_CASCADE_MIN_AVG_LOGPROB="not-a-number").cascade_min_avg_logprob is None
+    assert make_router(VIBE_CASCADE_MIN_AVG_LOGPROB="-0.5").cascade_min_avg_logprob == -0.5
+
+
+class FakeRouter:
+    """像 LiteLLM router 一样在发出上游请求前调用插件的 deployment 过滤"""
+
+    def __init__(self, plugin, answer):
+        self.plugin = plugin
+        self.answer = answer
+        self.model_list = []
+
+    async def acompletion(self, model, metadata, **kwargs):
+        await self.plugin.async_filter_deployments(model, [], request_kwargs={"metadata": metadata})
+        return self.answer
+
+
+def cascade_request():
+    return {"model": "auto-chat", "messages": [{"role": "user", "content": "what is 2+2?"}]}
+
+
+# proxy 对 /v1/chat/completions 调用 pre-call hook 时 call_type 为 acompletion
+@pytest.mark.parametrize("call_type", ["acompletion", "completion"])
+def test_accepted_answer_short_circuits(make_router, monkeypatch, vr, call_type):
+    router = make_router(VIBE_CASCADE_MODELS="auto-chat")
+    monkeypatch.setattr(vr, "_get_llm_router", lambda: FakeRouter(router, response("The answer to that is four.")))
+    data = run(router.async_pre_call_hook(None, None, cascade_request(), call_type))
+    assert data["mock_response"] == "The answer to that is four."
+    assert data["metadata"]["vibe_short_circuit"] == "cascade"
+
+
+def test_anthropic_messages_are_not_cascaded(make_router, monkeypatch, vr):
+    router = make_router(VIBE_CASCADE_MODELS="auto-chat")
+    monkeypatch.setattr(vr, "_get_llm_router", lambda: FakeRouter(router, response("The answer to that is four.")))
+    data = run(router.async_pre_call_hook(None, None, cascade_request(), "anthropic_messages"))
+    assert "mock_response" not in data
+    assert router._cascade_applies(cascade_request(), "auto-chat", "acompletion")
+
+
+def test_escalation_keeps_request_and_charges_retry_budget(make_router, monkeypatch, vr):
+    router = make_router(VIBE_CASCADE_MODELS="auto-chat")
+    monkeypatch.setattr(vr, "_get_llm_router", lambda: FakeRouter(router, response("Hmm", "length")))
+    data = run(router.async_pre_call_hook(None, None, cascade_request(), "acompletion"))
+    assert "mock_response" not in data
+    assert data["metadata"]["routing_reason"] == "cascade_escalated"
+    firsts, _ = router.retry_budget._totals("auto-chat-mini", __import__("time").monotonic())
+    assert firsts == 1
+    assert not router._request_attempts
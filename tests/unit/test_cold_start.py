@@ -0,0 +1,51 @@
+"""快照恢复与冷启动判定 (user-036)"""
+
+import gzip
+import json
+import time
+
+from conftest import deployment
+
+
+def write_snapshot(path, age, deployment_ids):
+    state = {"version": 1, "saved_at": time.time() - age,
+             "stats": {"tables": {"deployment_latency": {d: [1.0, time.time() - age] for d in deployment_ids}}},
+             "affinity": {}}
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(state, f)
+
+
+def setup(tmp_path, model_list, make_router, age, covered):
+    model_list([deployment("auto-chat", "a"), deployment("auto-chat", "b", 2)])
+    path = tmp_path / "state.json.gz"
+    write_snapshot(path, age, covered)
+    return make_router(VIBE_STATE_FILE=str(path), VIBE_STATE_HALF_LIFE="300")
+
+
+def test_fresh_full_snapshot_is_warm(tmp_path, model_list, make_router):
+    router = setup(tmp_path, model_list, make_router, 10, ["a", "b"])
+    assert not router.is_cold()
+    assert router.cold_deployments() == []
+
+
+def test_partial_snapshot_stays_cold(tmp_path, model_list, make_router):
+    router = setup(tmp_path, model_list, make_router, 10, ["a"])
+    assert router.is_cold()
+    assert router.cold_deployments() == ["b"]
+    router.stats.observe_latency("auto-chat", "b", 1.0)
+    assert not router.is_cold()
+
+
+def test_stale_snapshot_stays_cold(tmp_path, model_list, make_router):
+    router = setup(tmp_path, model_list, make_router, 1000, ["a", "b"])
+    assert router.snapshotter.restored_age is not None
+    assert router.is_cold()
+
+
+def test_enough_live_samples_end_cold_start(model_list, make_router):
+    model_list([deployment("auto-chat", "a")])
+    router = make_router(VIBE_COLD_START_SAMPLES="3")
+    assert router.is_cold()
+    for _ in range(3):
+        router.stats.observe_latency("auto-chat", "a", 1.0)
+    assert not router.is_cold()
@@ -0,0 +1,68 @@
+"""历史压缩: 工具结果去重 / 截断、丢弃最旧轮次, OpenAI 与 Anthropic 请求格式 (user-050)"""
+
+import types
+
+import pytest
+
+from conftest import deployment, run
+
+LOG = "line of build output\n" * 40
+
+
+def key():
+    return types.SimpleNamespace(api_key="sk-a", token=None, team_id=None, metadata={}, team_metadata=None,
+                                 user_id=None)
+
+
+@pytest.fixture
+def router(make_router, model_list):
+    model_list([deployment("auto-claude", "c1", max_input_tokens=200000)])
+    return make_router(VIBE_COMPACTION_ENABLED="true", VIBE_COMPACTION_MODELS="auto-claude",
+                       VIBE_COMPACTION_TOOL_MAX_CHARS="300", VIBE_TOOL_LOOP_ROUTING_ENABLED="false")
+
+
+def anthropic_turn(i, output):
+    return [
+        {"role": "assistant", "content": [{"type": "tool_use", "id": f"t{i}", "name": "bash",
+                                           "input": {"command": "make"}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"t{i}",
+                                      "content": [{"type": "text", "text": output}]}]},
+    ]
+
+
+def test_anthropic_messages_payload_is_compacted(router):
+    messages = [{"role": "user", "content": "fix the build"}]
+    messages += anthropic_turn(1, LOG) + anthropic_turn(2, LOG) + anthropic_turn(3, "x" * 1000)
+    data = {"model": "auto-claude", "system": "You are a coding agent.", "max_tokens": 1024,
+            "messages": messages}
+    result = run(router.async_pre_call_hook(key(), None, data, "anthropic_messages"))
+    compaction = result["metadata"]["vibe_compaction"]
+    assert compaction["deduped"] == 1 and compaction["truncated"] == 2
+    assert compaction["tokens_after"] < compaction["tokens_before"]
+    results = [m["content"][0]["content"] for m in result["messages"] if m["role"] == "user"
+               and isinstance(m["content"], list)]
+    assert "characters truncated" in results[0]
+    assert "identical to the earlier tool result of t1" in results[1]
+    assert result["system"] == "You are a coding agent."
+    # 原请求中的消息对象不被修改
+    assert messages[4]["content"][0]["content"][0]["text"] == LOG
+
+
+def test_oldest_turns_are_dropped_with_notice(vr):
+    messages = [{"role": "system", "content": "sys"}]
+    for i in range(6):
+        messages += [{"role": "user", "content": f"step {i} " + "word " * 200},
+                     {"role": "assistant", "content": "done " * 200}]
+    kept, dropped, tokens = vr._drop_oldest_turns(messages, 800, 2)
+    assert dropped > 0 and tokens > 0
+    assert kept[0] == messages[0]
+    # 说明并入切点后的首条 user 消息, 最近的消息原样保留
+    assert kept[-1] == messages[-1]
+    assert kept[1]["content"].startswith(f"[vibe-router: {dropped} earlier messages")
+    assert kept[1]["content"].endswith(messages[-2]["content"])
+
+
+def test_other_call_types_are_left_alone(router):
+    data = {"model": "auto-claude", "input": ["a"]}
+    result = run(router.async_pre_call_hook(key(), None, data, "aembedding"))
+    assert "vibe_compaction" not in (result or data).get("metadata", {})
@@ -0,0 +1,34 @@
+"""按类型遍历消息内容块 (user-027)"""
+
+
+def test_text_parts_are_read_and_lowercased(vr):
+    features = vr._walk_content([{"type": "text", "text": "Hello"}, {"type": "input_text", "text": "World"}], 100)
+    assert features.text == "hello world"
+    assert features.text_chars == 10
+    assert not features.truncated
+
+
+def test_media_payload_is_counted_not_read(vr):
+    class Exploding(dict):
+        def __getitem__(self, key):
+            raise AssertionError("media payload must not be read")
+
+    image = {"type": "image_url", "image_url": Exploding()}
+    features = vr._walk_content([image, {"type": "text", "text": "caption"}], 100)
+    assert features.media_parts == 1
+    assert features.text == "caption"
+
+
+def test_scan_cap_truncates_but_counts_full_length(vr):
+    features = vr._walk_content("x" * 50, 10)
+    assert features.text == "x" * 10
+    assert features.text_chars == 50
+    assert features.truncated
+
+
+def test_tool_blocks_are_counted_and_results_walked(vr):
+    content = [{"type": "tool_use", "id": "t1", "name": "grep", "input": {}},
+               {"type": "tool_result", "tool_use_id": "t1", "content": [{"type": "text", "text": "match"}]}]
+    features = vr._walk_content(content, 100)
+    assert (features.tool_uses, features.tool_results) == (1, 1)
+    assert features.text == "match"
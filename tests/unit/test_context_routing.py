@@ -0,0 +1,33 @@
+"""Token 估算与上下文窗口感知过滤 (user-028)"""
+
+from conftest import deployment
+
+
+def test_ascii_estimate_is_about_four_chars_per_token(vr):
+    assert 240 <= vr._estimate_text_tokens("word " * 200) <= 260
+
+
+def test_cjk_estimate_is_about_one_token_per_char(vr):
+    assert 950 <= vr._estimate_text_tokens("路由" * 500) <= 1050
+
+
+def test_request_estimate_covers_system_tools_and_tool_calls(vr):
+    data = {"system": "s" * 400,
+            "messages": [{"role": "assistant", "content": None,
+                          "tool_calls": [{"function": {"name": "f", "arguments": "a" * 400}}]}],
+            "tools": [{"name": "t"}]}
+    assert vr._estimate_request_tokens(data) >= 200
+
+
+def test_media_parts_use_fixed_cost(vr):
+    content = [{"type": "image_url", "image_url": {"url": "data:" + "A" * 1_000_000}}]
+    assert vr._estimate_content_tokens(content) == vr._MEDIA_PART_TOKENS
+
+
+def test_layers_that_cannot_fit_are_skipped(make_router, model_list):
+    small = deployment("auto-claude", "small", order=1, max_input_tokens=1000)
+    large = deployment("auto-claude", "large", order=2, max_input_tokens=200000)
+    model_list([small, large])
+    router = make_router()
+    metadata = {"vibe_request_id": "r", "vibe_estimated_tokens": 5000}
+    assert router._select_deployments("auto-claude", [small, large], metadata) == [large]
@@ -0,0 +1,109 @@
+"""Embeddings 微批处理: 合并、按大小 / token 提前发送、失败回退、结果拆分 (user-049)"""
+
+import asyncio
+import types
+
+import pytest
+
+from conftest import deployment, run
+
+
+class Upstream:
+    """记录每次批次调用, 向量 = [输入长度]"""
+
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+
+    async def __call__(self, key, inputs):
+        self.calls.append(list(inputs))
+        if self.error is not None:
+            raise self.error
+        return [[float(len(text))] for text in inputs]
+
+
+def batcher(vr, send, **kwargs):
+    return vr.EmbeddingBatcher(vr.VibeMetrics(), send, **kwargs)
+
+
+def test_requests_in_window_share_one_call(vr):
+    upstream = Upstream()
+
+    async def scenario():
+        b = batcher(vr, upstream, window_ms=20)
+        return await asyncio.gather(*(b.submit(("emb",), "x" * n, 1) for n in (1, 2, 3)))
+
+    results = run(scenario())
+    assert upstream.calls == [["x", "xx", "xxx"]]
+    assert [vector for vector, _, _ in results] == [[1.0], [2.0], [3.0]]
+    assert all(size == 3 for _, size, _ in results)
+
+
+def test_full_batch_is_sent_without_waiting_for_window(vr):
+    upstream = Upstream()
+
+    async def scenario():
+        b = batcher(vr, upstream, window_ms=10_000, max_size=2)
+        return await asyncio.wait_for(asyncio.gather(b.submit(("emb",), "a", 1), b.submit(("emb",), "b", 1)), 1.0)
+
+    run(scenario())
+    assert upstream.calls == [["a", "b"]]
+
+
+def test_token_limit_starts_new_batch_and_keys_are_separate(vr):
+    upstream = Upstream()
+
+    async def scenario():
+        b = batcher(vr, upstream, window_ms=10, max_tokens=10)
+        await asyncio.gather(b.submit(("emb",), "a", 6), b.submit(("emb",), "b", 6),
+                             b.submit(("other",), "c", 1))
+
+    run(scenario())
+    assert sorted(upstream.calls) == [["a"], ["b"], ["c"]]
+
+
+def test_failure_reaches_every_caller(vr):
+    async def scenario():
+        b = batcher(vr, Upstream(RuntimeError("boom")), window_ms=5)
+        return await asyncio.gather(b.submit(("emb",), "a", 1), b.submit(("emb",), "b", 1),
+                                    return_exceptions=True)
+
+    assert [type(e) for e in run(scenario())] == [RuntimeError, RuntimeError]
+
+
+@pytest.mark.parametrize("call_type", ["aembedding", "embeddings"])
+def test_hook_returns_own_vector_and_bills_batch_to_caller(make_router, model_list, call_type):
+    llm = model_list([deployment("emb", "e1")])
+    calls = []
+
+    async def aembedding(model, input, metadata, **params):
+        calls.append((model, list(input), metadata, params))
+        # 上游可能打乱顺序, 按 index 拆回
+        return types.SimpleNamespace(data=[{"index": i, "embedding": [float(i)]}
+                                           for i in reversed(range(len(input)))])
+
+    llm.aembedding = aembedding
+    router = make_router(VIBE_EMBEDDING_BATCH_ENABLED="true", VIBE_EMBEDDING_BATCH_WINDOW_MS="20")
+
+    async def scenario():
+        requests = [{"model": "emb", "input": [text], "dimensions": 8,
+                     "metadata": {"vibe_request_id": text, "vibe_budget_key": "sk-a"}} for text in ("a", "b")]
+        # 与 proxy 一样经过 pre-call hook
+        await asyncio.gather(*(router.async_pre_call_hook(None, None, data, call_type) for data in requests))
+        return requests
+
+    requests = run(scenario())
+    assert [data["mock_response"] for data in requests] == [[0.0], [1.0]]
+    assert requests[1]["metadata"]["vibe_embedding_batch"]["size"] == 2
+    (model, inputs, metadata, params), = calls
+    assert (model, inputs, params) == ("emb", ["a", "b"], {"dimensions": 8})
+    assert metadata["vibe_budget_key"] == "sk-a"
+
+
+@pytest.mark.parametrize("data", [
+    {"input": ["a", "b"]},
+    {"input": [[1, 2, 3]]},
+    {"input": "a", "encoding_format": "base64"},
+])
+def test_unbatchable_inputs_are_sent_alone(vr, data):
+    assert vr._batchable_embedding(data) is None
@@ -0,0 +1,52 @@
+"""延迟等级与预算感知选择 (user-037)"""
+
+from types import SimpleNamespace
+
+from conftest import deployment
+
+
+def test_header_wins_over_metadata(vr):
+    data = {"proxy_server_request": {"headers": {"x-vibe-latency-class": "batch"}},
+            "metadata": {"vibe_latency_class": "interactive"}}
+    assert vr._latency_request(data, None, 5000) == ("batch", None)
+
+
+def test_budget_alone_implies_class(vr):
+    assert vr._latency_request({"metadata": {"vibe_latency_ms": "2000"}}, None, 5000) == ("interactive", 2000.0)
+    assert vr._latency_request({"metadata": {"vibe_latency_ms": 60000}}, None, 5000) == ("standard", 60000.0)
+
+
+def test_interactive_without_budget_uses_default(vr):
+    key = SimpleNamespace(metadata={"vibe_latency_class": "Interactive"})
+    assert vr._latency_request({}, key, 5000) == ("interactive", 5000)
+    assert vr._latency_request({}, None, 5000) == ("standard", None)
+
+
+def test_budget_keeps_layers_predicted_in_time(make_router):
+    fast, slow = deployment("auto-chat", "fast"), deployment("auto-chat", "slow", 2)
+    router = make_router()
+    router.stats.observe_latency("auto-chat", "fast", 1.0)
+    router.stats.observe_latency("auto-chat", "slow", 9.0)
+    metadata = {"vibe_latency_budget_ms": 3000, "vibe_latency_class": "interactive"}
+    assert router._filter_by_latency("auto-chat", [fast, slow], metadata) == [fast]
+
+
+def test_fastest_layer_kept_when_none_fits(make_router):
+    fast, slow = deployment("auto-chat", "fast"), deployment("auto-chat", "slow", 2)
+    router = make_router()
+    router.stats.observe_latency("auto-chat", "fast", 4.0)
+    router.stats.observe_latency("auto-chat", "slow", 9.0)
+    metadata = {"vibe_latency_budget_ms": 1000, "vibe_latency_class": "interactive"}
+    assert router._filter_by_latency("auto-chat", [fast, slow], metadata) == [fast]
+    assert router.metrics.counter("vibe_latency_budget_misses_total", model_group="auto-chat",
+                                  latency_class="interactive") == 1
+
+
+def test_batch_requests_leave_reserved_slots(make_router):
+    limited = deployment("auto-chat", "limited", max_concurrency=4)
+    spare = deployment("auto-chat", "spare", 2)
+    router = make_router(VIBE_INTERACTIVE_RESERVE="0.25")
+    router.inflight["limited"] = 3
+    assert router._filter_by_latency("auto-chat", [limited, spare], {"vibe_latency_class": "batch"}) == [spare]
+    assert router._filter_by_latency("auto-chat", [limited, spare],
+                                     {"vibe_latency_class": "interactive"}) == [limited, spare]
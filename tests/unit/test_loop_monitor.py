@@ -0,0 +1,42 @@
+"""事件循环延迟监控与阻塞归因 (user-042)"""
+
+import asyncio
+import sys
+import time
+
+from conftest import run
+
+
+def test_blocking_call_is_recorded(vr):
+    monitor = vr.LoopLagMonitor(vr.VibeMetrics(), interval=0.01, threshold_ms=50)
+
+    async def scenario():
+        monitor.ensure_started()
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)  # 同步阻塞事件循环
+        await asyncio.sleep(0.05)
+        monitor._task.cancel()
+
+    run(scenario())
+    report = monitor.report()
+    assert len(report["blocks"]) == 1
+    assert report["blocks"][0]["blocked_ms"] >= 150
+    assert report["blocks"][0]["source"] in ("other", "unknown")
+    assert "p50" in report["lag_ms"]
+
+
+def test_block_is_attributed_to_outermost_plugin_function(vr):
+    metrics = vr.VibeMetrics()
+    frames = []
+    metrics.register_collector(lambda m: frames.append(sys._getframe()))
+    metrics.render()
+    source, stack = vr.LoopLagMonitor._attribute(frames[0])
+    assert source == "render"
+    assert any("render" in line for line in stack)
+
+
+def test_monitor_is_opt_in(vr, monkeypatch):
+    monkeypatch.delenv("VIBE_LOOP_MONITOR_ENABLED", raising=False)
+    assert vr.VibeIntelligentRouter().loop_monitor is None
+    monkeypatch.setenv("VIBE_LOOP_MONITOR_ENABLED", "true")
+    assert vr.VibeIntelligentRouter().loop_monitor is not None
@@ -0,0 +1,46 @@
+"""Proxy 开销分解 (user-044)"""
+
+import datetime
+
+import pytest
+
+from conftest import log_success
+
+
+def test_stages_are_derived_from_stamps(make_router):
+    router = make_router()
+    metadata = {"vibe_request_id": "r1", "vibe_bench": "run-1", "model_group": "auto-chat"}
+    # 固定时间戳: datetime 只有微秒精度, 用当前时间会让浮点结果随时间抖动
+    start = 1_700_000_000.0
+    for offset, stage in enumerate(("arrival", "pre_call_start", "pre_call_end", "filter_start",
+                                    "selected", "filter_end", "pre_api_call")):
+        router._stamp(metadata, stage, start + offset * 0.01)
+    router._record_overhead(metadata, datetime.datetime.fromtimestamp(start + 0.5))
+    report = router.overhead_report("run-1")
+    assert report["requests"] == 1
+    stages = report["stages_ms"]
+    assert stages["pre_call_hook"]["p50"] == pytest.approx(10.0, abs=0.01)
+    assert stages["upstream"]["p50"] == pytest.approx(440.0, abs=0.01)
+    assert stages["proxy_total"]["p50"] == pytest.approx(60.0, abs=0.01)
+    assert "callback" in stages
+
+
+def test_stamps_are_not_overwritten_by_retries(make_router):
+    router = make_router()
+    metadata = {"vibe_request_id": "r1"}
+    router._stamp(metadata, "filter_start", 1.0)
+    router._stamp(metadata, "filter_start", 2.0)
+    assert metadata["vibe_timings"]["filter_start"] == 1.0
+
+
+def test_success_callback_records_only_tagged_runs(make_router):
+    router = make_router()
+    for request_id, bench in (("r1", "a"), ("r2", None)):
+        metadata = {"vibe_request_id": request_id, "model_group": "auto-chat"}
+        if bench:
+            metadata["vibe_bench"] = bench
+        router._stamp(metadata, "pre_api_call")
+        log_success(router, metadata, "d1")
+    assert router.overhead_report("a")["requests"] == 1
+    assert router.overhead_report()["requests"] == 1
+    assert router._request_timings == {}
@@ -0,0 +1,38 @@
+"""上游连接预热 (user-039)"""
+
+from types import SimpleNamespace
+
+from conftest import deployment, run
+
+
+class FakeClient:
+    def __init__(self):
+        self.requests = []
+        self.event_hooks = {}
+
+    async def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+
+        async def aclose():
+            pass
+
+        return SimpleNamespace(aclose=aclose)
+
+
+def test_prewarm_is_opt_in(vr, monkeypatch):
+    monkeypatch.delenv("VIBE_PREWARM_ENABLED", raising=False)
+    assert vr.VibeIntelligentRouter().warmer is None
+
+
+def test_warm_once_probes_each_upstream(vr, monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(vr.ConnectionWarmer, "_clients_for", staticmethod(lambda deployment: [client]))
+    warmer = vr.ConnectionWarmer(vr.VibeMetrics())
+    router = SimpleNamespace(model_list=[deployment("auto-chat", "a"), deployment("auto-chat", "b", 2)])
+    run(warmer.warm_once(router))
+    assert {url for _, url in client.requests} == {"https://a.example/v1", "https://b.example/v1"}
+    assert all(method == "HEAD" for method, _ in client.requests)
+    assert warmer.deployment_upstream == {"a": "a.example", "b": "b.example"}
+    assert warmer.metrics.counter("vibe_upstream_warm_total", upstream="a.example", result="error") == 0
+    assert warmer.metrics.quantile("vibe_upstream_warm_seconds", 0.5, upstream="a.example") is not None
+    assert "request" in client.event_hooks
@@ -0,0 +1,42 @@
+"""按需采样 profiler: collapsed-stack 输出、同时只运行一个采样 (user-043)"""
+
+import asyncio
+import threading
+
+from conftest import run
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_samples_other_threads_as_collapsed_stacks(vr):
+    stop = threading.Event()
+    worker = threading.Thread(target=busy, args=(stop,), name="busy-worker", daemon=True)
+    worker.start()
+    try:
+        result = run(vr.SamplingProfiler(hz=200).run(0.1))
+    finally:
+        stop.set()
+        worker.join()
+    assert result["samples"] > 0
+    stacks = [stack for stack in result["stacks"] if stack.startswith("busy-worker;")]
+    assert stacks and any(stack.endswith("test_profiler:busy") for stack in stacks)
+    lines = vr.SamplingProfiler.collapsed(result).splitlines()
+    counts = [int(line.rsplit(" ", 1)[1]) for line in lines]
+    assert counts == sorted(counts, reverse=True)
+
+
+def test_concurrent_run_is_refused(vr):
+    profiler = vr.SamplingProfiler(hz=50)
+
+    async def scenario():
+        first = asyncio.ensure_future(profiler.run(0.1))
+        await asyncio.sleep(0.01)
+        second = await profiler.run(0.1)
+        return await first, second
+
+    first, second = run(scenario())
+    assert first is not None and second is None
+    assert profiler.last is first
@@ -0,0 +1,70 @@
+"""增量候选排名: bisect 维护的有序列表、top-k 截断、健康阈值校验 (user-047)"""
+
+import time
+
+from conftest import deployment
+
+
+def ids(deployments):
+    return [d["model_info"]["id"] for d in deployments]
+
+
+def make_ranking(vr, model, top_k=0, min_health=0.2):
+    stats = vr.RoutingStats()
+    ranking = vr.CandidateRanking(stats, min_health, 500, top_k=top_k)
+    ranking.rebuild(vr.RoutingTable(model))
+    return stats, ranking
+
+
+def test_update_moves_only_changed_deployment(vr):
+    model = [deployment("auto-chat", i) for i in ("a", "b", "c")] + [deployment("auto-chat", "d", 2)]
+    stats, ranking = make_ranking(vr, model)
+    stats.observe_latency("auto-chat", "a", 3.0)
+    stats.observe_latency("auto-chat", "b", 1.0)
+    assert [i for _, i in ranking._ranked["auto-chat"]] == ["c", "b", "a", "d"]
+    stats.observe_latency("auto-chat", "c", 9.0)
+    assert [i for _, i in ranking._ranked["auto-chat"]] == ["b", "a", "c", "d"]
+    # 没有排在首选层的 deployment 再快也留在后面的层
+    stats.observe_latency("auto-chat", "d", 0.1)
+    assert ranking._ranked["auto-chat"][-1][1] == "d"
+    assert len(ranking._ranked["auto-chat"]) == 4
+
+
+def test_order_filters_ranked_list_and_trims_to_top_k(vr):
+    model = [deployment("auto-chat", i) for i in ("a", "b", "c")]
+    stats, ranking = make_ranking(vr, model, top_k=1)
+    stats.observe_latency("auto-chat", "a", 2.0)
+    stats.observe_latency("auto-chat", "b", 1.0)
+    stats.observe_latency("auto-chat", "c", 3.0)
+    assert ids(ranking.order([model[0], model[2]])) == ["a"]
+    ranking.top_k = 0
+    unknown = deployment("auto-chat", "new")
+    assert ids(ranking.order([unknown] + model)) == ["b", "a", "c", "new"]
+
+
+def test_unhealthy_deployment_recovers_at_threshold(vr):
+    model = [deployment("auto-chat", "a"), deployment("auto-chat", "b")]
+    stats, ranking = make_ranking(vr, model, min_health=0.5)
+    for _ in range(5):
+        stats.record_outcome("a", False)
+    now = time.monotonic()
+    assert not ranking.is_healthy("a", now) and ranking.is_healthy("b", now)
+    assert ranking.is_healthy("a", now + 10 * stats.health_half_life)
+
+
+def test_top_k_limits_candidates_passed_to_router(vr, make_router, model_list):
+    model_list([deployment("auto-chat", i) for i in ("a", "b", "c")])
+    router = make_router(VIBE_RANKING_TOP_K="2")
+    router.stats.observe_latency("auto-chat", "c", 0.5)
+    router.stats.observe_latency("auto-chat", "a", 1.0)
+    router.stats.observe_latency("auto-chat", "b", 5.0)
+    chosen = router._select_deployments("auto-chat", list(vr._routing_table().group("auto-chat")), {})
+    assert ids(chosen) == ["c", "a"]
+
+
+def test_out_of_range_health_threshold_falls_back_to_default(make_router, model_list):
+    model_list([deployment("auto-chat", "a")])
+    router = make_router(VIBE_HEALTH_MIN_SCORE="1.0")
+    assert router.health_min_score == 0.2
+    router.stats.record_outcome("a", False)
+    assert router.ranking.is_healthy("a", time.monotonic() + 3600)
@@ -0,0 +1,54 @@
+"""重试预算: 令牌计算、pre-call 计数、请求结束时的清理 (user-026)"""
+
+from conftest import run
+
+
+def test_tokens_follow_ratio_and_minimum(vr):
+    budget = vr.RetryBudget(ratio=0.5, window_seconds=60, min_retries=2)
+    for _ in range(10):
+        budget.record_request("auto-chat")
+    assert budget.tokens("auto-chat") == 7
+    for _ in range(7):
+        assert budget.try_acquire_retry("auto-chat")
+    assert not budget.try_acquire_retry("auto-chat")
+    assert not budget.has_budget("auto-chat")
+
+
+def test_window_expiry_restores_budget(vr):
+    budget = vr.RetryBudget(ratio=0.0, window_seconds=60, min_retries=1)
+    assert budget.try_acquire_retry("s")
+    assert budget.tokens("s") == 0
+    assert budget.tokens("s", now=10_000.0 + 1e9) == 1
+
+
+def test_exhausted_budget_disables_retries(make_router):
+    router = make_router(VIBE_RETRY_BUDGET_MIN_RETRIES=0, VIBE_RETRY_BUDGET_RATIO=0)
+    data = run(router.async_pre_call_hook(None, None, {"model": "auto-chat", "messages": []}, "completion"))
+    assert data["num_retries"] == 0
+    assert data["metadata"]["vibe_retry_budget"] == "exhausted"
+
+
+def test_retry_attempt_is_cut_when_budget_is_empty(make_router):
+    router = make_router(VIBE_RETRY_BUDGET_MIN_RETRIES=0, VIBE_RETRY_BUDGET_RATIO=0)
+    kwargs = {"metadata": {"vibe_request_id": "r1", "vibe_retry_scope": "auto-chat"}}
+    deployments = [{"model_name": "auto-chat", "model_info": {"id": "a"}}]
+    assert run(router.async_filter_deployments("auto-chat", deployments, request_kwargs=kwargs)) == deployments
+    assert run(router.async_filter_deployments("auto-chat", deployments, request_kwargs=kwargs)) == []
+
+
+def test_final_failure_releases_attempt_counter(make_router):
+    router = make_router()
+    kwargs = {"metadata": {"vibe_request_id": "r1"}}
+    run(router.async_filter_deployments("auto-chat", [], request_kwargs=kwargs))
+    assert "r1" in router._request_attempts
+    run(router.async_post_call_failure_hook({"metadata": {"vibe_request_id": "r1"}}, RuntimeError("x"), None))
+    assert "r1" not in router._request_attempts
+
+
+def test_internal_calls_count_first_attempts(make_router):
+    router = make_router()
+    kwargs = {"metadata": {"vibe_request_id": "i1", "vibe_internal": "cascade", "vibe_retry_scope": "auto-chat-mini"}}
+    run(router.async_filter_deployments("auto-chat-mini", [], request_kwargs=kwargs))
+    run(router.async_filter_deployments("auto-chat-mini", [], request_kwargs=kwargs))
+    firsts, retries = router.retry_budget._totals("auto-chat-mini", __import__("time").monotonic())
+    assert (firsts, retries) == (1, 1)
@@ -0,0 +1,41 @@
+"""路由解释 dry-run (user-034)"""
+
+from conftest import deployment, run
+
+
+def setup_groups(model_list):
+    small = deployment("auto-claude", "small", order=1, max_input_tokens=1000)
+    large = deployment("auto-claude", "large", order=2, max_input_tokens=200000)
+    model_list([small, large])
+
+
+def test_explain_reports_candidates_and_trace(make_router, model_list):
+    setup_groups(model_list)
+    router = make_router()
+    result = run(router.explain_route({"model": "auto-claude",
+                                       "messages": [{"role": "user", "content": "x " * 20000}]}))
+    assert result["routed_model"] == "auto-claude"
+    assert [c["id"] for c in result["candidates"]] == ["small", "large"]
+    eligible = {c["id"]: c["eligible"] for c in result["candidates"]}
+    assert eligible == {"small": False, "large": True}
+    assert {"small": False, "large": True} == {c["id"]: c["fits_context"] for c in result["candidates"]}
+    stages = {step["stage"]: step["candidates"] for step in result["selection_trace"]}
+    assert len(stages["context"]) == 1
+
+
+def test_explain_has_no_side_effects(make_router, model_list):
+    setup_groups(model_list)
+    router = make_router(VIBE_AFFINITY_ENABLED="true", VIBE_RETRY_BUDGET_ENABLED="true")
+    before = dict(router.metrics._counters)
+    tokens = router.retry_budget.tokens("auto-claude")
+    run(router.explain_route({"model": "auto-claude", "messages": [{"role": "user", "content": "x " * 20000}]}))
+    assert router.metrics._counters == before
+    assert router.retry_budget.tokens("auto-claude") == tokens
+    assert len(router.affinity) == 0
+
+
+def test_explain_passthrough_model(make_router, model_list):
+    model_list([])
+    result = run(make_router().explain_route({"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}))
+    assert result["routing_reason"] == "passthrough_to_new_api"
+    assert result["candidates"] == []
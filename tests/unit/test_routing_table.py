@@ -0,0 +1,96 @@
+"""编译路由表: 重建、构建时校验、通配符匹配 (user-046)"""
+
+import pytest
+
+from conftest import deployment, run
+
+
+def test_groups_are_ordered_by_layer(vr):
+    table = vr.RoutingTable([deployment("auto-chat", "b", 2), deployment("auto-chat", "a", 1)])
+    assert [d["model_info"]["id"] for d in table.group("auto-chat")] == ["a", "b"]
+    assert table.by_id["b"]["model_info"]["fallback_order"] == 2
+
+
+def test_wildcard_prefers_most_specific_pattern(vr):
+    table = vr.RoutingTable([deployment("*", "any"), deployment("claude-*", "c"),
+                             deployment("claude-opus-*", "o")])
+    assert table.match_wildcard("claude-opus-4") == "claude-opus-*"
+    assert table.match_wildcard("claude-haiku") == "claude-*"
+    assert table.match_wildcard("gpt-4o") == "*"
+
+
+def test_inplace_upsert_rebuilds_table(vr, model_list, monkeypatch):
+    monkeypatch.setattr(vr, "_ROUTING_TABLE_CHECK_INTERVAL", 0.0)
+    router = model_list([deployment("auto-chat", "a"), deployment("auto-chat", "b", 2)])
+    assert vr._routing_table().by_id["a"]["model_info"]["fallback_order"] == 1
+    # 与 LiteLLM upsert_deployment 一样: 同一个 list 中替换条目, 长度不变
+    router.model_list[0] = deployment("auto-chat", "a", 3)
+    table = vr._routing_table()
+    assert table.by_id["a"]["model_info"]["fallback_order"] == 3
+    assert [d["model_info"]["id"] for d in table.group("auto-chat")] == ["b", "a"]
+
+
+def test_unchanged_model_list_keeps_table(vr, model_list, monkeypatch):
+    monkeypatch.setattr(vr, "_ROUTING_TABLE_CHECK_INTERVAL", 0.0)
+    model_list([deployment("auto-chat", "a")])
+    assert vr._routing_table() is vr._routing_table()
+
+
+def missing_env(group, deployment_id, order=1):
+    broken = deployment(group, deployment_id, order)
+    broken["litellm_params"]["api_key"] = "os.environ/VIBE_TEST_MISSING_KEY"
+    return broken
+
+
+def duplicated(group):
+    first = deployment(group, "1", 1)
+    second = deployment(group, "2", 1)
+    second["litellm_params"] = dict(first["litellm_params"])
+    return [first, second]
+
+
+@pytest.fixture(autouse=True)
+def unset_missing_key(monkeypatch):
+    monkeypatch.delenv("VIBE_TEST_MISSING_KEY", raising=False)
+
+
+def test_inconsistent_deployments_are_dropped_at_build_time(vr):
+    model = duplicated("auto-x") + [missing_env("auto-x", "3", 2), deployment("auto-x", "4", 3)]
+    table = vr.RoutingTable(model, strict=True)
+    # 只丢弃出问题的 deployment, 其余层照常使用
+    assert [d["model_info"]["id"] for d in table.group("auto-x")] == ["1", "4"]
+    assert set(table.rejected_ids) == {"2", "3"} and table.rejected == {}
+    assert "duplicate deployment openai/1 at fallback_order 1" in table.rejected_ids["2"]
+    assert "VIBE_TEST_MISSING_KEY is not set" in table.rejected_ids["3"]
+    assert len(table.errors["auto-x"]) == 2
+    lenient = vr.RoutingTable(model)
+    assert lenient.rejected_ids == {} and len(lenient.group("auto-x")) == 4 and lenient.errors["auto-x"]
+
+
+def test_load_balanced_layer_is_valid(vr):
+    assert vr.RoutingTable([deployment("auto-chat", "a", 1), deployment("auto-chat", "b", 1)]).errors == {}
+
+
+def test_rejected_deployment_is_never_selected(make_router, model_list):
+    model = [missing_env("auto-x", "x1", 1), deployment("auto-x", "x2", 2)]
+    model_list(model)
+    router = make_router()
+    assert router._select_deployments("auto-x", model, {}) == [model[1]]
+    assert router._select_deployments("auto-x", model[:1], {}) == []
+
+
+def test_group_without_valid_deployments_gets_503(make_router, model_list):
+    model_list([missing_env("auto-x", "x1")])
+    router = make_router()
+    with pytest.raises(Exception) as error:
+        run(router.async_pre_call_hook(None, None, {"model": "auto-x", "messages": []}, "completion"))
+    assert getattr(error.value, "status_code", None) == 503
+
+
+def test_non_strict_mode_only_logs(make_router, model_list):
+    model = [missing_env("auto-y", "y1")]
+    model_list(model)
+    router = make_router(VIBE_ROUTING_TABLE_STRICT="false")
+    data = run(router.async_pre_call_hook(None, None, {"model": "auto-y", "messages": []}, "completion"))
+    assert data["model"] == "auto-y"
+    assert router._select_deployments("auto-y", model, {}) == model
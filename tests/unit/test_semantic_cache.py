@@ -0,0 +1,137 @@
+"""语义缓存: 命名空间隔离、索引内存计入预算与淘汰、非 dict 消息 (user-048)"""
+
+import types
+
+import pytest
+
+from conftest import run
+
+np = pytest.importorskip("numpy")
+
+
+def caller(api_key="sk-a", team_id=None):
+    return types.SimpleNamespace(api_key=api_key, token=None, team_id=team_id)
+
+
+def request(prompt="what is the capital of france", request_id="r1", **params):
+    return {"model": "auto-chat-mini", "messages": [{"role": "user", "content": prompt}],
+            "metadata": {"vibe_request_id": request_id}, **params}
+
+
+def answer(text):
+    message = types.SimpleNamespace(content=text, tool_calls=None)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason="stop")])
+
+
+@pytest.fixture
+def router(make_router):
+    return make_router(VIBE_SEMANTIC_CACHE_ENABLED="true")
+
+
+def remember(router, data, user, text="Paris."):
+    router._semantic_cache_lookup(data, "auto-chat-mini", user)
+    assert "mock_response" not in data
+    router._semantic_cache_store(data["metadata"], answer(text))
+
+
+def test_hit_requires_same_caller_and_params(router):
+    remember(router, request(temperature=0.2), caller())
+    hit = request("What is the capital of France?", "r2", temperature=0.2)
+    router._semantic_cache_lookup(hit, "auto-chat-mini", caller())
+    assert hit["mock_response"] == "Paris."
+    for user, params in ((caller("sk-b"), {"temperature": 0.2}), (caller(team_id="t1"), {"temperature": 0.2}),
+                         (caller(), {"temperature": 0.9}),
+                         (caller(), {"temperature": 0.2, "response_format": {"type": "json_object"}}),
+                         (caller(), {"temperature": 0.2, "tools": [{"type": "function",
+                                                                     "function": {"name": "f"}}]})):
+        miss = request("What is the capital of France?", "r3", **params)
+        router._semantic_cache_lookup(miss, "auto-chat-mini", user)
+        assert "mock_response" not in miss, (user, params)
+
+
+def test_non_dict_messages_are_not_cacheable(vr):
+    assert vr._cacheable_prompt({"messages": ["hello"]}, 2000) is None
+    assert vr._cacheable_prompt({"messages": [{"role": "system", "content": "s"}, None]}, 2000) is None
+    assert vr._cacheable_prompt({"messages": "hello"}, 2000) is None
+    assert vr._cacheable_prompt({"messages": [{"role": "user", "content": "hi"}]}, 2000) == ("", "hi")
+
+
+def test_index_memory_is_counted_and_freed_with_last_entry(vr):
+    cache = vr.SemanticCache(np, dims=64)
+    vector = cache.signature("hello world")
+    namespace = cache.namespace("m", "", "sk-a|", {})
+    cache.store(namespace, vector, "hi")
+    index_bytes = 16 * 64 * 4 + 16 * 8
+    assert cache.bytes == index_bytes + 2
+    cache._evict(*next(iter(cache._entries)))
+    assert namespace not in cache._indexes and cache.bytes == 0
+
+
+def test_memory_cap_evicts_least_recent_namespaces(vr):
+    index_bytes = 16 * 64 * 4 + 16 * 8
+    cache = vr.SemanticCache(np, dims=64, max_bytes=3 * (index_bytes + 2))
+    vector = cache.signature("hello world")
+    spaces = [cache.namespace("m", "", f"sk-{i}|") for i in range(10)]
+    for namespace in spaces[:3]:
+        assert cache.store(namespace, vector, "hi")
+    # 命中让 sk-0 变为最近使用, 下一次淘汰的是 sk-1
+    assert cache.lookup(spaces[0], vector)[0] == "hi"
+    cache.store(spaces[3], vector, "hi")
+    assert list(cache._indexes) == [spaces[2], spaces[0], spaces[3]]
+    for namespace in spaces[4:]:
+        cache.store(namespace, vector, "hi")
+    assert list(cache._indexes) == spaces[7:] and cache.bytes <= cache.max_bytes
+
+
+def test_store_into_evicted_namespace_is_kept(vr):
+    cache = vr.SemanticCache(np, dims=64, max_entries=1)
+    namespace = cache.namespace("m", "")
+    cache.store(namespace, cache.signature("first question"), "one")
+    assert cache.store(namespace, cache.signature("second question"), "two")
+    assert len(cache) == 1
+    assert cache.lookup(namespace, cache.signature("second question"))[0] == "two"
+    assert cache.bytes == 1 * 64 * 4 + 8 + 3
+
+
+def test_answer_larger_than_cap_is_refused(vr):
+    cache = vr.SemanticCache(np, dims=64, max_bytes=10_000)
+    namespace = cache.namespace("m", "")
+    cache.store(namespace, cache.signature("small"), "ok")
+    assert not cache.store(cache.namespace("n", ""), cache.signature("big"), "x" * 8000)
+    assert len(cache) == 1 and cache.lookup(namespace, cache.signature("small"))[0] == "ok"
+
+
+def hook(router, data, call_type, user=None):
+    return run(router.async_pre_call_hook(user or caller(), None, data, call_type))
+
+
+# proxy 对 /v1/chat/completions 调用 pre-call hook 时 call_type 为 acompletion
+@pytest.mark.parametrize("call_type", ["acompletion", "completion"])
+def test_proxy_chat_requests_are_served_from_cache(router, call_type):
+    first = hook(router, request(request_id="r1"), call_type)
+    assert "mock_response" not in first
+    router._semantic_cache_store(first["metadata"], answer("Paris."))
+    second = hook(router, request("What is the capital of France?", "r2"), call_type)
+    assert second["mock_response"] == "Paris."
+    assert second["metadata"]["vibe_short_circuit"] == "semantic_cache"
+
+
+def anthropic_request(system, request_id):
+    return {"model": "auto-chat-mini", "system": [{"type": "text", "text": system}], "max_tokens": 256,
+            "messages": [{"role": "user", "content": [{"type": "text", "text": "what is the capital of france"}]}],
+            "metadata": {"vibe_request_id": request_id}}
+
+
+def test_anthropic_messages_are_cached_per_system_prompt(router):
+    first = hook(router, anthropic_request("Be terse.", "r1"), "anthropic_messages")
+    router._semantic_cache_store(first["metadata"], {"content": [{"type": "text", "text": "Paris."}],
+                                                     "stop_reason": "end_turn"})
+    assert hook(router, anthropic_request("Be terse.", "r2"), "anthropic_messages")["mock_response"] == "Paris."
+    assert "mock_response" not in hook(router, anthropic_request("Answer in French.", "r3"), "anthropic_messages")
+
+
+def test_tool_use_answers_are_not_stored(vr):
+    assert vr._cacheable_answer({"content": [{"type": "tool_use", "id": "t1", "name": "f", "input": {}}],
+                                 "stop_reason": "tool_use"}) is None
+    assert vr._cacheable_answer({"content": [{"type": "text", "text": "cut"}], "stop_reason": "max_tokens"}) is None
+    assert vr._cacheable_answer(answer("Paris.")) == "Paris."
@@ -0,0 +1,87 @@
+"""跨 worker 共享路由状态 (user-035)"""
+
+import fcntl
+import os
+import time
+import uuid
+
+import pytest
+
+from conftest import run
+
+
+def failing_worker(vr, failures):
+    stats = vr.RoutingStats()
+    for _ in range(failures):
+        stats.record_outcome("d1", ok=False)
+    return stats.export_state()
+
+
+def test_peer_failures_are_summed_not_overwritten(vr):
+    stats = vr.RoutingStats()
+    stats.record_outcome("d1", ok=False)
+    stats.merge_state(failing_worker(vr, 1), source="w2")
+    stats.merge_state(failing_worker(vr, 1), source="w3")
+    # 三个 worker 各失败一次: 缺口约为单次失败的三倍
+    assert stats.health_score("d1") == pytest.approx(1.0 - 3 * stats.alpha, abs=1e-3)
+
+
+def test_republished_peer_state_replaces_previous_snapshot(vr):
+    stats = vr.RoutingStats()
+    stats.merge_state(failing_worker(vr, 1), source="w2")
+    stats.merge_state(failing_worker(vr, 1), source="w2")
+    assert stats.health_score("d1") == pytest.approx(1.0 - stats.alpha, abs=1e-3)
+
+
+def test_only_own_observations_are_exported(vr):
+    stats = vr.RoutingStats()
+    stats.merge_state(failing_worker(vr, 2), source="w2")
+    assert stats.health_score("d1") < 1.0
+    assert stats.export_state()["health"] == {}
+
+
+def test_departed_peers_are_forgotten(vr):
+    stats = vr.RoutingStats()
+    stats.merge_state(failing_worker(vr, 2), source="w2")
+    stats.retain_peers(set())
+    assert stats.health_score("d1") == 1.0
+
+
+def test_rate_limit_takes_latest_expiry(vr):
+    stats = vr.RoutingStats()
+    stats.mark_rate_limited("d1", 5)
+    peer = vr.RoutingStats()
+    peer.mark_rate_limited("d1", 60)
+    stats.merge_state(peer.export_state(), source="w2")
+    assert stats.rate_limited["d1"] - time.monotonic() > 50
+
+
+@pytest.fixture
+def shm_backend(vr):
+    segment = f"vibe_test_{uuid.uuid4().hex[:8]}"
+    backend = vr.SharedMemoryBackend(segment=segment, slots=2, slot_bytes=4096)
+    yield backend
+    backend._shm.close()
+    backend._shm.unlink()
+    os.unlink(os.path.join("/tmp", f"{segment}.lock"))
+
+
+def test_shm_lock_does_not_block_event_loop(shm_backend):
+    shm_backend.LOCK_TIMEOUT_SECONDS = 0.05
+    with open(shm_backend._lock_file.name) as other:
+        fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+        with pytest.raises(TimeoutError):
+            run(shm_backend.publish("w1", {"worker": "w1"}))
+        fcntl.flock(other.fileno(), fcntl.LOCK_UN)
+    run(shm_backend.publish("w1", {"worker": "w1"}))
+    # 本进程的槽位不会被自己读回
+    assert run(shm_backend.collect("w1")) == []
+
+
+def test_backend_must_implement_publish_and_collect(vr):
+    class PublishOnly(vr.SharedStateBackend):
+        async def publish(self, worker_id, state):
+            pass
+
+    with pytest.raises(TypeError):
+        PublishOnly()
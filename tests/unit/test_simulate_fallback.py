@@ -0,0 +1,62 @@
+"""Fallback 配置离线模拟器 (user-045)"""
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("yaml")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import simulate_fallback as sim  # noqa: E402
+
+MODEL_LIST = [
+    {"model_name": "auto-chat", "litellm_params": {"model": "openai/l1"},
+     "model_info": {"fallback_order": 1, "input_cost_per_token": 0.0}},
+    {"model_name": "auto-chat", "litellm_params": {"model": "openai/l2"},
+     "model_info": {"fallback_order": 2, "input_cost_per_token": 1e-6}},
+]
+FAST = {"latency_ms": 100, "p95_ms": 150, "error_rate": 0.0}
+
+
+def arrivals(n, spacing=1.0):
+    return [{"t": i * spacing, "model": "auto-chat", "input_tokens": 1000, "output_tokens": 10} for i in range(n)]
+
+
+def test_healthy_first_layer_serves_everything():
+    result = sim.simulate(MODEL_LIST, {"routing_strategy": "ordered"}, {"*": FAST}, arrivals(50))
+    assert result["success_rate"] == 1.0
+    assert result["layer_mix"] == {"L1": 1.0}
+    assert result["cost_usd"] == 0.0
+
+
+def test_failing_layer_falls_back_with_retries():
+    profiles = {"*": FAST, "auto-chat/L1": dict(FAST, error_rate=1.0)}
+    settings = {"routing_strategy": "ordered", "num_retries": 1, "allowed_fails": 100}
+    result = sim.simulate(MODEL_LIST, settings, profiles, arrivals(20))
+    assert result["success_rate"] == 1.0
+    assert result["layer_mix"] == {"L2": 1.0}
+    assert result["attempts_per_request"] == 2.0
+    assert result["cost_usd"] == pytest.approx(20 * 1000 * 1e-6)
+
+
+def test_no_retries_means_failures_surface():
+    profiles = {"*": FAST, "auto-chat/L1": dict(FAST, error_rate=1.0)}
+    result = sim.simulate(MODEL_LIST, {"routing_strategy": "ordered", "allowed_fails": 100}, profiles, arrivals(10))
+    assert result["success_rate"] == 0.0
+    assert result["failures"] == {"error": 10}
+
+
+def test_concurrency_limit_triggers_cooldown_and_fallback():
+    profiles = {"*": FAST, "auto-chat/L1": dict(FAST, latency_ms=5000, p95_ms=5001, max_concurrency=1)}
+    settings = {"routing_strategy": "ordered", "num_retries": 1, "cooldown_time": 60}
+    result = sim.simulate(MODEL_LIST, settings, profiles, arrivals(5, spacing=0.1))
+    assert result["success_rate"] == 1.0
+    assert result["layer_mix"]["L2"] == 0.8
+
+
+def test_runs_are_reproducible():
+    trace = sim.synthetic_trace(5, 60, {"auto-chat": 1.0}, seed=7, input_tokens=500, output_tokens=100)
+    assert trace == sim.synthetic_trace(5, 60, {"auto-chat": 1.0}, seed=7, input_tokens=500, output_tokens=100)
+    first = sim.simulate(MODEL_LIST, {}, {"*": dict(FAST, error_rate=0.2)}, trace, seed=3)
+    assert first == sim.simulate(MODEL_LIST, {}, {"*": dict(FAST, error_rate=0.2)}, trace, seed=3)
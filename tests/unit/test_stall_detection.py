@@ -0,0 +1,60 @@
+"""流式卡顿检测: opt-in、按模型的 TTFT 上限 (user-033)"""
+
+import asyncio
+
+import pytest
+
+from conftest import deployment, run
+
+
+class Stream:
+    def __init__(self, deployment_id, first_delay, chunks=3):
+        self._hidden_params = {"model_id": deployment_id}
+        self.first_delay = first_delay
+        self.chunks = chunks
+
+    async def _gen(self):
+        await asyncio.sleep(self.first_delay)
+        for i in range(self.chunks):
+            yield f"chunk{i}"
+
+    def __aiter__(self):
+        return self._gen()
+
+
+async def collect(router, stream, model="auto-chat"):
+    return [c async for c in router.async_post_call_streaming_iterator_hook(
+        None, stream, {"model": model, "metadata": {"model_group": model}})]
+
+
+def test_stall_detection_is_opt_in(make_router):
+    router = make_router(VIBE_STREAM_TTFT_LIMIT="0.01")
+    assert not router.stall_detection_enabled
+    assert run(collect(router, Stream("a", 0.05))) == ["chunk0", "chunk1", "chunk2"]
+
+
+def test_slow_first_chunk_fails_with_504(make_router, model_list):
+    model_list([deployment("auto-chat", "a")])
+    router = make_router(VIBE_STALL_DETECTION_ENABLED="true", VIBE_STREAM_TTFT_LIMIT="0.01",
+                         VIBE_STREAM_MAX_REISSUES="0")
+    with pytest.raises(Exception) as error:
+        run(collect(router, Stream("a", 0.2)))
+    assert getattr(error.value, "status_code", None) == 504
+    assert router.metrics.counter("vibe_stream_stalls_total", deployment="auto-chat/L1:openai/a", phase="ttft") == 1
+
+
+def test_per_model_override_disables_ttft_for_reasoning_models(make_router, model_list):
+    reasoning = deployment("auto-chat", "r")
+    reasoning["litellm_params"]["model"] = "openai/gpt-5"
+    model_list([reasoning, deployment("auto-chat", "fast", 2)])
+    router = make_router(VIBE_STALL_DETECTION_ENABLED="true", VIBE_STREAM_TTFT_LIMIT="0.01",
+                         VIBE_STREAM_TTFT_LIMITS="*gpt-5*=0")
+    assert router._stream_ttft_limit("auto-chat", "r") is None
+    assert router._stream_ttft_limit("auto-chat", "fast") == 0.01
+    assert run(collect(router, Stream("r", 0.05))) == ["chunk0", "chunk1", "chunk2"]
+
+
+def test_model_group_override(make_router):
+    router = make_router(VIBE_STREAM_TTFT_LIMITS="auto-codex=90")
+    assert router._stream_ttft_limit("auto-codex", None) == 90
+    assert router._stream_ttft_limit("auto-chat", None) == 30
@@ -0,0 +1,53 @@
+"""Agent 轮次分类与工具循环路由, 包括 /v1/messages 请求 (user-029)"""
+
+import pytest
+
+from conftest import run
+
+
+def anthropic_continuation():
+    return {
+        "model": "auto-claude",
+        "system": "You are Claude Code.",
+        "tools": [{"name": "bash"}],
+        "messages": [
+            {"role": "user", "content": "run the tests"},
+            {"role": "assistant", "content": [{"type": "tool_use", "id": "t1", "name": "bash", "input": {}}]},
+            {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t1", "content": "ok"}]},
+        ],
+    }
+
+
+def test_classify_openai_and_anthropic_turns(vr):
+    openai = {"messages": [{"role": "user", "content": "hi"},
+                           {"role": "assistant", "tool_calls": [{"id": "c"}]},
+                           {"role": "tool", "tool_call_id": "c", "content": "done"}]}
+    assert vr._classify_turn(openai) == vr.TURN_TOOL_CONTINUATION
+    assert vr._classify_turn(anthropic_continuation()) == vr.TURN_TOOL_CONTINUATION
+    summary = anthropic_continuation()
+    summary["messages"].append({"role": "user", "content": "Please summarize what you did"})
+    assert vr._classify_turn(summary) == vr.TURN_FINAL_SUMMARY
+    assert vr._classify_turn({"messages": [{"role": "user", "content": "new task"}]}) == vr.TURN_FRESH_INSTRUCTION
+
+
+@pytest.mark.parametrize("call_type", ["completion", "acompletion", "anthropic_messages"])
+def test_continuation_is_routed_to_mini_for_chat_call_types(make_router, call_type):
+    router = make_router(VIBE_TOOL_LOOP_POLICY="continuation")
+    data = run(router.async_pre_call_hook(None, None, anthropic_continuation(), call_type))
+    assert data["model"] == "auto-claude-mini"
+    assert data["metadata"]["routing_reason"] == "tool_continuation"
+    assert data["metadata"]["vibe_estimated_tokens"] > 0
+
+
+def test_other_call_types_are_left_alone(make_router):
+    router = make_router(VIBE_TOOL_LOOP_POLICY="continuation")
+    data = run(router.async_pre_call_hook(None, None, anthropic_continuation(), "embeddings"))
+    assert data["model"] == "auto-claude"
+    assert "vibe_estimated_tokens" not in data["metadata"]
+
+
+def test_policy_off_only_classifies(make_router):
+    router = make_router(VIBE_TOOL_LOOP_POLICY="off")
+    data = run(router.async_pre_call_hook(None, None, anthropic_continuation(), "anthropic_messages"))
+    assert data["model"] == "auto-claude"
+    assert data["metadata"]["vibe_turn_type"] == "tool_continuation"
@@ -0,0 +1,74 @@
+"""请求追踪: head / tail 采样与 OTLP/JSON 导出 (user-041)"""
+
+import json
+
+from conftest import run
+
+TRACEPARENT = "00-" + "a" * 32 + "-" + "b" * 16 + "-01"
+
+
+def tracer(vr, tmp_path, **kwargs):
+    exporter = vr.TraceExporter(vr.VibeMetrics(), file_path=str(tmp_path / "traces.jsonl"))
+    return vr.Tracer(exporter, **kwargs)
+
+
+def exported_spans(path):
+    spans = []
+    for line in path.read_text().splitlines():
+        for resource in json.loads(line)["resourceSpans"]:
+            for scope in resource["scopeSpans"]:
+                spans.extend(scope["spans"])
+    return spans
+
+
+def test_unsampled_fast_request_is_dropped(vr, tmp_path):
+    t = tracer(vr, tmp_path, sample_rate=0.0)
+    t.start("r1", {})
+    t.finish("r1")
+    assert t.exporter._pending == []
+
+
+def test_failed_request_is_tail_sampled(vr, tmp_path):
+    t = tracer(vr, tmp_path, sample_rate=0.0)
+    trace = t.start("r1", {})
+    trace.span("vibe.pre_call_hook").end()
+    t.finish("r1", error=True)
+    run(t.exporter.flush())
+    spans = exported_spans(tmp_path / "traces.jsonl")
+    assert [s["name"] for s in spans] == ["vibe.request", "vibe.pre_call_hook"]
+    assert spans[1]["parentSpanId"] == spans[0]["spanId"]
+    assert t.exporter.metrics.counter("vibe_traces_sampled_total", reason="error") == 1
+
+
+def test_slow_request_is_tail_sampled(vr, tmp_path):
+    t = tracer(vr, tmp_path, sample_rate=0.0, slow_ms=0.0)
+    t.start("r1", {})
+    t.finish("r1")
+    assert t.exporter.metrics.counter("vibe_traces_sampled_total", reason="slow") == 1
+
+
+def test_incoming_traceparent_is_continued(vr, tmp_path):
+    t = tracer(vr, tmp_path, sample_rate=0.0)
+    trace = t.start("r1", {"proxy_server_request": {"headers": {"traceparent": TRACEPARENT}}})
+    assert trace.trace_id == "a" * 32 and trace.root.parent_id == "b" * 16
+    t.finish("r1")
+    run(t.exporter.flush())
+    assert exported_spans(tmp_path / "traces.jsonl")[0]["traceId"] == "a" * 32
+
+
+def test_evicted_traces_are_exported_as_incomplete(vr, tmp_path):
+    t = tracer(vr, tmp_path, sample_rate=0.0, max_traces=1)
+    t.start("r1", {})
+    t.start("r2", {})
+    assert t.get("r1") is None
+    assert t.exporter.metrics.counter("vibe_traces_sampled_total", reason="slow") == 1
+
+
+def test_router_traces_rejected_request(make_router, tmp_path):
+    router = make_router(VIBE_TRACE_FILE=str(tmp_path / "traces.jsonl"), VIBE_TRACE_SAMPLE_RATE="0")
+    data = run(router.async_pre_call_hook(None, None, {"model": "auto-chat", "messages": []}, "completion"))
+    request_id = data["metadata"]["vibe_request_id"]
+    assert router.tracer.get(request_id) is not None
+    run(router.async_post_call_failure_hook(data, Exception("upstream down"), None))
+    assert router.tracer.get(request_id) is None
+    assert router.metrics.counter("vibe_traces_sampled_total", reason="error") == 1
@@ -0,0 +1 @@
+config/vibe_router.py
\ No newline at end of file